@@ -18,14 +18,19 @@ class Application():
         self.client = None
 
     def exec(self):
-        login_window = LoginWindow(args=self.args)
-        login_window.exec()  # Runs until user connects to the server
-        if not login_window.data:
-            return  # window closed by user
-        self.client = login_window.data['client']
-
-        chat_window = ChatWindow(args={'client': self.client})
-        chat_window.exec()  # Runs until user disconnects from the chat
+        while True:
+            login_window = LoginWindow(args=self.args)
+            login = login_window.exec()  # Runs until user chooses a name and a server
+            if not login:
+                return  # window closed by user
+            self.args.update(default_name=login['name'], default_ip=login['ip'], default_port=login['port'])
+
+            chat_window = ChatWindow(args=login)
+            chat = chat_window.exec()  # Runs until user disconnects from the chat, or the server refuses the connection
+            self.args['refusal'] = chat.get('refusal')
+            if not self.args['refusal']:
+                break
+        self.client = chat_window.client
         try:
             chat_window.send_msg('/quit')
         except Exception:
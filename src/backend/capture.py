@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# capture.py
+# Recording of the traffic a server receives, and replaying it against another server.
+# The server records with: python server.py --capture traffic.cap
+# Replay with: python capture.py replay traffic.cap [--port 8000] [--speed 10 | --speed max]
+# Summarize with: python capture.py info traffic.cap
+#
+# A capture file starts with MAGIC, followed by records of a RECORD header and a payload:
+# JOIN - a connection completed the handshake, the payload is the member's name.
+# FRAME - a message received on a connection, the payload is the decrypted CPP message (datatype, datasize, data),
+#         so a replay can encrypt it again with the session key of the server it replays to.
+# LEAVE - the member closed its connection.
+
+import time
+import struct
+import asyncio
+import argparse
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_OAEP
+import cpp
+
+
+MAGIC = b"CPPCAP1\n"
+RECORD = struct.Struct(">dIBI")  # seconds since the capture started, connection id, event, payload size
+JOIN, FRAME, LEAVE = 0, 1, 2
+EVENT_NAMES = {JOIN: "join", FRAME: "frame", LEAVE: "leave"}
+
+
+class Capture:
+    """Appends the server's inbound traffic to a capture file.
+    Records are buffered, and written out by flush() once per iteration of the server loop.
+    Instance attributes:
+    ids - dict of the name of a connected member to the id of its connection.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.start = time.monotonic()
+        self.ids = {}
+        self.next_id = 1
+
+    def join(self, name):
+        self.ids[name] = self.next_id
+        self.next_id += 1
+        self.write(self.ids[name], JOIN, name.encode())
+
+    def frame(self, name, datatype, data):
+        if name in self.ids:
+            self.write(self.ids[name], FRAME, struct.pack(">BI", datatype, len(data)) + data)
+
+    def leave(self, name):
+        if name in self.ids:
+            self.write(self.ids.pop(name), LEAVE, b"")
+
+    def write(self, conn_id, event, payload):
+        self.file.write(RECORD.pack(time.monotonic() - self.start, conn_id, event, len(payload)))
+        self.file.write(payload)
+
+    def flush(self):
+        self.file.flush()
+
+
+def read(path):
+    """Yields the (time, connection id, event, payload) records of a capture file.
+    A record cut short (the server was killed while writing it) ends the capture.
+    """
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            at, conn_id, event, size = RECORD.unpack(header)
+            payload = file.read(size)
+            if len(payload) < size:
+                return
+            yield at, conn_id, event, payload
+
+
+class ReplayConnection:
+    """A connection replaying the frames of one captured connection, in order.
+    Frames are queued by the replay as their time comes, and sent once the handshake is done.
+    Anything the server sends is read and discarded.
+    Instance attributes:
+    refused - why the connection failed, if it did.
+    """
+
+    CLOSE_TIMEOUT = 10  # seconds to wait for the server to close a connection that left
+
+    def __init__(self, name, privkey):
+        self.name = name
+        self.privkey = privkey
+        self.queue = asyncio.Queue()
+        self.received = 0
+        self.refused = None
+
+    async def run(self, host, port):
+        try:
+            await self.replay(host, port)
+        except (OSError, asyncio.IncompleteReadError) as error:
+            self.refused = f"connection failed ({error!r})"
+
+    async def replay(self, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(cpp.encode(self.name) + cpp.encode(self.privkey.public_key().export_key().decode()))
+        datatype, datasize = struct.unpack(">BI", await reader.readexactly(5))
+        response = cpp.construct_cpp_msg(datatype, await reader.readexactly(datasize))
+        if type(response) is not bytes:
+            self.refused = response.msg if type(response) is cpp.ServerMsg else "invalid handshake"
+            writer.close()
+            return
+        aeskey = PKCS1_OAEP.new(self.privkey).decrypt(response)
+        discard = asyncio.ensure_future(self.discard(reader))
+        while True:
+            frame = await self.queue.get()
+            if frame is None:  # the member left
+                break
+            writer.write(cpp.encrypt(aeskey, frame))
+            await writer.drain()
+        # Closing with unread data would reset the connection and lose the frames the server has not read yet,
+        # so only stop sending, and wait for the server to close the connection once it has read everything:
+        writer.write_eof()
+        try:
+            await asyncio.wait_for(discard, self.CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        writer.close()
+
+    async def discard(self, reader):
+        while True:
+            data = await reader.read(64 * 1024)
+            if not data:
+                return
+            self.received += len(data)
+
+
+async def replay(path, host, port, speed):
+    """Replays a capture against the server at (host, port). speed is a time factor, or None for as fast as possible.
+    Returns (frames sent, connections, refusals).
+    """
+    privkey = RSA.generate(1024)  # the server only uses it to send the session key, so connections share it
+    connections = {}
+    tasks = []
+    frames = 0
+    start = time.monotonic()
+    for at, conn_id, event, payload in read(path):
+        if speed:
+            delay = start + at / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if event == JOIN:
+            connections[conn_id] = ReplayConnection(payload.decode(), privkey)
+            tasks.append(asyncio.ensure_future(connections[conn_id].run(host, port)))
+        elif event == FRAME and conn_id in connections:
+            connections[conn_id].queue.put_nowait(payload)
+            frames += 1
+        elif event == LEAVE and conn_id in connections:
+            connections[conn_id].queue.put_nowait(None)
+        if not speed:
+            await asyncio.sleep(0)  # let the connections send
+    for connection in connections.values():
+        connection.queue.put_nowait(None)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    refusals = [connection for connection in connections.values() if connection.refused]
+    return frames, len(connections), refusals
+
+
+def info(path):
+    """Prints a summary of a capture: its duration, connections and messages by datatype.
+    """
+    counts = {}
+    sizes = {}
+    connections = set()
+    duration = 0
+    for at, conn_id, event, payload in read(path):
+        duration = at
+        connections.add(conn_id)
+        name = cpp.datatype_name(payload[0]) if event == FRAME else EVENT_NAMES.get(event, str(event))
+        counts[name] = counts.get(name, 0) + 1
+        sizes[name] = sizes.get(name, 0) + len(payload)
+    print(f"{duration:.1f}s, {len(connections)} connections")
+    print(f"{'record':<20}{'count':>10}{'bytes':>14}")
+    for name, count in sorted(counts.items(), key=lambda item: -item[1]):
+        print(f"{name:<20}{count:>10}{sizes[name]:>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and replay traffic captured by the chat server.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    info_parser = subparsers.add_parser("info", help="summarize a capture")
+    info_parser.add_argument("capture")
+    replay_parser = subparsers.add_parser("replay", help="replay a capture against a (fresh) server")
+    replay_parser.add_argument("capture")
+    replay_parser.add_argument("--host", default="127.0.0.1")
+    replay_parser.add_argument("--port", type=int, default=8000)
+    replay_parser.add_argument("--speed", default="1", help="time factor (1, 10...) or 'max' (default 1)")
+    args = parser.parse_args()
+    if args.command == "info":
+        info(args.capture)
+        return
+    speed = None if args.speed == "max" else float(args.speed)
+    start = time.monotonic()
+    frames, connections, refusals = asyncio.run(replay(args.capture, args.host, args.port, speed))
+    print(f"Replayed {frames} messages of {connections} connections in {time.monotonic() - start:.2f}s")
+    for connection in refusals:
+        print(f"{connection.name} was refused: {connection.refused}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 import sys
+import html
 import socket
 import queue
 import struct
-from time import sleep
+import threading
+import itertools
+from collections import deque
+from time import sleep, perf_counter
 from time import gmtime, strftime, struct_time
 from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_OAEP
 from backend import cpp
 
 
@@ -21,6 +26,12 @@ class Client:
     name - client's name, will be displayed when sending messages.
     srv_soc - the socket connecting the client and the server.
     msg_que - queue of received messages waiting to be displayed.
+    sequences - dict of a room's name (None for the whole group) to the Sequence of its broadcasts received.
+    room - name of the room messages are sent in, None for the whole group.
+    joining - name of the room a join (or create) was sent for, messages are sent in it once the client is in it.
+    transport - the module (or object) sockets are created with: socket, or a simnet.SimulatedNetwork.
+    probes - dict of the id of a /ping probe waiting for its reply to when it was sent (perf_counter()).
+    round_trips - the most recent round trips to the server measured by /ping, in seconds.
     """
 
     COMMANDS = {"/help": cpp.DataType.CMD_HELP.value,
@@ -32,12 +43,29 @@ class Client:
                 "/promote": cpp.DataType.CMD_PROMOTE.value,
                 "/demote": cpp.DataType.CMD_DEMOTE.value,
                 "/mute": cpp.DataType.CMD_MUTE.value,
-                "/unmute": cpp.DataType.CMD_UNMUTE.value}
+                "/unmute": cpp.DataType.CMD_UNMUTE.value,
+                "/stats": cpp.DataType.CMD_STATS.value,
+                "/profile": cpp.DataType.CMD_PROFILE.value,
+                "/memory": cpp.DataType.CMD_MEMORY.value,
+                "/memsnap": cpp.DataType.CMD_MEMSNAP.value,
+                "/ping": cpp.DataType.CMD_PING.value,
+                "/rooms": cpp.DataType.CMD_ROOMS.value,
+                "/create": cpp.DataType.CMD_CREATE.value,
+                "/join": cpp.DataType.CMD_JOIN.value,
+                "/leave": cpp.DataType.CMD_LEAVE.value}
+    # commands that apply to the current room when sent in one:
+    ROOM_COMMANDS = [cpp.DataType.CMD_LIST.value, cpp.DataType.CMD_VIEW.value, cpp.DataType.CMD_KICK.value,
+                     cpp.DataType.CMD_PROMOTE.value, cpp.DataType.CMD_DEMOTE.value,
+                     cpp.DataType.CMD_MUTE.value, cpp.DataType.CMD_UNMUTE.value]
     BUFFER_SIZE = 1024  # how much data from a socket to read at a time.
+    MAX_MISSING = 1024  # how many skipped sequence numbers are tracked at most.
+    LATENCY_SAMPLES = 100  # how many of the latest round trips /ping summarizes.
+    LATENCY_BUCKETS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1]  # upper bounds (seconds) of the round trip histogram
 
-    def __init__(self, name):
+    def __init__(self, name, transport=socket):
         """params:
         name - client's name, will be displayed when sending messages.
+        transport - the module (or object) sockets are created with.
         """
         # Generate RSA private and public key:
         self.privkey = RSA.generate(1024)
@@ -45,30 +73,242 @@ class Client:
         self.aeskey = None  # used to encrypt session, will be sent by the server upon connection
 
         self.name = name
-        self.srv_soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.transport = transport
+        self.address = None  # (ip, port) of the server
+        self.srv_soc = self.transport.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.msg_que = queue.Queue()
+        self.send_lock = threading.Lock()  # the receiving thread may send replay requests
+
+        self.sequences = {}
+        self.room = None
+        self.joining = None
+        self.limits = dict(cpp.MAX_DATA_SIZES)  # largest [data] the server accepts per datatype, sent by the server
+        self.probes = {}
+        self.probe_ids = itertools.count()
+        self.round_trips = deque(maxlen=Client.LATENCY_SAMPLES)
 
     def connect(self, ip, port):
+        self.address = (ip, port)
         self.srv_soc.connect((ip, port))
         self.send(self.name)
         self.send(self.pubkey.export_key().decode())
 
+    def handshake(self, ip, port):
+        """Connects to the server and receives the session's AES key.
+        Returns None on success, otherwise the message explaining why the server refused the connection.
+        """
+        self.connect(ip, port)
+        return self.receive_key()
+
+    def receive_key(self):
+        """Receives the server's answer to the connection request: the session's AES key, or a refusal.
+        Returns None on success, otherwise the message explaining why the server refused the connection.
+        """
+        response = self.recv()
+        if response is None:
+            return "The server closed the connection."
+        if type(response) is cpp.ServerMsg:
+            return response.msg
+        self.aeskey = PKCS1_OAEP.new(self.privkey).decrypt(response)
+        return None
+
+    def reconnect(self, timeout=None):
+        """Reconnects to the server after the connection was lost, joins the rooms the client was in again,
+        and requests the broadcast messages that were missed in the meantime.
+        timeout - seconds the new socket's operations may block for, None to block until they complete.
+        Returns None on success, otherwise the message explaining why the server refused the connection.
+        """
+        self.srv_soc.close()
+        self.srv_soc = self.transport.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.srv_soc.settimeout(timeout)
+        for sequence in self.sequences.values():
+            sequence.resumed_from = None
+        refusal = self.handshake(*self.address)
+        if refusal is None:
+            self.rejoin()
+        return refusal
+
+    def rejoin(self):
+        """Joins the rooms of the known sequences again after connecting,
+        and requests the broadcast messages of the group and the rooms that were missed since the last ones received.
+        """
+        for room in list(self.sequences):
+            if room is not None:
+                self.ssend(cpp.Cmd(cpp.DataType.CMD_JOIN.value, room))
+            self.resume(room)
+
+    def resume(self, room=None):
+        """Requests the server to replay the broadcast messages of the group (or of a room)
+        newer than the last one received.
+        """
+        sequence = self.sequences.get(room)
+        if sequence is not None and sequence.resumed_from != sequence.last_seq:
+            sequence.resumed_from = sequence.last_seq
+            self.ssend(cpp.Resume(sequence.epoch, sequence.last_seq))
+
+    def in_room(self, cpp_msg):
+        """Returns cpp_msg wrapped to be sent in the current room, or as is if there is none.
+        """
+        return cpp_msg if self.room is None else cpp.InRoom(self.room, cpp_msg)
+
+    def join_room(self, room):
+        """Sends messages in room once the server confirms the client is in it (with a broadcast in the room),
+        or right away if it already is. To be called before the join (or create) command is sent.
+        """
+        if room in self.sequences:
+            self.room = room
+        else:
+            self.joining = room
+
+    def left_room(self, room):
+        """Forgets a room the client left, so it is not joined again on reconnection.
+        """
+        self.sequences.pop(room, None)
+        if self.room == room:
+            self.room = None
+        if self.joining == room:
+            self.joining = None
+
     def send(self, cpp_msg):
         """send a CPP message to the server.
         """
-        cpp.send(self.srv_soc, cpp_msg)
+        with self.send_lock:
+            cpp.send(self.srv_soc, cpp_msg)
 
     def ssend(self, cpp_msg):
         """send a CPPS message to the server.
         receives CPPS msg and encrpyts it
+        Raises ValueError if the message is larger than the server accepts (files should be sent as FilePart chunks).
         """
-        cpp.ssend(self.srv_soc, self.aeskey, cpp_msg)
+        self.ssend_encoded([self.encode(cpp_msg)])
+
+    def encode(self, cpp_msg):
+        """Returns a CPP message encoded, to be sent later with ssend_encoded.
+        Raises ValueError if the message is larger than the server accepts (files should be sent as FilePart chunks).
+        """
+        plaintext = cpp.encode(cpp_msg)
+        limit = self.limits.get(plaintext[0], cpp.DEFAULT_MAX_DATA_SIZE)
+        if len(plaintext) - 5 > limit:
+            raise ValueError(f"message of {len(plaintext) - 5} bytes exceeds the server's limit of {limit} bytes")
+        return plaintext
+
+    def ssend_encoded(self, plaintexts):
+        """Encrypts a list of encoded CPP messages and sends them to the server in one write.
+        """
+        with self.send_lock:
+            self.srv_soc.sendall(b"".join(cpp.encrypt(self.aeskey, plaintext) for plaintext in plaintexts))
 
     def recv(self):
         return cpp.recv(self.srv_soc)
 
     def srecv(self):
-        return cpp.srecv(self.srv_soc, self.aeskey)
+        """Returns the next message from the server.
+        Sequenced broadcasts are unwrapped, and ones that were already received are dropped.
+        Keepalive pings and the server's limits are handled here and not returned.
+        """
+        while True:
+            cpp_msg = cpp.srecv(self.srv_soc, self.aeskey)
+            if type(cpp_msg) is cpp.Ping:
+                self.ssend(cpp.Pong(cpp_msg.stamp))
+                continue
+            if type(cpp_msg) is cpp.Limits:
+                self.limits.update(cpp_msg.sizes)
+                continue
+            if type(cpp_msg) is cpp.PingReply:
+                result = self.ping_result(cpp_msg)
+                if result is not None:
+                    return result
+                continue
+            if type(cpp_msg) is not cpp.Sequenced:
+                return cpp_msg
+            room = cpp_msg.msg.room if type(cpp_msg.msg) is cpp.InRoom else None
+            if room is not None and room == self.joining:  # the server let the client in
+                self.room, self.joining = room, None
+            if self.accept_seq(cpp_msg.epoch, cpp_msg.seq, room):
+                return cpp_msg.msg
+
+    def ping(self):
+        """Returns a latency probe to send to the server right away.
+        srecv returns its result as a ServerMsg once the server answers.
+        """
+        probe = str(next(self.probe_ids))
+        self.probes[probe] = perf_counter()
+        return cpp.Cmd(cpp.DataType.CMD_PING.value, probe)
+
+    def ping_result(self, reply):
+        """Returns a ServerMsg describing the round trip of the probe a PingReply answers,
+        and how the last round trips were distributed. Returns None if the probe is unknown.
+        """
+        sent = self.probes.pop(reply.probe, None)
+        if sent is None:
+            return None
+        round_trip = perf_counter() - sent
+        self.round_trips.append(round_trip)
+        ms = lambda seconds: f"{seconds * 1000:.1f} ms"
+        breakdown = [f"Round trip: {ms(round_trip)}",
+                     f"Network and waiting for the server's tick: {ms(round_trip - (reply.sent - reply.received))}",
+                     f"Handling on the server: {ms(reply.handled - reply.received)}",
+                     f"Queued on the server: {ms(reply.sent - reply.handled)}"]
+        round_trips = sorted(self.round_trips)
+        at = lambda percent: round_trips[min(len(round_trips) - 1, int(percent / 100 * len(round_trips)))]
+        summary = [f"p50 {ms(at(50))}, p90 {ms(at(90))}, p99 {ms(at(99))}, max {ms(round_trips[-1])}"]
+        for label, count in self.latency_histogram():
+            summary.append(f"{label}: {'&#9608;' * round(count * 20 / len(round_trips))} {count}")
+        return cpp.ServerMsg(f'''
+            <p style='text-align:center'>
+                <u>Ping</u>
+                <p>{'<br />'.join(breakdown)}</p>
+                <u>Last {len(round_trips)} Round Trips</u>
+                <p>{'<br />'.join(summary)}</p>
+            </p>
+            ''')
+
+    def latency_histogram(self):
+        """Returns a list of (bucket label, number of round trips) of the recent round trips measured by /ping.
+        """
+        counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        for round_trip in self.round_trips:
+            counts[next((index for index, bound in enumerate(self.LATENCY_BUCKETS) if round_trip < bound),
+                        len(self.LATENCY_BUCKETS))] += 1
+        labels = [f"&lt; {bound * 1000:.0f} ms" for bound in self.LATENCY_BUCKETS]
+        labels.append(f"&ge; {self.LATENCY_BUCKETS[-1] * 1000:.0f} ms")
+        return list(zip(labels, counts))
+
+    def accept_seq(self, epoch, seq, room=None):
+        """Returns whether the broadcast with sequence number seq (of the group, or of a room) has not been received yet.
+        Skipped sequence numbers are remembered and their replay is requested from the server.
+        """
+        sequence = self.sequences.get(room)
+        if sequence is None or epoch != sequence.epoch:  # first message, or the server (or room) has restarted
+            self.sequences[room] = Sequence(epoch, seq)
+            return True
+        if seq <= sequence.last_seq:
+            if seq not in sequence.missing:
+                return False  # duplicate
+            sequence.missing.discard(seq)
+            return True
+        if seq > sequence.last_seq + 1:  # gap
+            sequence.missing.update(range(max(sequence.last_seq + 1, seq - self.MAX_MISSING), seq))
+            if len(sequence.missing) > self.MAX_MISSING:
+                sequence.missing = set(sorted(sequence.missing)[-self.MAX_MISSING:])
+            self.resume(room)
+        sequence.last_seq = seq
+        return True
+
+
+class Sequence:
+    """The broadcasts received from the group, or from one room.
+    Instance attributes:
+    epoch, last_seq - sequence number of the last broadcast received, and the server run (or room) it belongs to.
+    missing - sequence numbers older than last_seq that were skipped and may still be replayed.
+    resumed_from - sequence number of the last replay request.
+    """
+
+    def __init__(self, epoch, last_seq):
+        self.epoch = epoch
+        self.last_seq = last_seq
+        self.missing = set()
+        self.resumed_from = None
 
 
 
@@ -89,7 +329,7 @@ def main():
     client.connect(DEFAULT_IP, port)
     while True:
         msg = input("> ")
-        client.send(msg)
+        client.send(html.escape(msg, quote=False))  # sent as markup
         response = client.recv()
         print(f"{strftime('%H:%M',gmtime(response.timestamp))} {response.name}: {response.msg}")
         # print(response.msg)
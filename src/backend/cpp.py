@@ -2,6 +2,7 @@
 # Methods for receiving and sending message in CPP protocol
 # CPP specifications are at chat_program_protocol.txt
 
+import re
 import enum
 import socket
 import struct
@@ -17,6 +18,16 @@ class DataType(enum.Enum):
     FILE_PART = 3
     FILE_ATTACH_SEND = 4
     FILE_ATTACH_RECV = 5
+    SEQUENCED = 6  # broadcast message tagged with its group sequence number
+    RESUME = 7  # last sequence number seen by a reconnecting client
+    PING = 8  # keepalive probe, must be answered with PONG
+    PONG = 9
+    LIMITS = 10  # largest [data] the server accepts for each datatype
+    PING_REPLY = 11  # server's answer to CMD_PING, with the times it handled the probe
+    IN_ROOM = 12  # message or command sent in a room, or broadcast in it
+    FILE_ACK = 13  # bytes of an uploaded file the server has written
+    FILE_REQUEST = 14  # request to download a stored file
+    FILE_INFO = 15  # size and digest of a file being downloaded, sent before its FILE_PART chunks
     MASK_CMD = 128  # mask to filter command data types
 
     CMD_TELL = 128
@@ -27,12 +38,68 @@ class DataType(enum.Enum):
     CMD_DEMOTE = 162
     CMD_MUTE = 163
     CMD_UNMUTE = 164
+    CMD_PROFILE = 165  # profile the server for [name] seconds (manager only)
+    CMD_PING = 166  # latency probe, [name] is the client's probe id
+    CMD_JOIN = 167  # join the room [name]
+    CMD_LEAVE = 168  # leave the room [name]
+    CMD_CREATE = 169  # create the room [name] and join it as its manager
 
     MASK_CMD_NOARGS = 192  # mask to filter commands without arguments
     CMD_HELP = 192
     CMD_QUIT = 193
     CMD_VIEW = 194  # view managers
     CMD_LIST = 195  # list users
+    CMD_STATS = 196  # server statistics (manager only)
+    CMD_MEMORY = 197  # memory usage of the server (manager only)
+    CMD_MEMSNAP = 198  # tracemalloc snapshot, diffed against the previous one (manager only)
+    CMD_ROOMS = 199  # list rooms
+
+
+MAX_ROOM_NAME = 32  # longest room name, in bytes
+
+# Largest [data] accepted for each datatype, in bytes. Larger files must be sent as FILE_PART chunks.
+MAX_DATA_SIZES = {
+    DataType.MSG.value: 64 * 1024,
+    DataType.SERVERMSG.value: 1024 * 1024,
+    DataType.BYTES.value: 1024 * 1024,
+    DataType.FILE_PART.value: 32 + 256 * 1024,
+    DataType.FILE_ATTACH_SEND.value: 4 * 1024,
+    DataType.FILE_ATTACH_RECV.value: 4 * 1024,
+    DataType.IN_ROOM.value: 2 + MAX_ROOM_NAME + 5 + 64 * 1024,
+    DataType.SEQUENCED.value: 12 + 2 + MAX_ROOM_NAME + 5 + 5 + 1024 * 1024,
+}
+DEFAULT_MAX_DATA_SIZE = 64 * 1024  # commands and control messages
+MAX_FRAME_SIZE = 32 + 5 + max(MAX_DATA_SIZES.values())  # largest [datasize] of a CPPS message
+
+# A '<' that does not start one of the tags of the markup of a MSG (see chat_program_protocol.txt)
+NOT_MARKUP_TAG = re.compile(r'<(?!(?:/?[bius]|/a|/font)>|a href="[^"<>]*">|font color="#[0-9a-fA-F]{6}">)')
+
+
+class FrameError(ConnectionError):
+    """Raised when a peer sends a malformed message, or one larger than allowed.
+    The connection can't be trusted to stay in sync afterwards, so it should be closed.
+    """
+
+
+def max_data_size(datatype):
+    return MAX_DATA_SIZES.get(datatype, DEFAULT_MAX_DATA_SIZE)
+
+
+def valid_markup(msg):
+    """Returns whether the text of a MSG is in the chat's markup: text with '<', '>' and '&' escaped,
+    formatted by the tags <b> <i> <u> <s> <a href="..."> <font color="#rrggbb"> only.
+    It is checked by a single scan, so the server can check every message.
+    """
+    return NOT_MARKUP_TAG.search(msg) is None
+
+
+# names of the datatype values, skipping the masks that share their values with commands
+DATATYPE_NAMES = {datatype.value: name for name, datatype in DataType.__members__.items()
+                  if not name.startswith("MASK")}
+
+
+def datatype_name(datatype):
+    return DATATYPE_NAMES.get(datatype, str(datatype))
 
 
 def encode(cpp_msg):
@@ -46,6 +113,17 @@ def encode(cpp_msg):
     elif type(cpp_msg) is Cmd: datatype = cpp_msg.cmd
     elif type(cpp_msg) is FileAttachSend: datatype = DataType.FILE_ATTACH_SEND.value
     elif type(cpp_msg) is FileAttachRecv: datatype = DataType.FILE_ATTACH_RECV.value
+    elif type(cpp_msg) is Sequenced: datatype = DataType.SEQUENCED.value
+    elif type(cpp_msg) is Resume: datatype = DataType.RESUME.value
+    elif type(cpp_msg) is Ping: datatype = DataType.PING.value
+    elif type(cpp_msg) is Pong: datatype = DataType.PONG.value
+    elif type(cpp_msg) is FilePart: datatype = DataType.FILE_PART.value
+    elif type(cpp_msg) is Limits: datatype = DataType.LIMITS.value
+    elif type(cpp_msg) is PingReply: datatype = DataType.PING_REPLY.value
+    elif type(cpp_msg) is InRoom: datatype = DataType.IN_ROOM.value
+    elif type(cpp_msg) is FileAck: datatype = DataType.FILE_ACK.value
+    elif type(cpp_msg) is FileRequest: datatype = DataType.FILE_REQUEST.value
+    elif type(cpp_msg) is FileInfo: datatype = DataType.FILE_INFO.value
     elif cpp_msg is None: datatype = cpp_msg = Cmd(DataType.CMD_QUIT)  # Quit
     return struct.pack('>BI', datatype, datasize) + data
 
@@ -79,6 +157,28 @@ def construct_cpp_msg(datatype, data):
         return FileAttachSend.decode(data)
     elif datatype == DataType.FILE_ATTACH_RECV.value:
         return FileAttachRecv.decode(data)
+    elif datatype == DataType.FILE_PART.value:
+        return FilePart.decode(data)
+    elif datatype == DataType.LIMITS.value:
+        return Limits.decode(data)
+    elif datatype == DataType.SEQUENCED.value:
+        return Sequenced.decode(data)
+    elif datatype == DataType.RESUME.value:
+        return Resume.decode(data)
+    elif datatype == DataType.PING.value:
+        return Ping.decode(data)
+    elif datatype == DataType.PONG.value:
+        return Pong.decode(data)
+    elif datatype == DataType.PING_REPLY.value:
+        return PingReply.decode(data)
+    elif datatype == DataType.IN_ROOM.value:
+        return InRoom.decode(data)
+    elif datatype == DataType.FILE_ACK.value:
+        return FileAck.decode(data)
+    elif datatype == DataType.FILE_REQUEST.value:
+        return FileRequest.decode(data)
+    elif datatype == DataType.FILE_INFO.value:
+        return FileInfo.decode(data)
     else:
         return None  # invalid datatype
 
@@ -88,6 +188,8 @@ def _recv_raw(sock):
     if not raw_datasize_and_datatype:
         return None, None
     datatype, datasize = struct.unpack('>BI', raw_datasize_and_datatype)
+    if datasize > max_data_size(datatype):
+        raise FrameError(f"message of {datasize} bytes is too large for datatype {datatype}")
     data = _recvn(sock, datasize)
     return datatype, data
 
@@ -151,8 +253,8 @@ class ServerMsg:
     def decode(data):
         """Decodes the [data] part of a CPP msg of type SERVERMSG into a ServerMsg object.
         """
-        floatshort_size = struct.calcsize("fH")
-        timestamp, namesize = struct.unpack_from(">fH", data)
+        floatshort_size = struct.calcsize(">dH")
+        timestamp, namesize = struct.unpack_from(">dH", data)
         name = data[floatshort_size:floatshort_size + namesize].decode()
         msg = data[floatshort_size + namesize:].decode()
         return ServerMsg(msg, timestamp, name)
@@ -161,19 +263,22 @@ class ServerMsg:
         """Encodes the msg into a byte-array that is the [data] part of a CPP msg of type SERVERMSG.
         """
         namesize = len(self.name)
-        data = struct.pack('>fH', self.timestamp, namesize) + self.name.encode() + self.msg.encode()
+        data = struct.pack('>dH', self.timestamp, namesize) + self.name.encode() + self.msg.encode()
         return data
 
 class FileAttachSend:
-    def __init__(self, filename):
+    def __init__(self, filename, file_id):
+        """A file the client uploaded (as FILE_PART chunks with the UUID file_id), to be shared with the group.
+        """
         self.filename = filename
+        self.file_id = file_id
 
     @staticmethod
     def decode(data):
-        return FileAttachSend(data.decode())
+        return FileAttachSend(bytes(data[16:]).decode(), UUID(bytes=bytes(data[:16])))
 
     def get_data(self):
-        return self.filename.encode()
+        return self.file_id.bytes + self.filename.encode()
 
 class FileAttachRecv:
     def __init__(self, filename, name, uuid):
@@ -183,11 +288,8 @@ class FileAttachRecv:
 
     @staticmethod
     def decode(data):
-        print(f"decode: data={data}")
-
         short_size = struct.calcsize("H")
         namesize, = struct.unpack_from(">H", data)
-        print(namesize)
         name = data[short_size : short_size+namesize].decode()
         uuid = UUID(bytes=data[short_size+namesize : short_size+namesize+16])
         filename = data[short_size+namesize+16:].decode()
@@ -195,35 +297,203 @@ class FileAttachRecv:
 
     def get_data(self):
         namesize = len(self.name)
-        data = struct.pack('>H', namesize) + self.name.encode() + self.uuid.bytes + self.filename.encode()
-        print(f"data={data}")
-        return data
+        return struct.pack('>H', namesize) + self.name.encode() + self.uuid.bytes + self.filename.encode()
 
-class FilePart:
-    def __init__(self, msg, timestamp=None, name=""):
-        """data is the byte array to be parse.
+class Sequenced:
+    def __init__(self, epoch, seq, msg):
+        """epoch identifies the group's lifetime (it changes when the server restarts),
+        seq is the group's sequence number of the broadcast and msg is the wrapped CPP message.
         """
+        self.epoch = epoch
+        self.seq = seq
         self.msg = msg
-        self.timestamp = timestamp if timestamp else time()
-        self.name = name
 
     @staticmethod
     def decode(data):
-        """Decodes the [data] part of a CPP msg of type SERVERMSG into a ServerMsg object.
+        """Decodes the [data] part of a CPP msg of type SEQUENCED into a Sequenced object.
         """
-        floatshort_size = struct.calcsize("fH")
-        timestamp, namesize = struct.unpack_from(">fH", data)
-        name = data[floatshort_size:floatshort_size + namesize].decode()
-        msg = data[floatshort_size + namesize:].decode()
-        return ServerMsg(msg, timestamp, name)
+        header_size = struct.calcsize(">IQBI")
+        epoch, seq, datatype, _ = struct.unpack_from(">IQBI", data)
+        return Sequenced(epoch, seq, construct_cpp_msg(datatype, data[header_size:]))
 
     def get_data(self):
-        """Encodes the msg into a byte-array that is the [data] part of a CPP msg of type SERVERMSG.
+        """Encodes the msg into a byte-array that is the [data] part of a CPP msg of type SEQUENCED.
         """
-        namesize = len(self.name)
-        data = struct.pack('>fH', self.timestamp, namesize) + self.name.encode() + self.msg.encode()
-        return data
+        return struct.pack('>IQ', self.epoch, self.seq) + encode(self.msg)
 
+class InRoom:
+    def __init__(self, room, msg):
+        """room is the name of the room msg (the wrapped CPP message) is sent in.
+        """
+        self.room = room
+        self.msg = msg
+
+    @staticmethod
+    def decode(data):
+        """Decodes the [data] part of a CPP msg of type IN_ROOM into an InRoom object.
+        """
+        namesize = struct.unpack_from(">H", data)[0]
+        room = bytes(data[2:2 + namesize]).decode()
+        datatype, _ = struct.unpack_from(">BI", data, 2 + namesize)
+        return InRoom(room, construct_cpp_msg(datatype, data[2 + namesize + 5:]))
+
+    def get_data(self):
+        """Encodes the msg into a byte-array that is the [data] part of a CPP msg of type IN_ROOM.
+        """
+        room = self.room.encode()
+        return struct.pack('>H', len(room)) + room + encode(self.msg)
+
+class Resume:
+    def __init__(self, epoch, seq):
+        """seq is the last sequence number the client has seen in the group's epoch.
+        """
+        self.epoch = epoch
+        self.seq = seq
+
+    @staticmethod
+    def decode(data):
+        epoch, seq = struct.unpack_from(">IQ", data)
+        return Resume(epoch, seq)
+
+    def get_data(self):
+        return struct.pack('>IQ', self.epoch, self.seq)
+
+class Ping:
+    def __init__(self, stamp=None):
+        """stamp is the sender's time, echoed back in the Pong.
+        """
+        self.stamp = stamp if stamp is not None else time()
+
+    @staticmethod
+    def decode(data):
+        return Ping(struct.unpack_from(">d", data)[0])
+
+    def get_data(self):
+        return struct.pack('>d', self.stamp)
+
+class Pong:
+    def __init__(self, stamp):
+        """stamp is copied from the Ping being answered.
+        """
+        self.stamp = stamp
+
+    @staticmethod
+    def decode(data):
+        return Pong(struct.unpack_from(">d", data)[0])
+
+    def get_data(self):
+        return struct.pack('>d', self.stamp)
+
+class PingReply:
+    def __init__(self, probe, received, handled, sent):
+        """The server's times (as returned by time.time()) for the CMD_PING with the id probe:
+        - received is when it read the probe from the connection,
+        - handled is when it queued the reply,
+        - sent is when the reply left the queue to be written.
+        """
+        self.probe = probe
+        self.received = received
+        self.handled = handled
+        self.sent = sent
+
+    @staticmethod
+    def decode(data):
+        received, handled, sent = struct.unpack_from(">ddd", data)
+        return PingReply(data[24:].decode(), received, handled, sent)
+
+    def get_data(self):
+        return struct.pack('>ddd', self.received, self.handled, self.sent) + self.probe.encode()
+
+class Limits:
+    def __init__(self, sizes):
+        """sizes is a dict of datatype value to the largest [data] accepted for it.
+        """
+        self.sizes = sizes
+
+    @staticmethod
+    def decode(data):
+        return Limits(dict(struct.iter_unpack(">BI", data)))
+
+    def get_data(self):
+        return b"".join(struct.pack('>BI', datatype, size) for datatype, size in self.sizes.items())
+
+class FilePart:
+    def __init__(self, file_id, offset, total, data):
+        """A chunk of a file being transferred.
+        - file_id is the UUID of the file,
+        - offset is the position of data in the file,
+        - total is the size of the whole file.
+        """
+        self.file_id = file_id
+        self.offset = offset
+        self.total = total
+        self.data = data
+
+    @staticmethod
+    def decode(data):
+        """Decodes the [data] part of a CPP msg of type FILE_PART into a FilePart object.
+        """
+        offset, total = struct.unpack_from(">QQ", data, 16)
+        return FilePart(UUID(bytes=bytes(data[:16])), offset, total, data[32:])
+
+    def get_data(self):
+        """Encodes the msg into a byte-array that is the [data] part of a CPP msg of type FILE_PART.
+        """
+        return self.file_id.bytes + struct.pack('>QQ', self.offset, self.total) + self.data
+
+class FileAck:
+    def __init__(self, file_id, received):
+        """The server's answer to a FilePart: received is how many bytes of the file it has written, from its start.
+        """
+        self.file_id = file_id
+        self.received = received
+
+    @staticmethod
+    def decode(data):
+        """Decodes the [data] part of a CPP msg of type FILE_ACK into a FileAck object.
+        """
+        received, = struct.unpack_from(">Q", data, 16)
+        return FileAck(UUID(bytes=bytes(data[:16])), received)
+
+    def get_data(self):
+        """Encodes the msg into a byte-array that is the [data] part of a CPP msg of type FILE_ACK.
+        """
+        return self.file_id.bytes + struct.pack('>Q', self.received)
+
+class FileRequest:
+    def __init__(self, file_id):
+        """A request to download the file with the UUID file_id.
+        """
+        self.file_id = file_id
+
+    @staticmethod
+    def decode(data):
+        return FileRequest(UUID(bytes=bytes(data[:16])))
+
+    def get_data(self):
+        return self.file_id.bytes
+
+class FileInfo:
+    def __init__(self, file_id, size, digest):
+        """The server's answer to a FileRequest, before the file's chunks.
+        - size is the size of the file,
+        - digest is its SHA-256 digest (32 bytes), or empty if the server does not have the file.
+        """
+        self.file_id = file_id
+        self.size = size
+        self.digest = digest
+
+    @staticmethod
+    def decode(data):
+        """Decodes the [data] part of a CPP msg of type FILE_INFO into a FileInfo object.
+        """
+        size, = struct.unpack_from(">Q", data, 16)
+        return FileInfo(UUID(bytes=bytes(data[:16])), size, bytes(data[24:]))
+
+    def get_data(self):
+        """Encodes the msg into a byte-array that is the [data] part of a CPP msg of type FILE_INFO.
+        """
+        return self.file_id.bytes + struct.pack('>Q', self.size) + self.digest
 
 # CPPS - Chat Program Protocol Secure
 # Methods for receiving and sending message in CPPS protocol
@@ -232,18 +502,25 @@ class FilePart:
 def ssend(sock, aeskey, cpp_msg):
     """encodes a string or a Cmd object cpp_msg into raw data, encrypts it and sends it through sock
     """
-    plaintext = encode(cpp_msg)
-    # print(f"1st BYTE: {plaintext[0]}")
-    # print(f"type: {type(cpp_msg)}")
+    sock.sendall(seal(aeskey, cpp_msg))
+
+
+def seal(aeskey, cpp_msg):
+    """encodes cpp_msg into raw data, encrypts it and returns the resulting CPPS message
+    """
+    return encrypt(aeskey, encode(cpp_msg))
+
+
+def encrypt(aeskey, plaintext):
+    """encrypts an encoded CPP message and returns the resulting CPPS message
+    """
     cipher = AES.new(aeskey, AES.MODE_EAX, mac_len=16)
     nonce = cipher.nonce
     ciphertext, tag = cipher.encrypt_and_digest(plaintext)
-    # print(f"SENT: message: \"{plaintext}\"\n      nonce: {nonce}\n      tag:{tag}\n      ciphertext:{ciphertext}\n")
     # both 'nonce' and 'tag' are bytearrays of length 16
     datasize = len(nonce) + len(tag) + len(ciphertext)
-    # print(f"DATASIZE: {datasize}")
     raw_datasize = struct.pack(">I", datasize)
-    sock.send(raw_datasize + nonce + tag + ciphertext)
+    return raw_datasize + nonce + tag + ciphertext
 
 
 def srecv(sock, aeskey):
@@ -253,13 +530,26 @@ def srecv(sock, aeskey):
         nonce, tag, ciphertext = s_recv_raw(sock)
         if not (nonce and tag and ciphertext):
             return None
-        cipher_aes = AES.new(aeskey, AES.MODE_EAX, nonce)
-        cpp_data = cipher_aes.decrypt_and_verify(ciphertext, tag)
-        data = cpp_data[5:]
-        datatype, _ = struct.unpack('>BI', cpp_data[:5])
+        datatype, data = sdecrypt(aeskey, nonce, tag, ciphertext)
         return construct_cpp_msg(datatype, data)
     except BlockingIOError:
         return None
+    except FrameError:  # the connection is out of sync
+        return None
+
+def sdecrypt(aeskey, nonce, tag, ciphertext):
+    """Decrypts the parts of a CPPS message and returns the datatype and data of the CPP message inside it
+    Raises FrameError if the message was tampered with or its data is larger than allowed for its datatype.
+    """
+    cipher_aes = AES.new(aeskey, AES.MODE_EAX, nonce)
+    try:
+        cpp_data = cipher_aes.decrypt_and_verify(ciphertext, tag)
+    except ValueError:  # wrong tag
+        raise FrameError("message failed authentication")
+    datatype, datasize = struct.unpack('>BI', cpp_data[:5])
+    if datasize > max_data_size(datatype):
+        raise FrameError(f"message of {datasize} bytes is too large for datatype {datatype}")
+    return datatype, cpp_data[5:]
 
 def s_recv_raw(sock):
     raw_datasize = s_recvn(sock, 4)
@@ -268,7 +558,8 @@ def s_recv_raw(sock):
     if not (raw_datasize and nonce and tag):
         return None, None, None
     datasize = struct.unpack('>I', raw_datasize)[0]
-    # print(f"DATASIZE: {datasize}")
+    if not 32 < datasize <= MAX_FRAME_SIZE:
+        raise FrameError(f"invalid message size {datasize}")
     data = bytes(s_recvn(sock, datasize-32))
     return nonce, tag, data
 
@@ -282,3 +573,52 @@ def s_recvn(sock, n):
             return None
         data.extend(packet)
     return data
+
+
+class FrameReader:
+    """Reads CPPS messages from a non-blocking socket piece by piece, as their bytes arrive.
+    The size of a message is checked against max_size as soon as its header arrives, so a peer can't make
+    the reader hold more than max_size bytes; and its buffer grows as its bytes arrive, by up to CHUNK bytes or
+    its size so far, so a size header that lies about what follows holds at most CHUNK bytes, or twice the bytes
+    that did follow, whichever is more.
+    Instance attributes:
+    buffer - the size header while it is being read, then the part of the message received so far (and room for more).
+    size - bytes of the header, then of the message.
+    received - bytes of buffer filled so far.
+    in_header - whether buffer is the size header.
+    """
+
+    CHUNK = 64 * 1024
+
+    def __init__(self, max_size=MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self.buffer = bytearray(4)
+        self.size = 4
+        self.received = 0
+        self.in_header = True
+
+    def read(self, sock):
+        """Returns (nonce, tag, ciphertext) of the next message once it has fully arrived, otherwise None.
+        Raises FrameError if the message is larger than max_size, and ConnectionResetError if the peer closed the connection.
+        """
+        while True:
+            if self.received == len(self.buffer):
+                self.buffer.extend(bytes(min(max(len(self.buffer), self.CHUNK), self.size - self.received)))
+            try:
+                received = sock.recv_into(memoryview(self.buffer)[self.received:])
+            except BlockingIOError:
+                return None
+            if not received:
+                raise ConnectionResetError("connection closed by peer")
+            self.received += received
+            if self.received < self.size:
+                continue
+            if self.in_header:
+                datasize = struct.unpack('>I', self.buffer)[0]
+                if not 32 < datasize <= self.max_size:
+                    raise FrameError(f"invalid message size {datasize}")
+                self.buffer, self.size, self.received, self.in_header = bytearray(), datasize, 0, False
+            else:
+                message = memoryview(self.buffer)
+                self.buffer, self.size, self.received, self.in_header = bytearray(4), 4, 0, True
+                return bytes(message[:16]), bytes(message[16:32]), message[32:]
@@ -1,44 +1,116 @@
+from collections import deque
+from itertools import islice
+from random import getrandbits
+from time import monotonic
+from outbox import Outbox
+from cpp import FrameReader
+
+
 class Group:
     """Represents a chat group.
     This structure is a collection of Member types and supports various standard collection methods.
+    Every broadcast to the group is assigned a monotonic sequence number, and the most recent ones
+    are kept in a bounded replay ring so reconnecting members can receive what they missed.
     """
 
+    REPLAY_SIZE = 1024  # how many broadcast messages are kept for replay
+
     def __init__(self):
-        self.members = []
+        self.members = {}  # name -> Member, in the order they joined
+        self.epoch = getrandbits(32)  # distinguishes sequence numbers of different server runs
+        self.seq = 0  # sequence number of the last broadcast message
+        self.history = deque(maxlen=self.REPLAY_SIZE)  # (seq, cpp_msg) pairs, oldest first
+        self.history_sizes = deque(maxlen=self.REPLAY_SIZE)  # bytes of the messages in history, as broadcast
+        self.history_size = 0  # their total, kept as messages are recorded so it is read without encoding them again
 
     def add(self, *args):
-        self.members.append(Member(*args))
+        member = Member(*args)
+        self.members[member.name] = member
 
-    def kick(self, key):
+    def kick(self, key, close=True):
+        """Removes a member from the group, closing its connection unless close is False.
+        """
         if type(key) == Member:
             member = key
         elif type(key) == str:
             member = self[key]
         else:
             raise TypeError
-        member.conn.close()
-        self.members.remove(member)
+        if close:
+            member.conn.close()
+        if self.members.get(member.name) is member:
+            del self.members[member.name]
+
+    def record(self, cpp_msg, size):
+        """Assigns the next sequence number to a broadcast message and keeps it for replay.
+        size is the bytes of the message as it was encoded for the broadcast.
+        Returns the assigned sequence number.
+        """
+        self.seq += 1
+        if len(self.history_sizes) == self.history_sizes.maxlen:
+            self.history_size -= self.history_sizes[0]  # forgotten as the new message is appended
+        self.history.append((self.seq, cpp_msg))
+        self.history_sizes.append(size)
+        self.history_size += size
+        return self.seq
+
+    def replay(self, seq):
+        """Returns the kept (seq, cpp_msg) pairs that are newer than seq, oldest first.
+        """
+        if not self.history or seq >= self.seq:
+            return []
+        oldest = self.history[0][0]
+        return list(islice(self.history, max(seq + 1 - oldest, 0), None))
 
     def __iter__(self):
-        yield from self.members
+        yield from list(self.members.values())  # members may be removed while iterating
 
     def __getitem__(self, key):
-        for member in self.members:
-            if member.name == key:
-                return member
-        raise KeyError(key)
+        return self.members[key]
 
     def __len__(self):
         return len(self.members)
 
     def __contains__(self, key):
         if type(key) == Member:
-            return key in self.members
-        try:
-            self[key]
-            return True
-        except KeyError:
-            return False
+            return self.members.get(key.name) is key
+        return key in self.members
+
+
+class Room(Group):
+    """Represents a chat room: a group of some of the server's members, with its own managers, mutes
+    and broadcast sequence. Members join rooms they are already connected to the server with.
+    Instance attributes:
+    name - the room's name.
+    managers - names of the room's managers (the server's managers manage every room).
+    muted - names of the members muted in the room.
+    """
+
+    REPLAY_SIZE = 256  # rooms keep a shorter history, as a server hosts many of them
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.managers = set()
+        self.muted = set()
+
+    def join(self, member):
+        self.members[member.name] = member
+        member.rooms.add(self.name)
+
+    def leave(self, member):
+        """Removes a member from the room. Its mute is kept, so leaving and joining again does not lift it.
+        """
+        if self.members.get(member.name) is member:
+            del self.members[member.name]
+        member.rooms.discard(self.name)
+        self.managers.discard(member.name)
+
+    def is_manager(self, member):
+        return member.is_manager or member.name in self.managers
+
+    def is_muted(self, member):
+        return member.is_muted or member.name in self.muted
 
 
 class Member(object):
@@ -53,6 +125,13 @@ class Member(object):
         self.color = color
         self.is_manager = is_manager
         self.is_muted = is_muted
+        self.last_activity = monotonic()  # when data was last received from the member
+        self.buckets = {}  # name of a rate limit -> TokenBucket, set by the server
+        self.throttle_notice_time = float("-inf")  # when the member was last told it is throttled
+        self.outbox = Outbox()  # frames waiting to be sent to the member
+        self.reader = FrameReader()  # the frame being received from the member
+        self.rooms = set()  # names of the rooms the member joined
+        self.uploads = {}  # UUID of a file the member is uploading -> (bytes written, size of the file, their sha256)
         self.conn.setblocking(False)
 
     def __str__(self):
@@ -0,0 +1,216 @@
+# metrics.py
+# Counters, gauges and histograms describing what the server is doing,
+# rendered in the Prometheus text format.
+
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Counter:
+    """A value that only goes up (messages, bytes...).
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """A value that goes up and down (members, queued frames...).
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """HDR-style histogram: every power of two is split into SUB_BUCKETS equal buckets,
+    so any recorded value is known to within 1/SUB_BUCKETS of itself, from microseconds to hours,
+    and recording costs a frexp and a dict update.
+    Instance attributes:
+    counts - dict of bucket index to the number of values recorded in it.
+    count, sum, max - of all recorded values.
+    """
+
+    SUB_BUCKETS = 16
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, value):
+        if value > 0:
+            mantissa, exponent = math.frexp(value)  # value = mantissa * 2**exponent, 0.5 <= mantissa < 1
+            index = exponent * self.SUB_BUCKETS + int((mantissa - 0.5) * 2 * self.SUB_BUCKETS)
+        else:
+            index = None
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Adds the values recorded by another histogram (e.g. of another process) to this one.
+        """
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    @classmethod
+    def upper_bound(cls, index):
+        """Returns the largest value that falls in the bucket index.
+        """
+        if index is None:
+            return 0
+        exponent, sub = divmod(index, cls.SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub + 1) / (2 * cls.SUB_BUCKETS), exponent)
+
+    def buckets(self):
+        """Returns a list of (upper bound, cumulative count) of the non-empty buckets, in increasing order.
+        """
+        counts = dict(self.counts)  # copied at once, the server thread may be recording
+        cumulative = 0
+        result = []
+        for index in sorted(counts, key=lambda index: -math.inf if index is None else index):
+            cumulative += counts[index]
+            result.append((self.upper_bound(index), cumulative))
+        return result
+
+    def percentile(self, percent):
+        """Returns an upper bound of the given percentile of the recorded values (0 if there are none).
+        """
+        buckets = self.buckets()
+        if not buckets:
+            return 0
+        rank = percent / 100 * buckets[-1][1]
+        for bound, cumulative in buckets:
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Registry:
+    """A collection of named metrics.
+    Each metric is identified by its name and labels. Metrics are created on first use,
+    and callers on hot paths should keep the returned object rather than look it up every time.
+    Instance attributes:
+    metrics - dict of (name, labels) to the metric, labels being a sorted tuple of (label, value) pairs.
+    kinds - dict of name to (kind, help text), of the metrics and of the gauges of collectors.
+    collectors - functions called on render, returning (name, labels, value) gauges computed on demand.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.kinds = {}
+        self.collectors = []
+
+    def counter(self, name, help="", **labels):
+        return self.get(Counter, "counter", name, help, labels)
+
+    def gauge(self, name, help="", **labels):
+        return self.get(Gauge, "gauge", name, help, labels)
+
+    def histogram(self, name, help="", **labels):
+        return self.get(Histogram, "histogram", name, help, labels)
+
+    def get(self, cls, kind, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            self.kinds.setdefault(name, (kind, help))
+            metric = self.metrics[key] = cls()
+        return metric
+
+    def collect(self, collector, helps):
+        """Registers a function that returns a list of (name, labels dict, value) gauges when called.
+        helps is a dict of the name of every gauge it returns to the gauge's help text.
+        Label values should come from a small fixed set: each one is a time series of its own.
+        """
+        for name, help in helps.items():
+            self.kinds.setdefault(name, ("gauge", help))
+        self.collectors.append(collector)
+
+    def render(self):
+        """Returns all the metrics in the Prometheus text exposition format.
+        """
+        families = {}
+        for (name, labels), metric in list(self.metrics.items()):
+            families.setdefault(name, []).append((labels, metric))
+        lines = []
+        for name, samples in sorted(families.items()):
+            kind, help = self.kinds[name]
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in samples:
+                if kind == "histogram":
+                    for bound, cumulative in metric.buckets():
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {metric.count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {metric.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {metric.count}")
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {metric.value}")
+        gauges = {}
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                gauges.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+        for name, samples in gauges.items():
+            kind, help = self.kinds.get(name, ("gauge", ""))
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{label}="{escape(str(value))}"' for label, value in labels)
+    return "{" + pairs + "}"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def serve(registry, port, ip="127.0.0.1"):
+    """Serves the registry's metrics over HTTP (GET /metrics) from a background thread.
+    Returns the HTTP server.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ["/", "/metrics"]:
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes are not worth a line each
+
+    httpd = ThreadingHTTPServer((ip, port), MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,146 @@
+# outbox.py
+# Outbound queue of a member's connection, with priority lanes drained by a weighted scheduler.
+
+import enum
+from collections import deque
+
+
+class Lane(enum.IntEnum):
+    CONTROL = 0  # unsequenced server notices, private messages, keepalives
+    CHAT = 1  # broadcasts: chat messages, file announcements and notices, in the order they were sequenced
+    BULK = 2  # file transfers
+
+
+class Outbox:
+    """Frames waiting to be written to a member's socket.
+    Frames are queued in lanes. Bulk transfers may be queued as iterators that produce their frames lazily,
+    so a large file is read from disk only as fast as the socket drains. The iterators of a lane take turns,
+    a frame each, so several files are sent at once rather than one after the other.
+    Lanes are drained with deficit round robin: every turn a lane may write QUANTA[lane] more bytes,
+    so control and chat frames overtake a running file transfer after at most one of its chunks.
+    Instance attributes:
+    lanes - a deque of frames (bytes) or frame iterators per lane.
+    deficits - bytes each lane may still write in its current turn.
+    turn - the lane whose turn it is.
+    current - memoryview of the unsent rest of the frame being written.
+    sizes - bytes of the frames queued in each lane (not counting the files of iterators), and of the rest of current
+    (under None), kept as frames are queued and written so they are read without walking the lanes.
+    watched - dict of id(frame) to (frame, callback) for frames whose callback is called once they are written.
+    closing - once set, no more frames are accepted and the connection is closed when the outbox drains.
+    """
+
+    QUANTA = {Lane.CONTROL: 64 * 1024, Lane.CHAT: 32 * 1024, Lane.BULK: 16 * 1024}
+
+    def __init__(self):
+        self.lanes = {lane: deque() for lane in Lane}
+        self.deficits = {lane: 0 for lane in Lane}
+        self.turn = Lane.CONTROL
+        self.current = None
+        self.current_frame = None
+        self.sizes = {lane: 0 for lane in [*Lane, None]}
+        self.watched = {}
+        self.closing = False
+
+    def put(self, lane, frame, on_sent=None):
+        """Queues a frame (bytes), or an iterator of frames, in a lane.
+        on_sent is called with no arguments once the frame has been written to the socket.
+        """
+        if not self.closing:
+            self.lanes[lane].append(frame)
+            if type(frame) is bytes:
+                self.sizes[lane] += len(frame)
+            if on_sent is not None:
+                self.watched[id(frame)] = (frame, on_sent)
+
+    def close(self):
+        """Stops accepting frames and drops queued bulk transfers, so only the pending messages are sent.
+        """
+        self.closing = True
+        self.lanes[Lane.BULK].clear()
+        self.sizes[Lane.BULK] = 0
+
+    def pop(self):
+        """Removes and returns the next frame to write, or None if the outbox is empty.
+        """
+        if not any(self.lanes.values()):
+            return None
+        while True:
+            lane = self.turn
+            frame = self.head(lane)
+            if frame is None:
+                self.deficits[lane] = 0
+            elif self.deficits[lane] >= len(frame):
+                self.deficits[lane] -= len(frame)
+                self.lanes[lane].popleft()
+                self.sizes[lane] -= len(frame)
+                return frame
+            self.turn = Lane((lane + 1) % len(Lane))
+            self.deficits[self.turn] += self.QUANTA[self.turn]
+            if not any(self.lanes.values()):  # the last iterators turned out to be exhausted
+                return None
+
+    def head(self, lane):
+        """Returns the first frame of a lane without removing it, or None if the lane is empty.
+        An iterator that produced the frame goes to the back of the lane.
+        """
+        queue = self.lanes[lane]
+        while queue:
+            if type(queue[0]) is bytes:
+                return queue[0]
+            frame = next(queue[0], None)
+            iterator = queue.popleft()
+            if frame is not None:
+                queue.append(iterator)
+                queue.appendleft(frame)
+                self.sizes[lane] += len(frame)
+        return None
+
+    def flush(self, sock, budget=None):
+        """Writes queued frames to the non-blocking sock until it would block, the outbox is empty,
+        or about budget bytes were written (if given).
+        Returns the number of bytes written. Raises socket.error if the connection is broken.
+        """
+        written = 0
+        while budget is None or written < budget:
+            if self.current is None:
+                frame = self.pop()
+                if frame is None:
+                    return written
+                self.current = memoryview(frame)
+                self.current_frame = frame
+                self.sizes[None] = len(frame)
+            try:
+                sent = sock.send(self.current)
+            except BlockingIOError:
+                return written
+            written += sent
+            self.current = self.current[sent:]
+            self.sizes[None] -= sent
+            if not self.current:
+                self.current = None
+                if self.watched:
+                    self.sent(self.current_frame)
+                self.current_frame = None
+        return written
+
+    def sent(self, frame):
+        watched_frame, on_sent = self.watched.pop(id(frame), (None, None))
+        if watched_frame is frame:
+            on_sent()
+
+    def size(self, lanes=None):
+        """Returns the bytes held by the frames queued in the given lanes,
+        or in all of them and the frame being written if lanes is None.
+        Bulk transfers hold only the chunk they have produced, the rest of their file is still on disk.
+        """
+        if lanes is None:
+            lanes = [*Lane, None]
+        return sum(self.sizes[lane] for lane in lanes)
+
+    def __len__(self):
+        """Returns the number of queued frames (a bulk transfer counts as one) including the one being written.
+        """
+        return sum(len(queue) for queue in self.lanes.values()) + (self.current is not None)
+
+    def __bool__(self):
+        return self.current is not None or any(self.lanes.values())
@@ -0,0 +1,71 @@
+# profiler.py
+# On-demand profiling of the running server, without restarting or pausing it.
+
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class ProfileSession:
+    """Profiles a thread (the server loop) for a while, in two ways at once:
+    - a background thread samples the thread's stack every INTERVAL seconds, and the samples are written
+      in collapsed-stack format ('outer;inner;leaf count' lines), ready for flamegraph.pl or speedscope,
+    - cProfile records every call the thread makes, and its stats are dumped for pstats / snakeviz.
+    start() and stop() must be called from the profiled thread.
+    Instance attributes:
+    path - files are written to path + '.collapsed' and path + '.prof'.
+    samples - Counter of collapsed stacks to the number of times they were sampled.
+    sampler - the thread sampling the stack.
+    """
+
+    INTERVAL = 0.005  # seconds between stack samples
+
+    def __init__(self, directory="./profiles"):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, time.strftime("profile-%Y%m%d-%H%M%S"))
+        self.samples = Counter()
+        self.thread_id = None
+        self.profile = cProfile.Profile()
+        self.running = False
+        self.sampler = None
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        """Stops profiling and writes the results. Returns the paths of the written files.
+        """
+        self.profile.disable()
+        self.running = False
+        self.sampler.join()  # it may be adding a sample
+        self.profile.dump_stats(self.path + ".prof")
+        with open(self.path + ".collapsed", "w") as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+        return [self.path + ".collapsed", self.path + ".prof"]
+
+    def sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[collapse(frame)] += 1
+            del frame
+            time.sleep(self.INTERVAL)
+
+
+def collapse(frame):
+    """Returns the stack ending at frame as a single 'outer;inner;leaf' line.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
@@ -0,0 +1,41 @@
+# ratelimit.py
+# Token buckets, used by the server to limit how much traffic each member may send.
+
+from time import monotonic
+
+
+class TokenBucket:
+    """Allows an average of rate units per second, with bursts of up to burst units.
+    A single request larger than burst is allowed when the bucket is full, and leaves it in debt,
+    so large files are delayed rather than rejected forever.
+    Instance attributes:
+    rate, burst - the bucket's limits.
+    tokens - units that may currently be spent (negative while in debt).
+    stamp - time (monotonic) at which tokens was last refilled.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = monotonic()
+
+    def allows(self, amount=1, now=None):
+        """Returns whether amount tokens are available, without spending them.
+        """
+        if now is None:
+            now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens >= min(amount, self.burst)
+
+    def consume(self, amount=1, now=None):
+        """Spends amount tokens if they are available.
+        Returns whether the request is within the limits.
+        """
+        if not self.allows(amount, now):
+            return False
+        self.tokens -= amount
+        return True
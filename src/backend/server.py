@@ -1,14 +1,29 @@
 #!/usr/bin/env python
 
 import sys
+import argparse
 import socket
 import threading
 import time
 import queue
-from uuid import uuid4, UUID
-from random import choice
+import signal
+import tracemalloc
+import html
+import heapq
+import re
+import struct
+import hashlib
+from uuid import UUID
+from random import choice, getrandbits
 import cpp
-from group import Group, Member  # implemented in group.py
+from group import Group, Room, Member  # implemented in group.py
+from timerwheel import TimerWheel
+from ratelimit import TokenBucket
+from outbox import Lane
+import metrics
+from profiler import ProfileSession
+from tracing import Tracer
+from capture import Capture
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.Random import get_random_bytes
@@ -25,45 +40,187 @@ class Server:
     """Chat server. Listens to requests from any IP on a specific port.
     Instance attributes:
     group - (instance of Group) group of the current chat members.
+    rooms - dict of room name to its Room. Rooms are created by members, and deleted once their last member leaves.
+    room_epochs - dict of a room's epoch to the Room, to find the room a Resume asks about.
     accept_soc - the socket used to accept new connections.
     pending_que - queue of newly accepted connections.
+    leaving - members removed from the group whose connection closes once their outbox is sent.
+    wheel - (instance of TimerWheel) keepalive timers of the members.
+    rate_limits - dict of limit name to (rate per second, burst) of the traffic each member may send:
+                  'msgs' - messages, 'bytes' - bytes of messages, 'file_bytes' - bytes of file data.
+    metrics - (instance of metrics.Registry) counters and histograms of the server's activity,
+              shown by /stats and served in the Prometheus format if a stats port is given.
+    profile_session - (instance of ProfileSession) the running profiler, started by /profile or SIGUSR1.
+    profile_requested - set by SIGUSR1, the loop starts profiling at the start of its next iteration.
+    tracer - (instance of tracing.Tracer) samples inbound messages and traces them until their last copy is written.
+    trace - the Trace of the message being handled, if it was sampled.
+    received_at - when the message being handled was read from its connection (as returned by time.time()).
+    memory_snapshot - tracemalloc snapshot taken by the last /memsnap, the next one is diffed against it.
+    memory_tracing - whether /memsnap started tracing allocations, and is to stop it (rather than tracing started otherwise).
+    capture - (instance of capture.Capture) records the inbound traffic for replay, if capturing.
+    transport - the module (or object) sockets are created with: socket, or a simnet.SimulatedNetwork.
 
     """
 
     BUFFER_SIZE = 1024
+    TICK = 0.05  # seconds between iterations of the server loop
+    KEEPALIVE_INTERVAL = 15  # seconds of silence from a member before it is pinged
+    IDLE_TIMEOUT = 30  # seconds of silence from a member before it is evicted
+    RATE_LIMITS = {"msgs": (5, 20), "bytes": (32 * 1024, 128 * 1024), "file_bytes": (1024 * 1024, 8 * 1024 * 1024)}
+    FILE_TYPES = [cpp.DataType.BYTES.value, cpp.DataType.FILE_PART.value]  # limited by 'file_bytes'
+    FILE_CHUNK_SIZE = 64 * 1024  # size of the FILE_PART frames files are sent in
+    MAX_FILE_SIZE = 1024 * 1024 * 1024  # largest file members may upload
+    FLUSH_BUDGET = 1024 * 1024  # bytes written to a member per loop iteration, so one download can't stall the loop
+    READ_BUDGET = 1024 * 1024  # bytes of messages read from a member per loop iteration, so one upload can't stall it
+    HANDSHAKE_TIMEOUT = 2  # seconds to wait for a new connection's name and key
+    LINGER_TIMEOUT = 5  # seconds a removed member's connection is kept open to send its last messages
+    TRACE_TIMEOUT = 10  # seconds after which a trace is stored even if some copies were not written
+    PROFILE_DURATION = 30  # default seconds to profile the server for
+    MAX_PROFILE_DURATION = 600
+    THROTTLE_NOTICE_INTERVAL = 5  # minimal seconds between notices to a throttled member
+    UNLIMITED_TYPES = [cpp.DataType.RESUME.value, cpp.DataType.PING.value, cpp.DataType.PONG.value]
     MANAGER_NAMES = ["Alice", "Menny", "Reem"]  # these names automatically become managers
-    COMMANDS = ["/help", "/quit", "/view-managers", "/tell", "/kick", "/promote", "/demote", "/mute", "/unmute"]
+    MAX_ROOMS_PER_MEMBER = 100  # rooms a member may be in at once
+    ROOMS_LISTED = 20  # largest rooms shown by /rooms
+    ROOM_NAME = re.compile(r"[\w.-]+")  # letters, digits, '_', '.' and '-'
+    ROOM_MANAGER_COMMANDS = [cpp.DataType.CMD_KICK.value, cpp.DataType.CMD_PROMOTE.value, cpp.DataType.CMD_DEMOTE.value,
+                             cpp.DataType.CMD_MUTE.value, cpp.DataType.CMD_UNMUTE.value]
+    COMMANDS = ["/help", "/quit", "/view-managers", "/tell", "/kick", "/promote", "/demote", "/mute", "/unmute", "/stats", "/profile", "/memory", "/memsnap", "/ping",
+                "/rooms", "/create", "/join", "/leave"]
     COLORS = ["#aa0000", "#005500", "#00007f", "#aa007f", "#00557f", "#550000", "#b07500", "#00aa00"]
 
-    def __init__(self):
+    def __init__(self, rate_limits=None, tracer=None, capture=None, transport=socket):
         # Generate AES key to encrypt all communication with clients:
         self.aeskey = get_random_bytes(16)
         self.curr_file_desc = 0
         self.group = Group()
-        self.accept_soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.rooms = {}
+        self.room_epochs = {}
+        self.transport = transport
+        self.accept_soc = transport.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.pending_que = queue.Queue()
-
-    def start(self, port, ip='0.0.0.0'):
+        self.leaving = []
+        self.wheel = TimerWheel(Server.TICK)
+        self.rate_limits = rate_limits if rate_limits is not None else Server.RATE_LIMITS
+        self.start_time = time.time()
+        self.profile_session = None
+        self.profile_requested = False
+        self.tracer = tracer if tracer is not None else Tracer(sample_rate=0)
+        self.trace = None
+        self.received_at = None
+        self.memory_snapshot = None
+        self.memory_tracing = False
+        self.capture = capture
+        self.init_metrics()
+
+    def init_metrics(self):
+        """Creates the metrics updated on the hot paths, so they are not looked up by name every time.
+        """
+        self.metrics = metrics.Registry()
+        self.loop_time = self.metrics.histogram("chat_loop_seconds", "Time spent in one iteration of the server loop, excluding the sleep.")
+        self.handshake_time = self.metrics.histogram("chat_handshake_seconds", "Time taken to accept a new member.")
+        self.encrypt_time = self.metrics.histogram("chat_encrypt_seconds", "Time taken to encode and encrypt one outgoing message.")
+        self.decrypt_time = self.metrics.histogram("chat_decrypt_seconds", "Time taken to decrypt one incoming message.")
+        self.fanout_size = self.metrics.histogram("chat_broadcast_recipients", "Number of members each broadcast is sent to.")
+        self.bytes_in = self.metrics.counter("chat_received_bytes_total", "Bytes received from members.")
+        self.bytes_out = self.metrics.counter("chat_sent_bytes_total", "Bytes sent to members.")
+        self.msgs_in = {}  # datatype value -> Counter
+        self.msgs_out = {}
+        self.metrics.collect(self.collect_gauges, {
+            "chat_members": "Members connected to the server.",
+            "chat_rooms": "Rooms on the server.",
+            "chat_uptime_seconds": "Time since the server started.",
+            "chat_outbox_frames": "Frames queued to all members (a file transfer counts as one).",
+            "chat_outbox_frames_max": "Frames queued to the member with the most of them.",
+            "chat_memory_bytes": "Memory held by each subsystem of the server.",
+        })
+
+    def count_msg(self, counters, direction, datatype):
+        counter = counters.get(datatype)
+        if counter is None:
+            counter = counters[datatype] = self.metrics.counter(f"chat_{direction}_messages_total", f"Messages {direction} by datatype.",
+                                                                type=cpp.datatype_name(datatype))
+        counter.inc()
+
+    def collect_gauges(self):
+        """Returns the gauges computed when the metrics are rendered: members, the depth of their outboxes
+        (over all members and the deepest, not one series per member) and the memory of each subsystem.
+        """
+        gauges = [("chat_members", {}, len(self.group)),
+                  ("chat_rooms", {}, len(self.rooms)),
+                  ("chat_uptime_seconds", {}, round(time.time() - self.start_time))]
+        depths = [len(member.outbox) for member in list(self.group)]
+        gauges += [("chat_outbox_frames", {}, sum(depths)), ("chat_outbox_frames_max", {}, max(depths, default=0))]
+        subsystems, _ = self.memory_usage()
+        gauges += [("chat_memory_bytes", {"subsystem": subsystem}, size) for subsystem, size in subsystems.items()]
+        return gauges
+
+    def memory_usage(self):
+        """Returns the memory held by each subsystem of the server, as a dict of subsystem name to bytes,
+        and a list of (member, receive buffer bytes, send queue bytes) sorted by the total, largest first.
+        Only reads the sizes the loop keeps as it goes, as the metrics are rendered from another thread.
+        """
+        members = list(self.group) + list(self.leaving)
+        per_member = sorted(((member, len(member.reader.buffer), member.outbox.size()) for member in members),
+                            key=lambda usage: -usage[1] - usage[2])
+        file_transfers = sum(member.outbox.size([Lane.BULK]) for member in members)
+        subsystems = {
+            "members": sum(sys.getsizeof(member) + sys.getsizeof(member.__dict__) for member in members),
+            "receive_buffers": sum(usage[1] for usage in per_member),
+            "send_queues": sum(usage[2] for usage in per_member) - file_transfers,
+            "file_transfers": file_transfers,
+            "history": self.group.history_size + sum(room.history_size for room in list(self.rooms.values())),
+            "traces": self.tracer.size,
+        }
+        return subsystems, per_member
+
+    def start(self, port, ip='0.0.0.0', stats_port=None):
         self.accept_soc.bind((ip, port))
         self.accept_soc.listen(1)
         threading.Thread(target=self.accept_connections).start()
+        if stats_port:
+            metrics.serve(self.metrics, stats_port)
+        if hasattr(signal, "SIGUSR1"):  # 'kill -USR1 <pid>' profiles the server
+            signal.signal(signal.SIGUSR1, lambda signum, frame: setattr(self, "profile_requested", True))
         while True:
             try:
-                self.add_pending_member()
-                self.do()
-                time.sleep(0.05)
+                self.step()
+                time.sleep(Server.TICK)
             except KeyboardInterrupt:
                 pid = os.getpid()
                 os.kill(pid, 9)
 
+    def step(self):
+        """Runs one iteration of the server loop: admits a pending member, handles the members' messages,
+        runs the due timers and writes the queued messages.
+        """
+        if self.profile_requested:  # not from the signal handler, which may run in the middle of an iteration
+            self.profile_requested = False
+            self.start_profiling()
+        start = time.perf_counter()
+        self.add_pending_member()
+        self.do()
+        self.wheel.advance()
+        self.flush()
+        if self.capture:
+            self.capture.flush()
+        self.loop_time.record(time.perf_counter() - start)
+
     def add_pending_member(self):
         try:
             conn = self.pending_que.get_nowait()
         except queue.Empty:  # no pending members to add
             return
+        start = time.perf_counter()
+        conn.settimeout(self.HANDSHAKE_TIMEOUT)  # the name and key may still be on their way
         name = self.recv(conn, secure=False)
-        time.sleep(0.5)
-        pubkey = RSA.import_key(self.recv(conn, secure=False))
+        pubkey = self.recv(conn, secure=False)
+        conn.setblocking(0)
+        try:
+            pubkey = RSA.import_key(pubkey)
+        except (ValueError, TypeError, IndexError):  # not a chat client, or it gave up
+            conn.close()
+            return
         if type(name) == str and name:
             name = name.strip()
             if name in self.group:
@@ -74,10 +231,17 @@ class Server:
                 cpp.send(conn, enc_aeskey)
                 color = choice(Server.COLORS)
                 self.group.add(name, pubkey, conn, color, name in self.MANAGER_NAMES)
+                if self.capture:
+                    self.capture.join(name)
+                self.group[name].buckets = {limit: TokenBucket(rate, burst)
+                                            for limit, (rate, burst) in self.rate_limits.items()}
+                self.wheel.schedule(self.KEEPALIVE_INTERVAL, self.keepalive, self.group[name])
                 self.broadcast(cpp.ServerMsg(f"{self.group[name]} joined the chat."))
                 self.unicast(self.group[name], cpp.ServerMsg("Tip: Type /help to display available commands."))
+                self.unicast(self.group[name], cpp.Limits(cpp.MAX_DATA_SIZES))
                 if len(self.group) == 1:  # make first member to join the chat a manager
                     self.group[name].is_manager = True
+        self.handshake_time.record(time.perf_counter() - start)
 
     def accept_connections(self):
         while True:
@@ -86,21 +250,132 @@ class Server:
             self.pending_que.put(conn)
             time.sleep(0.1)
 
-    def unicast(self, member, cpp_msg):
+    def keepalive(self, member):
+        """Checks when the member was last heard from: pings it if it has been quiet for a while,
+        and evicts it if it did not answer in time. Runs from the timer wheel.
+        """
+        if member.conn.fileno() == -1 or member.outbox.closing:  # already left
+            return
+        idle = time.monotonic() - member.last_activity
+        if idle >= self.IDLE_TIMEOUT:
+            self.remove(member)
+            self.broadcast(cpp.ServerMsg(f"{member.name} left the chat (connection timed out)."))
+            return
+        if idle >= self.KEEPALIVE_INTERVAL:
+            self.unicast(member, cpp.Ping())
+            delay = self.IDLE_TIMEOUT - idle
+        else:
+            delay = self.KEEPALIVE_INTERVAL - idle
+        self.wheel.schedule(delay, self.keepalive, member)
+
+    def unicast(self, member, cpp_msg, plaintext=None):
         """send a CPP message to a specific member.
+        The message is encrypted right away and queued in the member's outbox, in the lane matching its priority.
+        plaintext is the message already encoded, by a broadcast for all its recipients.
         """
-        try:
-            cpp.ssend(member.conn, self.aeskey, cpp_msg)
-        except socket.error:  # connection has likely been closed
-            self.group.kick(member)
-            self.broadcast(cpp.ServerMsg(f"{member.name} left the chat."))
+        start = time.perf_counter()
+        if plaintext is None:
+            plaintext = cpp.encode(cpp_msg)
+        frame = cpp.encrypt(self.aeskey, plaintext)
+        self.encrypt_time.record(time.perf_counter() - start)
+        self.count_msg(self.msgs_out, "sent", plaintext[0])
+        if self.trace:
+            trace, copy = self.trace, self.trace.mark_encrypted(member.name)
+            member.outbox.put(self.lane_of(cpp_msg), frame, on_sent=lambda: self.trace_written(trace, copy))
+        else:
+            member.outbox.put(self.lane_of(cpp_msg), frame)
+
+    def trace_written(self, trace, copy):
+        trace.mark_written(copy)
+        if not trace.pending and "handle" in trace.stages:
+            self.tracer.finish(trace)
+
+    def lane_of(self, cpp_msg):
+        """Returns the outbox lane a message is sent in.
+        Broadcasts all go in the chat lane, whatever they carry: lanes overtake each other, and a member that
+        received a broadcast before an earlier one would take the gap for lost messages and ask for them again.
+        """
+        if type(cpp_msg) is cpp.Sequenced:
+            return Lane.CHAT
+        if type(cpp_msg) in [bytes, bytearray, cpp.FilePart]:
+            return Lane.BULK
+        return Lane.CONTROL  # unsequenced notices, private messages, keepalives
+
+    def flush(self):
+        """Writes the members' queued messages to their sockets, as much as the sockets accept without blocking.
+        """
+        for member in list(self.group):
+            try:
+                self.bytes_out.inc(member.outbox.flush(member.conn, self.FLUSH_BUDGET))
+            except socket.error:  # connection has likely been closed
+                self.remove(member)
+                self.broadcast(cpp.ServerMsg(f"{member.name} left the chat."))
+        for member in list(self.leaving):
+            try:
+                self.bytes_out.inc(member.outbox.flush(member.conn, self.FLUSH_BUDGET))
+                done = not member.outbox
+            except socket.error:
+                done = True
+            if done:
+                self.close(member)
+
+    def remove(self, member, close=True):
+        """Removes a member from the group and from its rooms, closing its connection unless close is False.
+        The files it uploaded but did not share are deleted.
+        """
+        self.group.kick(member, close)
+        if self.capture:
+            self.capture.leave(member.name)
+        for name in list(member.rooms):
+            self.leave_room(member, self.rooms[name])
+        for file_id in member.uploads:  # files that were never shared
+            for path in [self.file_path(file_id), self.digest_path(file_id)]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        member.uploads.clear()
+
+    def leave_room(self, member, room):
+        """Removes a member from a room, and deletes the room if it was its last member.
+        """
+        room.leave(member)
+        if not len(room):
+            del self.rooms[room.name]
+            self.room_epochs.pop(room.epoch, None)
 
-    def broadcast(self, cpp_msg, exclude=[]):
-        """send a message to all members, possibly excluding some.
+    def dismiss(self, member):
+        """Removes a member from the group, closing its connection once the messages queued to it are sent.
         """
-        for member in self.group:
+        self.remove(member, close=False)
+        member.outbox.close()
+        self.leaving.append(member)
+        self.wheel.schedule(self.LINGER_TIMEOUT, self.close, member)
+
+    def close(self, member):
+        """Closes the connection of a member that was dismissed.
+        """
+        if member in self.leaving:
+            self.leaving.remove(member)
+            member.conn.close()
+
+    def broadcast(self, cpp_msg, exclude=[], room=None):
+        """send a message to all members, or to the members of a room, possibly excluding some.
+        The message is tagged with the group's (or room's) next sequence number, which lets members detect
+        duplicates and request the messages they missed.
+        """
+        group = self.group
+        if room is not None:
+            group, cpp_msg = room, cpp.InRoom(room.name, cpp_msg)
+        seq_msg = cpp.Sequenced(group.epoch, group.seq + 1, cpp_msg)  # the sequence number record() assigns it
+        plaintext = cpp.encode(seq_msg)  # once for all the recipients
+        group.record(cpp_msg, len(plaintext))
+        recipients = 0
+        for member in group:
             if member not in exclude:
-                self.unicast(member, cpp_msg)
+                self.unicast(member, seq_msg, plaintext)
+                recipients += 1
+        self.fanout_size.record(recipients)
 
     def recv(self, origin, secure=True):
         if type(origin) is Member:
@@ -110,49 +385,220 @@ class Server:
         else:
             return cpp.recv(origin)
 
+    def recv_member(self, member, frame):
+        """Decrypts and decodes a message (frame) received from a member.
+        The member's rate limits are enforced once the message is decrypted, before it is decoded and handled.
+        Returns None if the message was dropped.
+        Raises ConnectionError if the member sent an invalid message.
+        """
+        nonce, tag, ciphertext = frame
+        member.last_activity = time.monotonic()
+        self.received_at = time.time()
+        self.trace = self.tracer.begin(member.name)
+        self.bytes_in.inc(36 + len(ciphertext))  # size, nonce and tag are 36 bytes
+        start = time.perf_counter()
+        datatype, data = cpp.sdecrypt(self.aeskey, nonce, tag, ciphertext)
+        self.decrypt_time.record(time.perf_counter() - start)
+        if self.capture:
+            self.capture.frame(member.name, datatype, data)
+        self.count_msg(self.msgs_in, "received", datatype)
+        if self.trace:
+            self.trace.datatype = cpp.datatype_name(datatype)
+            self.trace.mark("decrypt")
+        if not self.within_rate_limits(member, datatype, len(data)):
+            self.trace = None
+            return None
+        try:
+            cpp_msg = cpp.construct_cpp_msg(datatype, data)
+        except (struct.error, ValueError, UnicodeDecodeError) as err:  # truncated fields, a bad UUID or text
+            raise cpp.FrameError(f"invalid {cpp.datatype_name(datatype)} message: {err}") from err
+        if self.trace:
+            self.trace.mark("decode")
+        return cpp_msg
+
+    def within_rate_limits(self, member, datatype, size):
+        """Charges a message to the member's token buckets, and notifies the member when it is throttled.
+        Managers are exempt. Returns whether the message may be handled.
+        A message is charged only if every bucket allows it, so a dropped message costs the member nothing.
+        """
+        if member.is_manager or datatype in self.UNLIMITED_TYPES:
+            return True
+        if datatype in self.FILE_TYPES:
+            charges = [("file_bytes", size)]
+        else:
+            charges = [("msgs", 1), ("bytes", size)]
+        buckets = [(member.buckets.get(limit), amount) for limit, amount in charges]
+        allowed = all(bucket is None or bucket.allows(amount) for bucket, amount in buckets)
+        if allowed:
+            for bucket, amount in buckets:
+                if bucket is not None:
+                    bucket.consume(amount)
+        now = time.monotonic()
+        if not allowed and now - member.throttle_notice_time >= self.THROTTLE_NOTICE_INTERVAL:
+            member.throttle_notice_time = now
+            self.unicast(member, cpp.ServerMsg("Error - You are sending too fast, messages are being dropped."))
+        return allowed
+
     def handle(self, member, cpp_msg):
         if type(cpp_msg) is cpp.Cmd:
             self.execute_command(member, cpp_msg)
+        elif type(cpp_msg) is str and not cpp.valid_markup(cpp_msg):
+            self.unicast(member, cpp.ServerMsg("Error - Invalid message format, message was not sent."))
         elif type(cpp_msg) is str and not member.is_muted:
-            if cpp_msg.startswith("DOWNLOAD:"):
-                file_descriptor = int(cpp_msg.split(':', 1)[1])
-                self.send_file(member, file_descriptor)
-                return
             if cpp_msg.startswith("FILE:"):
                 filepath = cpp_msg.split(':', 1)[1]
                 self.curr_file_desc += 1
                 cpp_msg = f"FILE:{self.curr_file_desc}:{filepath}"
-            self.broadcast(cpp.ServerMsg(cpp_msg, name=member.name), exclude=[member])
-            self.unicast(member, cpp.ServerMsg(cpp_msg, name=member.name))
+            self.broadcast(cpp.ServerMsg(cpp_msg, name=member.name))
         elif type(cpp_msg) is cpp.FileAttachSend:
-            uuid = uuid4()
-            attachment = cpp.FileAttachRecv(cpp_msg.filename, member.name, uuid)
-            self.broadcast(attachment, exclude=[member])
-            self.unicast(member, attachment)
+            self.attach_file(member, cpp_msg)
+        elif type(cpp_msg) is cpp.InRoom:
+            self.handle_in_room(member, cpp_msg.room, cpp_msg.msg)
+        elif type(cpp_msg) is cpp.Resume:
+            self.resume(member, cpp_msg.epoch, cpp_msg.seq)
+        elif type(cpp_msg) is cpp.Ping:
+            self.unicast(member, cpp.Pong(cpp_msg.stamp))
+        elif type(cpp_msg) is cpp.Pong:
+            pass  # the member's activity is already recorded
         elif type(cpp_msg) is cpp.FileAttachRecv:
             print("recv")
         elif type(cpp_msg) is bytes:
             self.download_file(cpp_msg)
+        elif type(cpp_msg) is cpp.FilePart:
+            self.download_file_part(member, cpp_msg)
+        elif type(cpp_msg) is cpp.FileRequest:
+            self.send_file(member, cpp_msg.file_id)
         elif member.is_muted:
             self.unicast(member, cpp.ServerMsg("Error - You are muted, message was not sent."))
 
-    def send_file(self, member, file_descriptor):
-        filepath = f"./data/{file_descriptor}"
+    def handle_in_room(self, member, name, cpp_msg):
+        """Handles a message a member sent in a room: chat messages and file attachments are broadcast
+        to the room's members, and commands apply to the room.
+        """
+        room = self.rooms.get(name)
+        if room is None or member not in room:
+            self.unicast(member, cpp.ServerMsg(f"Error - You are not in #{name}."))
+        elif type(cpp_msg) is cpp.Cmd:
+            self.execute_room_command(member, room, cpp_msg)
+        elif room.is_muted(member):
+            self.unicast(member, cpp.ServerMsg(f"Error - You are muted in #{room.name}, message was not sent."))
+        elif type(cpp_msg) is str and not cpp.valid_markup(cpp_msg):
+            self.unicast(member, cpp.ServerMsg("Error - Invalid message format, message was not sent."))
+        elif type(cpp_msg) is str:
+            self.broadcast(cpp.ServerMsg(cpp_msg, name=member.name), room=room)
+        elif type(cpp_msg) is cpp.FileAttachSend:
+            self.attach_file(member, cpp_msg, room)
+
+    def attach_file(self, member, attachment, room=None):
+        """Broadcasts a file a member uploaded to the group (or to a room), once all of it was written.
+        """
+        upload = member.uploads.get(attachment.file_id)
+        if upload is None or upload[0] < upload[1]:
+            self.unicast(member, cpp.ServerMsg("Error - The file was not uploaded."))
+            return
+        del member.uploads[attachment.file_id]
+        self.broadcast(cpp.FileAttachRecv(attachment.filename, member.name, attachment.file_id), room=room)
+
+    def resume(self, member, epoch, seq):
+        """send a reconnecting member the broadcast messages sent after the sequence number seq,
+        in the group or in the room whose epoch is epoch.
+        """
+        if epoch == self.group.epoch:
+            group = self.group
+        elif epoch in self.room_epochs and member in self.room_epochs[epoch]:
+            group = self.room_epochs[epoch]
+        else:
+            self.unicast(member, cpp.ServerMsg("The server has restarted, earlier messages are unavailable."))
+            return
+        missed = group.replay(seq)
+        first = missed[0][0] if missed else group.seq + 1
+        if first > seq + 1:
+            self.unicast(member, cpp.ServerMsg(f"{first - seq - 1} earlier messages are no longer available."))
+        for missed_seq, cpp_msg in missed:
+            self.unicast(member, cpp.Sequenced(group.epoch, missed_seq, cpp_msg))
+
+    def file_path(self, file_id):
+        """Returns the path a file with the UUID file_id is stored at.
+        """
+        return f"./data/{file_id}"
+
+    def digest_path(self, file_id):
+        """Returns the path of the SHA-256 digest of a stored file, written once all of it was uploaded.
+        """
+        return f"{self.file_path(file_id)}.sha256"
+
+    def send_file(self, member, file_id):
+        """Queues a stored file to a member: its size and digest, then FILE_PART chunks that are read from disk
+        only when they are due. A file that is not stored, or not completely uploaded, is answered without digest.
+        """
+        filepath = self.file_path(file_id)
+        try:
+            with open(self.digest_path(file_id)) as file:
+                digest = bytes.fromhex(file.read())
+            size = os.path.getsize(filepath)
+        except (OSError, ValueError):
+            self.unicast(member, cpp.FileInfo(file_id, 0, b""))
+            return
+        self.unicast(member, cpp.FileInfo(file_id, size, digest))
+        member.outbox.put(Lane.BULK, self.file_frames(filepath, file_id))
+
+    def file_frames(self, filepath, file_id):
+        """Yields the encrypted FILE_PART messages of a file, reading one chunk at a time.
+        """
+        total = os.path.getsize(filepath)
         with open(filepath, 'rb') as file:
-            data = file.read()
-            file.close()
-        self.unicast(member, data)
+            offset = 0
+            chunk = file.read(self.FILE_CHUNK_SIZE)
+            while chunk:
+                yield cpp.seal(self.aeskey, cpp.FilePart(file_id, offset, total, chunk))
+                offset += len(chunk)
+                chunk = file.read(self.FILE_CHUNK_SIZE)
 
     def download_file(self, data):
         Path(f"./data").mkdir(parents=True, exist_ok=True)
-        file = open(f"./data/{self.curr_file_desc}", 'wb')
+        file = open(self.file_path(UUID(int=self.curr_file_desc)), 'wb')
         file.write(data)
         file.close()
 
+    def download_file_part(self, member, part):
+        """Writes a chunk of a file uploaded by a member straight to disk,
+        so files larger than a single message are never held in memory.
+        Chunks are written only in order, and each one is answered with how much of the file was written,
+        so the member paces its upload and sends again what was lost (a chunk dropped over the rate limit).
+        The file's digest is computed along, and stored once all of it was written.
+        """
+        if part.total > self.MAX_FILE_SIZE or part.offset + len(part.data) > part.total:
+            self.unicast(member, cpp.ServerMsg("Error - File is too large."))
+            return
+        filepath = self.file_path(part.file_id)
+        if part.file_id not in member.uploads:
+            if part.offset or os.path.exists(filepath):  # only new files are uploaded, from their start
+                self.unicast(member, cpp.ServerMsg("Error - Invalid file upload."))
+                return
+            member.uploads[part.file_id] = (0, part.total, hashlib.sha256())
+        received, total, digest = member.uploads[part.file_id]
+        if part.total != total:
+            self.unicast(member, cpp.ServerMsg("Error - Invalid file upload."))
+            return
+        if part.offset == received:
+            Path(f"./data").mkdir(parents=True, exist_ok=True)
+            with open(filepath, 'r+b' if part.offset else 'wb') as file:
+                file.seek(part.offset)
+                file.write(part.data)
+            digest.update(part.data)
+            received += len(part.data)
+            member.uploads[part.file_id] = (received, total, digest)
+            if received == total:
+                with open(self.digest_path(part.file_id), 'w') as file:
+                    file.write(digest.hexdigest())
+        self.unicast(member, cpp.FileAck(part.file_id, received))
+
     def execute_command(self, executer, cmd):
 
         if not executer.is_manager and cmd.cmd in [cpp.DataType.CMD_KICK.value, cpp.DataType.CMD_PROMOTE.value, cpp.DataType.CMD_DEMOTE.value,
-                                                   cpp.DataType.CMD_MUTE.value, cpp.DataType.CMD_UNMUTE.value]:
+                                                   cpp.DataType.CMD_MUTE.value, cpp.DataType.CMD_UNMUTE.value,
+                                                   cpp.DataType.CMD_STATS.value, cpp.DataType.CMD_PROFILE.value,
+                                                   cpp.DataType.CMD_MEMORY.value, cpp.DataType.CMD_MEMSNAP.value]:
             # executer is not a manager but tries to use manager-only commands
             self.unicast(executer, cpp.ServerMsg("Error - Permission denied."))
         elif cmd.cmd == cpp.DataType.CMD_HELP.value:
@@ -163,6 +609,24 @@ class Server:
             self.execute_view_managers(executer)
         elif cmd.cmd == cpp.DataType.CMD_LIST.value:
             self.execute_list(executer)
+        elif cmd.cmd == cpp.DataType.CMD_STATS.value:
+            self.execute_stats(executer)
+        elif cmd.cmd == cpp.DataType.CMD_PROFILE.value:
+            self.execute_profile(executer, cmd.name)
+        elif cmd.cmd == cpp.DataType.CMD_MEMORY.value:
+            self.execute_memory(executer)
+        elif cmd.cmd == cpp.DataType.CMD_MEMSNAP.value:
+            self.execute_memsnap(executer)
+        elif cmd.cmd == cpp.DataType.CMD_PING.value:
+            self.execute_ping(executer, cmd.name)
+        elif cmd.cmd == cpp.DataType.CMD_ROOMS.value:
+            self.execute_rooms(executer)
+        elif cmd.cmd == cpp.DataType.CMD_CREATE.value:
+            self.execute_create(executer, cmd.name.strip().lstrip("#"))
+        elif cmd.cmd == cpp.DataType.CMD_JOIN.value:
+            self.execute_join(executer, cmd.name.strip().lstrip("#"))
+        elif cmd.cmd == cpp.DataType.CMD_LEAVE.value:
+            self.execute_leave(executer, cmd.name.strip().lstrip("#"))
         elif cmd.name not in self.group:
             self.unicast(executer, cpp.ServerMsg(f"Error - '{cmd.name}' is not in the group."))
         elif cmd.cmd == cpp.DataType.CMD_TELL.value:
@@ -185,10 +649,95 @@ class Server:
 
     def execute_quit(self, executer):
         self.broadcast(cpp.ServerMsg(f"{executer.name} left the chat."))
-        self.group.kick(executer)
+        self.remove(executer)
+
+    def execute_room_command(self, executer, room, cmd):
+        """Executes a command sent in a room, which applies to the room's members, managers and mutes.
+        """
+        if not room.is_manager(executer) and cmd.cmd in self.ROOM_MANAGER_COMMANDS:
+            self.unicast(executer, cpp.ServerMsg("Error - Permission denied."))
+        elif cmd.cmd == cpp.DataType.CMD_LIST.value:
+            self.execute_list(executer, room)
+        elif cmd.cmd == cpp.DataType.CMD_VIEW.value:
+            self.execute_view_managers(executer, room)
+        elif cmd.cmd == cpp.DataType.CMD_LEAVE.value:
+            self.execute_leave(executer, room.name)
+        elif cmd.cmd not in self.ROOM_MANAGER_COMMANDS:
+            self.unicast(executer, cpp.ServerMsg("Error - This command can't be used in a room."))
+        elif cmd.name not in room:
+            self.unicast(executer, cpp.ServerMsg(f"Error - '{cmd.name}' is not in #{room.name}."))
+        elif cmd.cmd == cpp.DataType.CMD_KICK.value:
+            member = room[cmd.name]
+            self.broadcast(cpp.ServerMsg(f"{member.name} has been kicked from the room."), exclude=[member], room=room)
+            self.unicast(member, cpp.ServerMsg(f"You have been kicked from #{room.name}."))
+            self.leave_room(member, room)
+        elif cmd.cmd == cpp.DataType.CMD_PROMOTE.value and cmd.name not in room.managers:
+            room.managers.add(cmd.name)
+            self.unicast(room[cmd.name], cpp.ServerMsg(f"You are now a manager of #{room.name}."))
+        elif cmd.cmd == cpp.DataType.CMD_DEMOTE.value and cmd.name in room.managers:
+            room.managers.discard(cmd.name)
+            self.unicast(room[cmd.name], cpp.ServerMsg(f"You are no longer a manager of #{room.name}."))
+        elif cmd.cmd == cpp.DataType.CMD_MUTE.value and cmd.name not in room.muted:
+            room.muted.add(cmd.name)
+            self.unicast(room[cmd.name], cpp.ServerMsg(f"You have been muted in #{room.name}."))
+        elif cmd.cmd == cpp.DataType.CMD_UNMUTE.value and cmd.name in room.muted:
+            room.muted.discard(cmd.name)
+            self.unicast(room[cmd.name], cpp.ServerMsg(f"You are no longer muted in #{room.name}."))
+
+    def execute_rooms(self, executer):
+        joined = [f"#{name}" for name in sorted(executer.rooms)]
+        largest = heapq.nlargest(self.ROOMS_LISTED, self.rooms.values(), key=len)
+        room_list = [f"#{room.name} ({len(room)})" for room in largest]
+        self.unicast(executer, cpp.ServerMsg(f'''
+            <p style='text-align:center'>
+                <u>Your Rooms</u>
+                <p>{'<br />'.join(joined) or 'None, type /join [room] to join one.'}</p>
+                <u>Largest Rooms ({len(self.rooms)} in total)</u>
+                <p>{'<br />'.join(room_list)}</p>
+            </p>
+            '''))
+
+    def execute_create(self, executer, name):
+        if not self.ROOM_NAME.fullmatch(name) or len(name.encode()) > cpp.MAX_ROOM_NAME:
+            self.unicast(executer, cpp.ServerMsg(f"Error - Room names are 1-{cpp.MAX_ROOM_NAME} letters, digits, '_', '.' or '-'."))
+        elif name in self.rooms:
+            self.unicast(executer, cpp.ServerMsg(f"Error - #{name} already exists, type /join {name} to join it."))
+        elif len(executer.rooms) >= self.MAX_ROOMS_PER_MEMBER:
+            self.unicast(executer, cpp.ServerMsg(f"Error - You can't be in more than {self.MAX_ROOMS_PER_MEMBER} rooms."))
+        else:
+            room = self.rooms[name] = Room(name)
+            while room.epoch in self.room_epochs or room.epoch == self.group.epoch:  # a Resume must find one history
+                room.epoch = getrandbits(32)
+            self.room_epochs[room.epoch] = room
+            room.managers.add(executer.name)
+            room.join(executer)
+            self.broadcast(cpp.ServerMsg(f"{executer.name} created the room."), room=room)
+
+    def execute_join(self, executer, name):
+        room = self.rooms.get(name)
+        if room is None:
+            self.unicast(executer, cpp.ServerMsg(f"Error - There is no room #{name}, type /create {name} to create it."))
+        elif executer in room:
+            self.unicast(executer, cpp.ServerMsg(f"You are already in #{name}."))
+        elif len(executer.rooms) >= self.MAX_ROOMS_PER_MEMBER:
+            self.unicast(executer, cpp.ServerMsg(f"Error - You can't be in more than {self.MAX_ROOMS_PER_MEMBER} rooms."))
+        else:
+            room.join(executer)
+            self.broadcast(cpp.ServerMsg(f"{executer.name} joined the room."), room=room)
+
+    def execute_leave(self, executer, name):
+        room = self.rooms.get(name)
+        if room is None or executer not in room:
+            self.unicast(executer, cpp.ServerMsg(f"Error - You are not in #{name}."))
+        else:
+            self.broadcast(cpp.ServerMsg(f"{executer.name} left the room."), room=room)
+            self.leave_room(executer, room)
 
-    def execute_view_managers(self, executer):
-        manager_list = map(lambda memb: str(memb), filter(lambda memb: memb.is_manager, self.group))
+    def execute_view_managers(self, executer, room=None):
+        if room is None:
+            manager_list = map(lambda memb: str(memb), filter(lambda memb: memb.is_manager, self.group))
+        else:
+            manager_list = map(lambda memb: str(memb), filter(room.is_manager, room))
         self.unicast(executer, cpp.ServerMsg(f'''
             <p style='text-align:center'>
                 <u>Managers</u>
@@ -196,15 +745,120 @@ class Server:
             </p> 
             '''))
     
-    def execute_list(self, executer):
-        user_list = map(lambda memb: str(memb), self.group)
+    def execute_list(self, executer, room=None):
+        user_list = map(lambda memb: str(memb), self.group if room is None else room)
         self.unicast(executer, cpp.ServerMsg(f'''
             <p style='text-align:center'>
-                <u>Online Users</u>
+                <u>{'Online Users' if room is None else f'Members of #{room.name}'}</u>
                 <p>{'<br />'.join(user_list)}</p>
             </p> 
             '''))
 
+    def execute_stats(self, executer):
+        ms = lambda seconds: f"{seconds * 1000:.2f} ms"
+        received = sum(counter.value for counter in list(self.msgs_in.values()))
+        sent = sum(counter.value for counter in list(self.msgs_out.values()))
+        busiest = max(self.group, key=lambda memb: len(memb.outbox))
+        uptime = round(time.time() - self.start_time)
+        self.unicast(executer, cpp.ServerMsg(f'''
+            <p style='text-align:center'>
+                <u>Server Stats</u>
+                <p>Uptime: {uptime // 3600}h {uptime // 60 % 60}m {uptime % 60}s<br />
+                Members: {len(self.group)}, rooms: {len(self.rooms)}<br />
+                Messages received / sent: {received} / {sent}<br />
+                Bytes received / sent: {self.bytes_in.value} / {self.bytes_out.value}<br />
+                Loop time p50 / p99 / max: {ms(self.loop_time.percentile(50))} / {ms(self.loop_time.percentile(99))} / {ms(self.loop_time.max)}<br />
+                Encrypt p99: {ms(self.encrypt_time.percentile(99))}, decrypt p99: {ms(self.decrypt_time.percentile(99))}<br />
+                Broadcast recipients p50 / max: {self.fanout_size.percentile(50):.0f} / {self.fanout_size.max}<br />
+                Handshake p50: {ms(self.handshake_time.percentile(50))}<br />
+                Largest outbox: {busiest} ({len(busiest.outbox)} frames)</p>
+            </p>
+            '''))
+
+    def execute_memory(self, executer):
+        kb = lambda size: f"{size / 1024:.1f} KB"
+        subsystems, per_member = self.memory_usage()
+        subsystem_list = [f"{subsystem.replace('_', ' ').capitalize()}: {kb(size)}" for subsystem, size in subsystems.items()]
+        member_list = [f"{member}: {kb(received)} received, {kb(queued)} queued" for member, received, queued in per_member[:10]]
+        self.unicast(executer, cpp.ServerMsg(f'''
+            <p style='text-align:center'>
+                <u>Memory Usage</u>
+                <p>{'<br />'.join(subsystem_list)}</p>
+                <u>Top Members</u>
+                <p>{'<br />'.join(member_list)}</p>
+            </p>
+            '''))
+
+    def execute_memsnap(self, executer):
+        """Takes a tracemalloc snapshot. The first call starts tracing allocations,
+        the second one shows what was allocated in between (the full diff is saved on the server) and stops tracing,
+        unless it was already tracing (e.g. started with -X tracemalloc).
+        """
+        if self.memory_snapshot is None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.memory_tracing = True
+            self.memory_snapshot = tracemalloc.take_snapshot()
+            self.unicast(executer, cpp.ServerMsg("Tracing allocations, type /memsnap again to see what changed."))
+            return
+        diff = tracemalloc.take_snapshot().compare_to(self.memory_snapshot, "lineno")
+        self.memory_snapshot = None
+        if self.memory_tracing:
+            tracemalloc.stop()
+            self.memory_tracing = False
+        os.makedirs("./profiles", exist_ok=True)
+        path = time.strftime("./profiles/memsnap-%Y%m%d-%H%M%S.txt")
+        with open(path, "w") as file:
+            file.write("\n".join(str(stat) for stat in diff) + "\n")
+        top = [html.escape(str(stat)) for stat in diff[:10]]
+        self.unicast(executer, cpp.ServerMsg(f'''
+            <p style='text-align:center'>
+                <u>Largest Allocation Changes</u>
+                <p>{'<br />'.join(top)}</p>
+                Full diff saved to {path}
+            </p>
+            '''))
+
+    def execute_ping(self, executer, probe):
+        """Answers a latency probe with the times it was received and handled.
+        The reply is encrypted only when it leaves the member's outbox, so it also carries the time it was sent.
+        """
+        executer.outbox.put(Lane.CONTROL, self.ping_reply_frames(probe, self.received_at, time.time()))
+
+    def ping_reply_frames(self, probe, received, handled):
+        self.count_msg(self.msgs_out, "sent", cpp.DataType.PING_REPLY.value)
+        yield cpp.seal(self.aeskey, cpp.PingReply(probe, received, handled, time.time()))
+
+    def execute_profile(self, executer, duration):
+        try:
+            duration = float(duration) if duration else self.PROFILE_DURATION
+        except ValueError:
+            duration = 0
+        if not 0 < duration <= self.MAX_PROFILE_DURATION:
+            self.unicast(executer, cpp.ServerMsg(f"Error - Duration must be 1-{self.MAX_PROFILE_DURATION} seconds."))
+        elif not self.start_profiling(duration, executer):
+            self.unicast(executer, cpp.ServerMsg("Error - The server is already being profiled."))
+        else:
+            self.unicast(executer, cpp.ServerMsg(f"Profiling the server for {duration:g} seconds."))
+
+    def start_profiling(self, duration=PROFILE_DURATION, requester=None):
+        """Starts profiling the server loop for duration seconds, while it keeps running.
+        When done, the requester (if still connected) is told where the results were saved.
+        Returns False if a profiler is already running.
+        """
+        if self.profile_session:
+            return False
+        self.profile_session = ProfileSession()
+        self.profile_session.start()
+        self.wheel.schedule(duration, self.stop_profiling, requester)
+        return True
+
+    def stop_profiling(self, requester):
+        paths = self.profile_session.stop()
+        self.profile_session = None
+        if requester is not None and requester in self.group:
+            self.unicast(requester, cpp.ServerMsg(f"Profile saved to {', '.join(paths)}"))
+
     def execute_tell(self, executer, name, msg):
         if executer.is_muted:
             self.unicast(executer, cpp.ServerMsg("Error - You are muted, message was not sent."))
@@ -216,7 +870,7 @@ class Server:
         if name in self.group:
             self.broadcast(cpp.ServerMsg(f"{self.group[name].name} has been kicked from the group."), exclude=[self.group[name]])
             self.unicast(self.group[name], cpp.ServerMsg("You have been kicked from the group."))
-            self.group.kick(name)
+            self.dismiss(self.group[name])
 
     def execute_promote(self, name):
         if name in self.group and not self.group[name].is_manager:
@@ -239,16 +893,38 @@ class Server:
             self.group[name].is_muted = False
 
     def do(self):
-        for member in self.group:
+        """Handles the complete messages each member sent, up to READ_BUDGET bytes of them per member.
+        """
+        for member in list(self.group):
             if member.conn.fileno() == -1:
-                self.group.kick(member)
+                self.remove(member)
             else:
                 try:
-                    cpp_msg = self.recv(member)
-                    if cpp_msg is not None:
-                        self.handle(member, cpp_msg)
-                except ConnectionError:
-                    self.group.kick(member)
+                    read = 0
+                    while read < self.READ_BUDGET and member in self.group:  # handling may remove the member
+                        frame = member.reader.read(member.conn)
+                        if frame is None:
+                            break
+                        read += 36 + len(frame[2])
+                        cpp_msg = self.recv_member(member, frame)
+                        if cpp_msg is not None:
+                            self.handle(member, cpp_msg)
+                            self.end_trace()
+                except ConnectionError:  # closed by the member, or an invalid message
+                    self.trace = None
+                    self.remove(member)
+                    self.broadcast(cpp.ServerMsg(f"{member.name} left the chat."))
+
+    def end_trace(self):
+        """Marks the end of handling the traced message. The trace is stored once all its copies are written.
+        """
+        trace, self.trace = self.trace, None
+        if trace:
+            trace.mark("handle")
+            if trace.pending:
+                self.wheel.schedule(self.TRACE_TIMEOUT, self.tracer.finish, trace)
+            else:
+                self.tracer.finish(trace)
                 
 
     def help_html(self):
@@ -258,6 +934,14 @@ class Server:
         <p><span style=" font-weight:600;">/help</span> - display this text.</p>
         <p><span style=" font-weight:600;">/quit</span> - quit the chat group.</p>
         <p><span style=" font-weight:600;">/view-managers</span> - view all members with manager permissions.</p>
+        <p><span style=" font-weight:600;">/ping</span> - measure the delay to the server.</p>
+        <p><span style=" font-weight:600;">/rooms</span> - list your rooms and the largest ones.</p>
+        <p><span style=" font-weight:600;">/create</span><span style=" font-style:italic;"> [room]</span> - create a room and
+                join it as its manager.</p>
+        <p><span style=" font-weight:600;">/join</span><span style=" font-style:italic;"> [room]</span> - join a room, and
+                talk in it.</p>
+        <p><span style=" font-weight:600;">/leave</span><span style=" font-style:italic;"> [room]</span> - leave a room (the
+                current one if not given).</p>
         <p><span style=" font-weight:600;">/tell</span><span style=" font-style:italic;"> [name] [msg]</span> - send a
                 private message to a member.</p>
         <p><span style=" font-weight:600; text-decoration: underline;">/kick</span><span
@@ -270,18 +954,29 @@ class Server:
                         style=" font-style:italic;"> [name]</span> - make a member unable to send messages.</p>
         <p><span style=" font-weight:600; text-decoration: underline;">/unmute</span><span
                         style=" font-style:italic;"> [name]</span> - make a member able to send messages.</p>
-        <p>* Underlined commands require manager permissions.</p>
+        <p><span style=" font-weight:600; text-decoration: underline;">/stats</span> - display server statistics.</p>
+        <p><span style=" font-weight:600; text-decoration: underline;">/profile</span><span
+                        style=" font-style:italic;"> [seconds]</span> - profile the server and save the results on it.</p>
+        <p><span style=" font-weight:600; text-decoration: underline;">/memory</span> - display the server's memory usage.</p>
+        <p><span style=" font-weight:600; text-decoration: underline;">/memsnap</span> - trace allocations until the next /memsnap, then display them.</p>
+        <p>* Underlined commands require manager permissions. In a room, /list, /view-managers, /kick, /promote,
+                /demote, /mute and /unmute apply to the room, and its managers may use them.</p>
         </body></html>'''
 
 
 def main():
-    if len(sys.argv) > 1:
-        port = int(sys.argv[1])
-    else:
-        port = DEFAULT_PORT
-    print(f"Running chat server on port {port}")
-    server = Server()
-    server.start(port, ip=LISTEN_IP)
+    parser = argparse.ArgumentParser(description="Chat server.")
+    parser.add_argument("port", type=int, nargs="?", default=DEFAULT_PORT)
+    parser.add_argument("--stats-port", type=int, help="serve Prometheus metrics on http://127.0.0.1:STATS_PORT/metrics")
+    parser.add_argument("--trace-file", help="append traces of sampled messages to this JSONL file")
+    parser.add_argument("--trace-sample", type=float, default=0.01, help="fraction of messages to trace (default 0.01)")
+    parser.add_argument("--capture", help="record the received messages to this file, to replay with capture.py")
+    args = parser.parse_args()
+    print(f"Running chat server on port {args.port}")
+    tracer = Tracer(args.trace_sample, args.trace_file) if args.trace_file else None
+    capture = Capture(args.capture) if args.capture else None
+    server = Server(tracer=tracer, capture=capture)
+    server.start(args.port, ip=LISTEN_IP, stats_port=args.stats_port)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,297 @@
+# simnet.py
+# In-process simulated network, a drop-in replacement for the socket module wherever the server or client
+# create their sockets: Server(transport=SimulatedNetwork(...)) or Client(name, transport=...).
+# Links have a configurable latency, jitter, bandwidth, segment size and loss, and with a ManualClock
+# every run is deterministic: time only moves when the simulation advances it.
+
+import time
+import errno
+import socket
+import random
+import itertools
+import threading
+from collections import deque
+
+
+class ManualClock:
+    """A clock that only moves when told to.
+    Blocking operations on the sockets of a network using it advance it to the next arrival instead of waiting.
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def advance_to(self, when):
+        self.now = max(self.now, when)
+
+
+class LinkProfile:
+    """Characteristics of a simulated link, the same in both directions.
+    Instance attributes:
+    latency - seconds a segment takes to arrive once it has been sent.
+    jitter - up to this many random extra seconds of latency per segment (segments still arrive in order).
+    bandwidth - bytes per second the link sends, None for unlimited.
+    mtu - data is split into segments of at most this many bytes, so reads see messages arrive in pieces.
+    loss - probability that a segment is lost, which stalls the stream for stall seconds until it is retransmitted.
+    buffer_size - bytes that may be written and not read yet before sends block (or raise BlockingIOError).
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, mtu=1460, loss=0.0, stall=0.2, buffer_size=256 * 1024):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.mtu = mtu
+        self.loss = loss
+        self.stall = stall
+        self.buffer_size = buffer_size
+
+
+class Pipe:
+    """One direction of a simulated connection: the segments written to it, and when each of them arrives.
+    Instance attributes:
+    segments - deque of [arrival time, bytes], in the order they were written.
+    queued - bytes written and not read yet.
+    free_at - when the link finishes sending the segments written so far.
+    fin_at - when the end of the stream arrives, once the writer has closed.
+    reader_closed - whether the reading end was closed, so writes fail.
+    """
+
+    def __init__(self, network, profile):
+        self.network = network
+        self.profile = profile
+        self.segments = deque()
+        self.queued = 0
+        self.free_at = 0
+        self.last_arrival = 0
+        self.fin_at = None
+        self.reader_closed = False
+
+    def space(self):
+        return self.profile.buffer_size - self.queued
+
+    def write(self, data):
+        """Writes as much of data as the buffer has room for. Returns the number of bytes written.
+        """
+        profile, rng = self.profile, self.network.random
+        data = memoryview(data)[:max(0, self.space())]
+        now = self.network.clock()
+        for offset in range(0, len(data), profile.mtu):
+            segment = bytes(data[offset:offset + profile.mtu])
+            self.free_at = max(now, self.free_at) + (len(segment) / profile.bandwidth if profile.bandwidth else 0)
+            arrival = self.free_at + profile.latency + rng.uniform(0, profile.jitter)
+            if profile.loss and rng.random() < profile.loss:
+                arrival += profile.stall
+            self.last_arrival = max(arrival, self.last_arrival)  # segments arrive in order, like over TCP
+            self.segments.append([self.last_arrival, segment])
+        self.queued += len(data)
+        return len(data)
+
+    def read(self, n):
+        """Returns up to n of the bytes that have arrived (b'' if none have).
+        """
+        now = self.network.clock()
+        data = bytearray()
+        while self.segments and self.segments[0][0] <= now and len(data) < n:
+            segment = self.segments[0]
+            wanted = n - len(data)
+            data += segment[1][:wanted]
+            if len(segment[1]) > wanted:
+                segment[1] = segment[1][wanted:]
+            else:
+                self.segments.popleft()
+        self.queued -= len(data)
+        return bytes(data)
+
+    def close(self):
+        self.fin_at = max(self.last_arrival, self.network.clock() + self.profile.latency)
+
+    def readable(self):
+        """Returns whether a read would return data or the end of the stream right now.
+        """
+        now = self.network.clock()
+        if self.segments:
+            return self.segments[0][0] <= now
+        return self.fin_at is not None and self.fin_at <= now
+
+    def next_arrival(self):
+        """Returns when the next segment (or the end of the stream) arrives, or None if nothing is on its way.
+        """
+        return self.segments[0][0] if self.segments else self.fin_at
+
+
+class SimulatedNetwork:
+    """A network of simulated links, usable in place of the socket module: network.socket() returns a socket-like
+    object supporting the calls the server and client make (connect, bind, listen, accept, send, sendall,
+    recv, recv_into, setblocking, settimeout, fileno and close).
+    Sockets listen and connect by port only. A socket's links use its profile, or the network's by default.
+    Instance attributes:
+    profile - (instance of LinkProfile) the links' default characteristics.
+    clock - function returning the current time, time.monotonic or a ManualClock.
+    random - random generator of the jitter and loss, seeded so runs repeat.
+    listeners - dict of port to the listening socket.
+    """
+
+    def __init__(self, profile=None, clock=None, seed=0):
+        self.profile = profile if profile is not None else LinkProfile()
+        self.clock = clock if clock is not None else time.monotonic
+        self.random = random.Random(seed)
+        self.condition = threading.Condition()
+        self.listeners = {}
+        self.fds = itertools.count(1000)
+
+    def socket(self, family=socket.AF_INET, type=socket.SOCK_STREAM, profile=None):
+        return SimulatedSocket(self, profile)
+
+    def pair(self, profile=None):
+        """Returns two sockets connected to each other, like socket.socketpair().
+        """
+        first, second = SimulatedSocket(self, profile), SimulatedSocket(self, profile)
+        first.link(second)
+        return first, second
+
+    def wait(self, ready, next_event, deadline):
+        """Waits until ready() is true, the condition being held. next_event() returns when something is due
+        to arrive, or None. Raises socket.timeout if deadline (a time of the clock) passes first.
+        """
+        while not ready():
+            now = self.clock()
+            if deadline is not None and now >= deadline:
+                raise socket.timeout("timed out")
+            due = next_event()
+            if isinstance(self.clock, ManualClock):
+                if due is None and deadline is None:
+                    raise socket.timeout("nothing is on its way, the simulation would wait forever")
+                self.clock.advance_to(min(when for when in [due, deadline] if when is not None))
+            else:
+                timeouts = [when - now for when in [due, deadline] if when is not None]
+                self.condition.wait(min(timeouts) if timeouts else None)
+
+
+class SimulatedSocket:
+    """A socket of a SimulatedNetwork.
+    Instance attributes:
+    incoming, outgoing - the Pipes data is read from and written to, once connected.
+    timeout - None if blocking, 0 if non-blocking, otherwise seconds blocking calls wait for.
+    backlog - connections waiting to be accepted, once listening.
+    reads - number of reads that returned data, to see how fragmented the received messages were.
+    """
+
+    def __init__(self, network, profile=None):
+        self.network = network
+        self.profile = profile if profile is not None else network.profile
+        self.incoming = self.outgoing = None
+        self.timeout = None
+        self.address = None
+        self.backlog = None
+        self.reads = 0
+        self.fd = next(network.fds)
+        self.closed = False
+
+    def link(self, peer):
+        self.outgoing = peer.incoming = Pipe(self.network, self.profile)
+        self.incoming = peer.outgoing = Pipe(self.network, self.profile)
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0.0
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def fileno(self):
+        return -1 if self.closed else self.fd
+
+    def bind(self, address):
+        self.address = address
+
+    def listen(self, backlog=0):
+        with self.network.condition:
+            self.backlog = deque()
+            self.network.listeners[self.address[1]] = self
+
+    def accept(self):
+        with self.network.condition:
+            self.wait(lambda: self.backlog, lambda: None)
+            conn = self.backlog.popleft()
+            return conn, ("simnet", conn.fd)
+
+    def connect(self, address):
+        with self.network.condition:
+            listener = self.network.listeners.get(address[1])
+            if listener is None:
+                raise ConnectionRefusedError(errno.ECONNREFUSED, f"nothing listens on port {address[1]}")
+            conn = SimulatedSocket(self.network, self.profile)
+            self.link(conn)
+            self.address = address
+            listener.backlog.append(conn)
+            self.network.condition.notify_all()
+
+    def send(self, data):
+        with self.network.condition:
+            self.check_open()
+            self.wait(lambda: self.outgoing.space() > 0 or self.outgoing.reader_closed, lambda: None)
+            if self.outgoing.reader_closed:
+                raise BrokenPipeError(errno.EPIPE, "connection closed by peer")
+            sent = self.outgoing.write(data)
+            self.network.condition.notify_all()
+            return sent
+
+    def sendall(self, data):
+        data = memoryview(data)
+        sent = 0
+        while sent < len(data):
+            sent += self.send(data[sent:])
+
+    def recv(self, n):
+        with self.network.condition:
+            self.check_open()
+            self.wait(self.incoming.readable, self.incoming.next_arrival)
+            data = self.incoming.read(n)
+            if data:
+                self.reads += 1
+            self.network.condition.notify_all()
+            return data
+
+    def recv_into(self, buffer, nbytes=0):
+        data = self.recv(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        with self.network.condition:
+            if self.closed:
+                return
+            self.closed = True
+            if self.outgoing:
+                self.outgoing.close()
+            if self.incoming:
+                self.incoming.reader_closed = True
+                self.incoming.segments.clear()
+            if self.backlog is not None:
+                self.network.listeners.pop(self.address[1], None)
+            self.network.condition.notify_all()
+
+    def check_open(self):
+        if self.closed:
+            raise OSError(errno.EBADF, "Bad file descriptor")
+        if self.outgoing is None:
+            raise OSError(errno.ENOTCONN, "Transport endpoint is not connected")
+
+    def wait(self, ready, next_event):
+        """Waits until ready() is true according to the socket's timeout, the condition being held.
+        Raises BlockingIOError if the socket is non-blocking and it isn't ready.
+        """
+        if self.timeout == 0:
+            if not ready():
+                raise BlockingIOError(errno.EAGAIN, "Resource temporarily unavailable")
+            return
+        deadline = self.network.clock() + self.timeout if self.timeout is not None else None
+        self.network.wait(ready, next_event, deadline)
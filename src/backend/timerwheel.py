@@ -0,0 +1,75 @@
+# timerwheel.py
+# Hashed timer wheel - keeps track of many timers (keepalives, idle checks) at a constant cost per tick.
+
+from math import ceil
+from time import monotonic
+
+
+class Timer:
+    """A callback scheduled on a TimerWheel.
+    Instance attributes:
+    rounds - how many more full turns of the wheel to wait before firing.
+    callback, args - called as callback(*args) when the timer fires.
+    cancelled - cancelled timers are dropped without firing when their slot is reached.
+    """
+
+    __slots__ = ("rounds", "callback", "args", "cancelled")
+
+    def __init__(self, rounds, callback, args):
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """A ring of slots, each holding the timers that expire when the wheel's hand reaches it.
+    The hand moves one slot every tick, so scheduling and cancelling are O(1),
+    and a tick only looks at the timers of a single slot.
+    Instance attributes:
+    tick - duration of a slot in seconds, also the resolution of the timers.
+    slots - list of lists of Timer objects.
+    current - index of the slot the hand reaches next.
+    last_tick - time (monotonic) at which the hand last moved.
+    """
+
+    def __init__(self, tick=0.05, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.last_tick = monotonic()
+
+    def schedule(self, delay, callback, *args):
+        """Calls callback(*args) after delay seconds (rounded up to whole ticks).
+        Returns the Timer object, which can be used to cancel the call.
+        """
+        ticks = max(1, ceil(delay / self.tick))
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        timer = Timer(rounds, callback, args)
+        self.slots[(self.current + offset) % len(self.slots)].append(timer)
+        return timer
+
+    def advance(self, now=None):
+        """Moves the hand to the current time, firing every timer that expired on the way.
+        """
+        if now is None:
+            now = monotonic()
+        while now - self.last_tick >= self.tick:
+            self.last_tick += self.tick
+            index = self.current
+            self.current = (self.current + 1) % len(self.slots)
+            slot, self.slots[index] = self.slots[index], []
+            for timer in slot:
+                if timer.cancelled:
+                    continue
+                if timer.rounds:
+                    timer.rounds -= 1
+                    self.slots[index].append(timer)
+                else:
+                    timer.callback(*timer.args)
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
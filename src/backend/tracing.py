@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# tracing.py
+# Per-message traces of the server: how long each stage took from receiving a message
+# until its last copy was written to a recipient's socket.
+# Summarize trace files with: python tracing.py summarize traces.jsonl [more.jsonl ...]
+
+import sys
+import json
+import random
+import time
+from collections import deque
+
+
+class Trace:
+    """Timestamps of a single inbound message going through the server.
+    Instance attributes:
+    trace_id - random hex id of the trace.
+    start - wall-clock time the message was received.
+    stages - dict of stage name ('decrypt', 'decode', 'handle') to milliseconds since the message was received.
+    fanout - list of {'member': recipient, 'encrypt': ms, 'write': ms}: when each copy was encrypted and written.
+    pending - number of copies not written yet.
+    """
+
+    __slots__ = ("trace_id", "member", "datatype", "start", "t0", "stages", "fanout", "pending", "finished")
+
+    def __init__(self, member, start, t0):
+        self.trace_id = f"{random.getrandbits(64):016x}"
+        self.member = member
+        self.datatype = None
+        self.start = start
+        self.t0 = t0  # perf_counter() at receive time
+        self.stages = {}
+        self.fanout = []
+        self.pending = 0
+        self.finished = False
+
+    def elapsed(self):
+        return round((time.perf_counter() - self.t0) * 1000, 4)
+
+    def mark(self, stage):
+        self.stages[stage] = self.elapsed()
+
+    def mark_encrypted(self, recipient):
+        """Records that a copy for recipient was encrypted, returns the copy's record.
+        """
+        copy = {"member": recipient, "encrypt": self.elapsed()}
+        self.fanout.append(copy)
+        self.pending += 1
+        return copy
+
+    def mark_written(self, copy):
+        copy["write"] = self.elapsed()
+        self.pending -= 1
+
+    def to_dict(self):
+        return {"trace_id": self.trace_id, "member": self.member, "type": self.datatype, "start": self.start,
+                "stages": self.stages, "fanout": self.fanout}
+
+
+class Tracer:
+    """Samples inbound messages for tracing.
+    Finished traces are kept in a ring buffer, and appended to a JSONL file if a path is given.
+    Instance attributes:
+    sample_rate - fraction of the messages that are traced.
+    traces - deque of the most recent finished traces (as dicts).
+    size - bytes held by the dicts of traces, kept as traces are added.
+    """
+
+    RING_SIZE = 1000
+
+    def __init__(self, sample_rate=0.01, path=None):
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=Tracer.RING_SIZE)
+        self.size = 0
+        self.file = open(path, "a") if path else None
+
+    def begin(self, member):
+        """Returns a new Trace for a message just received from member, or None if the message isn't sampled.
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return Trace(member, time.time(), time.perf_counter())
+
+    def finish(self, trace):
+        """Stores a trace, once it is complete or timed out.
+        """
+        if trace.finished:
+            return
+        trace.finished = True
+        record = trace.to_dict()
+        if len(self.traces) == self.traces.maxlen:
+            self.size -= sys.getsizeof(self.traces[0])
+        self.traces.append(record)
+        self.size += sys.getsizeof(record)
+        if self.file:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+
+def summarize(records):
+    """Returns a dict of stage to the list of its durations (ms) in the given trace records.
+    Stages are the time between consecutive server stages, the time to encrypt and to write each copy,
+    and 'total': from receiving the message until its last copy was written.
+    """
+    durations = {}
+    for record in records:
+        previous = 0
+        for index, (stage, at) in enumerate(record["stages"].items()):
+            durations.setdefault(stage if index else f"recv->{stage}", []).append(at - previous)
+            previous = at
+        writes = []
+        for times in record["fanout"]:
+            durations.setdefault("encrypt (from recv)", []).append(times["encrypt"])
+            if "write" in times:
+                durations.setdefault("queued (encrypt->write)", []).append(times["write"] - times["encrypt"])
+                writes.append(times["write"])
+        if writes:
+            durations.setdefault("total (recv->last write)", []).append(max(writes))
+    return durations
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(percent / 100 * len(values)))]
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] != "summarize":
+        print("usage: tracing.py summarize TRACE_FILE [TRACE_FILE ...]")
+        sys.exit(1)
+    records = []
+    for path in sys.argv[2:]:
+        with open(path) as file:
+            records += [json.loads(line) for line in file if line.strip()]
+    print(f"{len(records)} traces")
+    print(f"{'stage':<28}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, values in summarize(records).items():
+        print(f"{stage:<28}{len(values):>8}{percentile(values, 50):>10.3f}{percentile(values, 90):>10.3f}"
+              f"{percentile(values, 99):>10.3f}{max(values):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
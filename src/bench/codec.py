@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# codec.py
+# Microbenchmarks of the wire format and its encryption (backend/cpp.py):
+# encoding and decoding every message type, sending over a socket pair, reading fragmented input and AES sealing.
+# Run from src/: python -m bench.codec [--save baseline.json] [--compare baseline.json]
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tracemalloc
+from uuid import uuid4
+from backend import cpp
+
+
+#########################
+TARGET_TIME = 0.2  # seconds each timing run lasts
+REPEAT = 5  # timing runs per benchmark, the fastest one is reported
+REGRESSION_THRESHOLD = 0.15  # default slowdown reported as a regression when comparing to a baseline
+SEAL_SIZES = [32, 1024, 64 * 1024, 1024 * 1024]
+#########################
+
+
+class FragmentedSocket:
+    """Stands in for a socket whose data arrives in pieces of at most fragment bytes, as it does over a real network.
+    """
+
+    def __init__(self, data, fragment):
+        self.data = data
+        self.fragment = fragment
+        self.position = 0
+
+    def recv(self, n):
+        chunk = self.data[self.position:self.position + min(n, self.fragment)]
+        self.position += len(chunk)
+        return chunk
+
+    def rewind(self):
+        self.position = 0
+
+
+def sample_messages():
+    """Returns a list of (name, message) with one message of every type.
+    """
+    file_id = uuid4()
+    return [("MSG", "hello there, how is everyone doing today?"),
+            ("BYTES 1K", os.urandom(1024)),
+            ("SERVERMSG", cpp.ServerMsg("hello there, how is everyone doing today?", name="Alice")),
+            ("CMD_LIST", cpp.Cmd(cpp.DataType.CMD_LIST.value)),
+            ("CMD_TELL", cpp.Cmd(cpp.DataType.CMD_TELL.value, "Bob", "see you at eight")),
+            ("FILE_ATTACH_SEND", cpp.FileAttachSend("holiday.jpg", file_id)),
+            ("FILE_ATTACH_RECV", cpp.FileAttachRecv("holiday.jpg", "Alice", file_id)),
+            ("SEQUENCED", cpp.Sequenced(1234, 5678, cpp.ServerMsg("hello there", name="Alice"))),
+            ("RESUME", cpp.Resume(1234, 5678)),
+            ("PING", cpp.Ping()),
+            ("PONG", cpp.Pong(time.time())),
+            ("LIMITS", cpp.Limits(cpp.MAX_DATA_SIZES)),
+            ("PING_REPLY", cpp.PingReply("17", time.time(), time.time(), time.time())),
+            ("IN_ROOM", cpp.InRoom("general", "hello there, how is everyone doing today?")),
+            ("FILE_PART 64K", cpp.FilePart(file_id, 0, 1024 * 1024, os.urandom(64 * 1024))),
+            ("FILE_ACK", cpp.FileAck(file_id, 64 * 1024)),
+            ("FILE_REQUEST", cpp.FileRequest(file_id)),
+            ("FILE_INFO", cpp.FileInfo(file_id, 1024 * 1024, os.urandom(32)))]
+
+
+def benchmarks():
+    """Returns a list of (name, function, payload bytes per call) to measure.
+    """
+    aeskey = os.urandom(16)
+    result = []
+    for name, cpp_msg in sample_messages():
+        encoded = cpp.encode(cpp_msg)
+        datatype, data = encoded[0], encoded[5:]
+        result.append((f"encode {name}", lambda cpp_msg=cpp_msg: cpp.encode(cpp_msg), len(encoded)))
+        result.append((f"decode {name}", lambda datatype=datatype, data=data: cpp.construct_cpp_msg(datatype, data), len(encoded)))
+
+    for size in SEAL_SIZES:
+        plaintext = cpp.encode(os.urandom(size))
+        frame = cpp.encrypt(aeskey, plaintext)
+        nonce, tag, ciphertext = frame[4:20], frame[20:36], frame[36:]
+        result.append((f"seal {format_size(size)}", lambda plaintext=plaintext: cpp.encrypt(aeskey, plaintext), size))
+        result.append((f"open {format_size(size)}", lambda nonce=nonce, tag=tag, ciphertext=ciphertext:
+                       cpp.sdecrypt(aeskey, nonce, tag, ciphertext), size))
+
+    for fragment in [1460, 64]:  # a TCP segment, and a badly fragmented stream
+        sock = FragmentedSocket(os.urandom(64 * 1024), fragment)
+
+        def recvn(sock=sock):
+            sock.rewind()
+            cpp._recvn(sock, len(sock.data))
+        result.append((f"_recvn 64K in {fragment} B pieces", recvn, 64 * 1024))
+
+    for name, cpp_msg in [("MSG", "hello there, how is everyone doing today?"), ("BYTES 64K", os.urandom(64 * 1024))]:
+        sender, receiver = socket.socketpair()
+        sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+
+        def roundtrip(cpp_msg=cpp_msg, sender=sender, receiver=receiver):
+            cpp.ssend(sender, aeskey, cpp_msg)
+            cpp.srecv(receiver, aeskey)
+        result.append((f"ssend+srecv {name}", roundtrip, len(cpp.encode(cpp_msg))))
+    return result
+
+
+def format_size(size):
+    return f"{size // 1024 ** 2}M" if size >= 1024 ** 2 else f"{size // 1024}K" if size >= 1024 else f"{size}B"
+
+
+def measure(function):
+    """Returns the fastest time (ns) a call of function took, over REPEAT runs of about TARGET_TIME seconds each,
+    and the bytes it allocated at its peak (the temporary buffers a call needs).
+    """
+    loops = 1
+    while True:  # find how many calls take about TARGET_TIME
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= TARGET_TIME / 10:
+            break
+        loops *= 10
+    loops = max(1, int(loops * TARGET_TIME / elapsed))
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        best = min(best, (time.perf_counter() - start) / loops)
+
+    tracemalloc.start()
+    function()  # warm up caches, so only the memory the call itself needs is counted
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    function()
+    allocated = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return best * 1e9, allocated
+
+
+def run(name_filter=None):
+    """Runs the benchmarks whose name contains name_filter, printing each result as it is measured.
+    Returns a dict of benchmark name to {'ns_per_op', 'mb_per_s', 'alloc_bytes_per_op'}.
+    """
+    results = {}
+    print(f"{'benchmark':<36}{'ns/op':>14}{'MB/s':>10}{'alloc B/op':>12}")
+    for name, function, size in benchmarks():
+        if name_filter and name_filter not in name:
+            continue
+        ns, allocated = measure(function)
+        results[name] = {"ns_per_op": round(ns, 1), "mb_per_s": round(size / ns * 1e9 / 2 ** 20, 1),
+                         "alloc_bytes_per_op": allocated}
+        print(f"{name:<36}{ns:>14,.0f}{results[name]['mb_per_s']:>10,.1f}{allocated:>12,}")
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Prints how each benchmark changed from the baseline.
+    Returns the names of the ones that became slower by more than threshold (a fraction).
+    """
+    regressions = []
+    print(f"\n{'benchmark':<36}{'baseline ns':>14}{'ns/op':>14}{'change':>9}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]["ns_per_op"], result["ns_per_op"]
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<36}{before:>14,.0f}{after:>14,.0f}{change:>+9.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the chat protocol's encoding and encryption.")
+    parser.add_argument("--filter", help="only run the benchmarks whose name contains this text")
+    parser.add_argument("--save", help="save the results to this JSON file, to compare later runs against")
+    parser.add_argument("--compare", help="compare the results to a saved JSON file, exit with 1 if any regressed")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help=f"slowdown counted as a regression (default {REGRESSION_THRESHOLD})")
+    args = parser.parse_args()
+    results = run(args.filter)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"python": sys.version.split()[0], "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "results": results}, file, indent=2)
+        print(f"Results saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
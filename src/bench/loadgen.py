@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+# loadgen.py
+# Headless load generator: connects many bots to a chat server, makes them chat under a configurable mix
+# of traffic, and reports latency, throughput and the server's CPU and memory usage.
+# Run from src/: python -m bench.loadgen --bots 200 --duration 30
+# Results are saved as JSON so runs of different versions can be compared.
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from uuid import uuid4
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_OAEP
+from backend import cpp
+from backend.metrics import Histogram
+
+
+#########################
+DEFAULT_MIX = "chat=0.85,tell=0.1,list=0.04,file=0.01"
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend", "server.py")
+#########################
+
+
+class Stats:
+    """What the bots of one process measured. Latencies are in seconds.
+    Instance attributes:
+    latencies - dict of kind to Histogram: 'handshake', 'chat' (every copy of a broadcast),
+                'tell' (both copies of a private message), 'list' (/list round trip) and 'file' (upload then download).
+    fanout - dict of chat message id to the latency of its latest copy received so far.
+    sent - dict of action to the number of times it was performed.
+    received - number of bench messages received, received_bytes - bytes of everything received.
+    connected, failed - bots that joined the chat, and ones that were refused or could not connect.
+    throttled - rate-limit notices received, disconnected - bots whose connection was closed by the server.
+    """
+
+    def __init__(self):
+        self.latencies = {kind: Histogram() for kind in ["handshake", "chat", "tell", "list", "file"]}
+        self.fanout = {}
+        self.sent = {}
+        self.received = 0
+        self.received_bytes = 0
+        self.connected = 0
+        self.failed = 0
+        self.throttled = 0
+        self.disconnected = 0
+
+    def merge(self, other):
+        for kind, histogram in other.latencies.items():
+            self.latencies[kind].merge(histogram)
+        for msg_id, latency in other.fanout.items():
+            self.fanout[msg_id] = max(latency, self.fanout.get(msg_id, 0))
+        for action, count in other.sent.items():
+            self.sent[action] = self.sent.get(action, 0) + count
+        for counter in ["received", "received_bytes", "connected", "failed", "throttled", "disconnected"]:
+            setattr(self, counter, getattr(self, counter) + getattr(other, counter))
+
+
+class Bot:
+    """A headless chat member speaking the same protocol as backend.client.Client, over asyncio streams.
+    Instance attributes:
+    name - the bot's name in the chat.
+    peers - names of the other bots, the recipients of its private messages.
+    stats - (instance of Stats) shared by the bots of the process.
+    measuring - dict whose 'on' flag is set while latencies should be recorded (shared by the bots of the process).
+    list_requests - send times of the /list requests not answered yet.
+    uploads - dict of file id to the time its upload started, until its download completes.
+    """
+
+    FILE_CHUNK_SIZE = 64 * 1024
+    HANDSHAKE_TIMEOUT = 60  # seconds, the server accepts members one at a time
+
+    def __init__(self, name, peers, privkey, stats, measuring, args):
+        self.name = name
+        self.peers = peers
+        self.privkey = privkey
+        self.stats = stats
+        self.measuring = measuring
+        self.args = args
+        self.aeskey = None
+        self.reader = self.writer = None
+        self.counter = 0
+        self.list_requests = []
+        self.uploads = {}
+
+    async def connect(self, host, port):
+        """Joins the chat. Returns whether the server accepted the bot.
+        """
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(self.handshake(host, port), self.HANDSHAKE_TIMEOUT)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            self.stats.failed += 1
+            return False
+        if type(response) is not bytes:  # refused, with a ServerMsg explaining why
+            self.stats.failed += 1
+            self.writer.close()
+            return False
+        self.aeskey = PKCS1_OAEP.new(self.privkey).decrypt(response)
+        self.stats.connected += 1
+        self.stats.latencies["handshake"].record(time.perf_counter() - start)
+        return True
+
+    async def handshake(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(cpp.encode(self.name) + cpp.encode(self.privkey.public_key().export_key().decode()))
+        datatype, datasize = struct.unpack('>BI', await self.reader.readexactly(5))
+        return cpp.construct_cpp_msg(datatype, await self.reader.readexactly(datasize))
+
+    def send(self, cpp_msg):
+        self.writer.write(cpp.seal(self.aeskey, cpp_msg))
+
+    async def receive(self):
+        """Handles the messages from the server until the connection is closed.
+        """
+        try:
+            while True:
+                raw_datasize = await self.reader.readexactly(4)
+                body = await self.reader.readexactly(struct.unpack('>I', raw_datasize)[0])
+                self.stats.received_bytes += 4 + len(body)
+                datatype, data = cpp.sdecrypt(self.aeskey, body[:16], body[16:32], body[32:])
+                self.handle(cpp.construct_cpp_msg(datatype, data))
+        except (OSError, asyncio.IncompleteReadError, cpp.FrameError):
+            self.stats.disconnected += 1
+
+    def handle(self, cpp_msg):
+        now = time.time()
+        if type(cpp_msg) is cpp.Sequenced:
+            cpp_msg = cpp_msg.msg
+        if type(cpp_msg) is cpp.Ping:
+            self.send(cpp.Pong(cpp_msg.stamp))
+        elif type(cpp_msg) is cpp.FilePart:
+            if cpp_msg.file_id in self.uploads and cpp_msg.offset + len(cpp_msg.data) == cpp_msg.total:
+                self.record("file", now - self.uploads.pop(cpp_msg.file_id))
+        elif type(cpp_msg) is cpp.ServerMsg:
+            text = cpp_msg.msg
+            if "bench " in text:
+                _, msg_id, stamp = text[text.index("bench "):].split(" ", 3)[:3]
+                latency = now - float(stamp)
+                if cpp_msg.name:  # a broadcast chat message
+                    self.record("chat", latency)
+                    if self.measuring["on"]:
+                        self.stats.fanout[msg_id] = max(latency, self.stats.fanout.get(msg_id, 0))
+                else:
+                    self.record("tell", latency)
+            elif "<u>Online Users</u>" in text and self.list_requests:
+                self.record("list", now - self.list_requests.pop(0))
+            elif "sending too fast" in text:
+                self.stats.throttled += 1
+
+    def record(self, kind, latency):
+        if self.measuring["on"]:
+            self.stats.received += 1
+            self.stats.latencies[kind].record(latency)
+
+    def bench_text(self):
+        """Returns the text of a chat message carrying its id and send time, padded to the configured size.
+        """
+        self.counter += 1
+        text = f"bench {self.name}.{self.counter} {time.time():.6f} "
+        return text + "x" * max(0, self.args.msg_size - len(text))
+
+    async def run(self, actions, weights, until):
+        """Performs random actions at random (Poisson) intervals until the time until.
+        """
+        while True:
+            await asyncio.sleep(random.expovariate(self.args.rate))
+            if time.time() >= until or self.writer.is_closing():
+                return
+            action = random.choices(actions, weights)[0]
+            self.stats.sent[action] = self.stats.sent.get(action, 0) + 1
+            if action == "chat":
+                self.send(self.bench_text())
+            elif action == "tell":
+                self.send(cpp.Cmd(cpp.DataType.CMD_TELL.value, random.choice(self.peers), self.bench_text()))
+            elif action == "list":
+                self.list_requests.append(time.time())
+                self.send(cpp.Cmd(cpp.DataType.CMD_LIST.value))
+            elif action == "file":
+                await self.upload()
+            await self.writer.drain()
+
+    async def upload(self):
+        """Uploads a file of random bytes, then requests it back. Its latency is measured once the download completes.
+        """
+        file_id = uuid4()
+        self.uploads[file_id] = time.time()
+        data = os.urandom(self.args.file_size)
+        for offset in range(0, len(data), self.FILE_CHUNK_SIZE):
+            self.send(cpp.FilePart(file_id, offset, len(data), data[offset:offset + self.FILE_CHUNK_SIZE]))
+            await self.writer.drain()
+        self.send(cpp.FileRequest(file_id))
+
+
+async def run_bots(index, names, args, ready, go, results):
+    """Runs the bots of one process: connects them, waits for every process to be ready,
+    makes them chat for the duration of the benchmark, and puts the process's Stats in results.
+    """
+    privkey = RSA.generate(1024)  # the server only uses it to send the session key, so bots share it
+    stats = Stats()
+    measuring = {"on": False}
+    mix = parse_mix(args.mix)
+    actions, weights = list(mix), list(mix.values())
+    peers = [f"bot{i}" for i in range(args.bots)]
+    bots = [Bot(name, peers, privkey, stats, measuring, args) for name in names]
+    connecting = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(bot):
+        async with connecting:
+            return await bot.connect(args.host, args.port)
+
+    joined = await asyncio.gather(*(connect(bot) for bot in bots))
+    bots = [bot for bot, ok in zip(bots, joined) if ok]
+    receivers = [asyncio.ensure_future(bot.receive()) for bot in bots]
+    ready.put(index)
+    loop = asyncio.get_running_loop()
+    until = await loop.run_in_executor(None, go.get)
+    measuring["on"] = True
+    await asyncio.gather(*(bot.run(actions, weights, until) for bot in bots))
+    await asyncio.sleep(max(0, until + args.drain - time.time()))  # let the last messages arrive
+    measuring["on"] = False
+    results.put(stats)
+    for bot in bots:
+        bot.writer.close()
+    for receiver in receivers:
+        receiver.cancel()
+
+
+def worker(index, names, args, ready, go, results):
+    asyncio.run(run_bots(index, names, args, ready, go, results))
+
+
+def parse_mix(mix):
+    """Parses a traffic mix such as 'chat=0.8,tell=0.2' into a dict of action to weight.
+    """
+    weights = {}
+    for part in mix.split(","):
+        action, weight = part.split("=")
+        if action not in ["chat", "tell", "list", "file"]:
+            raise argparse.ArgumentTypeError(f"unknown action '{action}'")
+        weights[action] = float(weight)
+    return weights
+
+
+class ProcessMonitor:
+    """Samples the CPU time and resident memory of a process from /proc (Linux only) in a background thread.
+    Instance attributes:
+    peak_rss - largest resident set size seen, in bytes.
+    """
+
+    INTERVAL = 0.5
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self.running = False
+
+    def available(self):
+        return self.pid is not None and os.path.exists(f"/proc/{self.pid}/stat")
+
+    def cpu_time(self):
+        with open(f"/proc/{self.pid}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")  # utime + stime
+
+    def rss(self):
+        with open(f"/proc/{self.pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.sample, daemon=True).start()
+
+    def sample(self):
+        while self.running:
+            try:
+                self.peak_rss = max(self.peak_rss, self.rss())
+            except OSError:  # the process has exited
+                return
+            time.sleep(self.INTERVAL)
+
+
+def start_server(port):
+    """Starts a server in a temporary directory (its uploads are written there). Returns the server process.
+    """
+    directory = tempfile.mkdtemp(prefix="chat-bench-")
+    process = subprocess.Popen([sys.executable, "-u", SERVER_SCRIPT, str(port)], cwd=directory,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    # Probing the port would add a member that never completes the handshake, so wait for the server's banner:
+    if not process.stdout.readline().startswith("Running chat server"):
+        process.kill()
+        raise RuntimeError("the server did not start")
+    threading.Thread(target=process.stdout.read, daemon=True).start()  # keep its output from filling the pipe
+    time.sleep(0.2)  # until it listens
+    return process
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def summary(histogram):
+    """Returns the count and the p50/p99/p999/max latencies (in ms) of a histogram.
+    """
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {"count": histogram.count, "p50": ms(histogram.percentile(50)), "p99": ms(histogram.percentile(99)),
+            "p999": ms(histogram.percentile(99.9)), "max": ms(histogram.max)}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(SERVER_SCRIPT)).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def report(args, stats, server):
+    """Returns the results of the run as a dict, ready to be saved as JSON.
+    """
+    fanout = Histogram()
+    for latency in stats.fanout.values():
+        fanout.record(latency)
+    latencies = {kind: summary(histogram) for kind, histogram in stats.latencies.items()}
+    latencies["chat_fanout"] = summary(fanout)  # until the last copy of a message was received
+    expected = stats.sent.get("chat", 0) * stats.connected  # every member, the sender included, gets a copy
+    return {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "bots": {"requested": args.bots, "connected": stats.connected, "failed": stats.failed,
+                 "disconnected": stats.disconnected},
+        "sent": stats.sent,
+        "throttled": stats.throttled,
+        "latency_ms": latencies,
+        "throughput": {"sent_per_second": round(sum(stats.sent.values()) / args.duration, 1),
+                       "received_per_second": round(stats.received / args.duration, 1),
+                       "received_bytes_per_second": round(stats.received_bytes / args.duration),
+                       "chat_delivered": round(stats.latencies["chat"].count / expected, 4) if expected else None},
+        "server": server,
+    }
+
+
+def print_report(result):
+    bots = result["bots"]
+    print(f"{bots['connected']}/{bots['requested']} bots connected, {bots['failed']} failed, "
+          f"{bots['disconnected']} disconnected, {result['throttled']} throttle notices")
+    print(f"{'latency':<14}{'count':>9}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'max ms':>10}")
+    for kind, latency in result["latency_ms"].items():
+        if latency["count"]:
+            print(f"{kind:<14}{latency['count']:>9}{latency['p50']:>10.2f}{latency['p99']:>10.2f}"
+                  f"{latency['p999']:>10.2f}{latency['max']:>10.2f}")
+    throughput = result["throughput"]
+    print(f"sent {throughput['sent_per_second']}/s, received {throughput['received_per_second']}/s "
+          f"({throughput['received_bytes_per_second'] / 1024:.1f} KB/s)")
+    if throughput["chat_delivered"] is not None:
+        print(f"{throughput['chat_delivered']:.1%} of the chat copies arrived within the run")
+    server = result["server"]
+    if server:
+        print(f"server: {server['cpu_percent']}% CPU, {server['rss_mb']} MB RSS (peak {server['peak_rss_mb']} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test a chat server with headless bots.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="port of a running server (default: start a local one)")
+    parser.add_argument("--server-pid", type=int, help="pid of the running server, to measure its CPU and memory")
+    parser.add_argument("--bots", type=int, default=50, help="number of bots (default 50)")
+    parser.add_argument("--processes", type=int, default=1, help="processes the bots are spread over (default 1)")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of measured traffic (default 20)")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for the last messages (default 2)")
+    parser.add_argument("--rate", type=float, default=1, help="actions per second of each bot (default 1)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"weights of the actions (default {DEFAULT_MIX})")
+    parser.add_argument("--msg-size", type=int, default=64, help="bytes of each chat message (default 64)")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="bytes of each uploaded file (default 256K)")
+    parser.add_argument("--connect-concurrency", type=int, default=8, help="handshakes in flight per process (default 8)")
+    parser.add_argument("--output", help="JSON file to save the results to (default bench-results/loadgen-<time>.json)")
+    args = parser.parse_args()
+    parse_mix(args.mix)
+
+    server_process = None
+    if args.port is None:
+        args.port = free_port()
+        server_process = start_server(args.port)
+        args.server_pid = server_process.pid
+    monitor = ProcessMonitor(args.server_pid)
+    try:
+        ready, go, results = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Queue()
+        names = [f"bot{i}" for i in range(args.bots)]
+        processes = [multiprocessing.Process(target=worker, args=(index, names[index::args.processes], args, ready, go, results))
+                     for index in range(args.processes)]
+        for process in processes:
+            process.start()
+        print(f"Connecting {args.bots} bots to port {args.port}...")
+        start = time.time()
+        for _ in processes:
+            ready.get()
+        print(f"Connected in {time.time() - start:.1f}s, running for {args.duration}s...")
+        if monitor.available():
+            monitor.start()
+            cpu_start = monitor.cpu_time()
+        until = time.time() + args.duration
+        for _ in processes:
+            go.put(until)
+        stats = Stats()
+        for _ in processes:
+            stats.merge(results.get())
+        server = None
+        if monitor.available():
+            cpu = monitor.cpu_time() - cpu_start
+            server = {"cpu_percent": round(cpu / (args.duration + args.drain) * 100, 1),
+                      "rss_mb": round(monitor.rss() / 2 ** 20, 1), "peak_rss_mb": round(monitor.peak_rss / 2 ** 20, 1)}
+        for process in processes:
+            process.join()
+    finally:
+        monitor.running = False
+        if server_process:
+            server_process.kill()
+
+    result = report(args, stats, server)
+    print_report(result)
+    output = args.output or time.strftime("bench-results/loadgen-%Y%m%d-%H%M%S.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(result, file, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# render.py
+# Time to render a message of the chat, headless: formatting its rich text (frontend/ui/render.py), and laying out
+# and painting its bubble with the message list's MessageDelegate, for each kind of message.
+# Also the bytes a message typed by a member takes on the wire, as the protocol's markup and as the full HTML
+# document Qt makes of the message input.
+# "new" is a message shown for the first time (laid out, then painted), "repaint" one painted again as the list is
+# scrolled or updated, and "layout" one laid out again for a new width.
+# Run from src/: python -m bench.render [--save baseline.json] [--compare baseline.json]
+
+import os
+import sys
+import json
+import time
+import argparse
+from uuid import uuid4
+from PyQt5 import QtWidgets, QtGui, QtCore
+from backend import cpp
+from bench.codec import measure, compare, REGRESSION_THRESHOLD
+from frontend.ui.chat_ui import ChatUi
+from frontend.ui.message_list import MsgType, ChatMessage, MessageModel, MessageDelegate
+from frontend.ui.render import render, to_markup
+
+
+#########################
+LIST_WIDTH = 600  # width of the message list the messages are painted in
+#########################
+
+
+def typed_messages():
+    """Returns a list of (name, QTextDocument) with messages as typed (or pasted) in the message input.
+    """
+    result = []
+    for name, text in [("short", "ok"), ("sentence", "hello there, how is everyone doing today?"),
+                       ("rich", "<b>Meeting moved</b> to <i>Thursday</i>, 3pm.<br>Bring the figures for the second "
+                                "quarter, and the slides from last week if anyone still has them.")]:
+        document = QtGui.QTextDocument()
+        document.setHtml(text)
+        result.append((name, document))
+    return result
+
+
+def sample_messages():
+    """Returns a list of (name, MsgType, message) with a cpp.ServerMsg as clients send them, or a cpp.FileAttachRecv.
+    """
+    typed = {name: to_markup(document) for name, document in typed_messages()}
+    return [("SELF short", MsgType.SELF, cpp.ServerMsg(typed["short"], name="Alice")),
+            ("OTHER short", MsgType.OTHER, cpp.ServerMsg(typed["short"], name="Bob")),
+            ("OTHER rich", MsgType.OTHER, cpp.ServerMsg(typed["rich"], name="Bob")),
+            ("SERVER", MsgType.SERVER, cpp.ServerMsg("<b>#general</b> Carol joined the room.")),
+            ("ATTACHMENT", MsgType.OTHER, cpp.FileAttachRecv("quarterly report.pdf", "Bob", uuid4()))]
+
+
+def wire_sizes():
+    """Prints the bytes of the messages typed by members as sent in a room (an IN_ROOM frame, encrypted),
+    as markup and as Qt's HTML. Returns a dict of message name to {'html_bytes', 'markup_bytes'}.
+    """
+    results = {}
+    print(f"{'message':<12}{'Qt HTML B':>12}{'markup B':>12}{'ratio':>8}")
+    for name, document in typed_messages():
+        html, markup = (len(cpp.encrypt(bytes(16), cpp.encode(cpp.InRoom("general", text))))
+                        for text in [document.toHtml(), to_markup(document)])
+        results[name] = {"html_bytes": html, "markup_bytes": markup}
+        print(f"{name:<12}{html:>12,}{markup:>12,}{html / markup:>8.1f}")
+    print()
+    return results
+
+
+def benchmarks(painter):
+    """Returns a list of (name, function, payload bytes per call) to measure, painting with painter.
+    """
+    delegate = MessageDelegate({MsgType.SELF: ChatUi.SELF_COLOR, MsgType.OTHER: ChatUi.OTHER_COLOR,
+                                MsgType.SERVER: ChatUi.SERVER_COLOR})
+    delegate.resize(LIST_WIDTH)
+    model = MessageModel()
+    option = QtWidgets.QStyleOptionViewItem()
+    option.rect = QtCore.QRect(0, 0, LIST_WIDTH, painter.device().height())
+    result = []
+    for name, msgtype, cpp_msg in sample_messages():
+        if type(cpp_msg) is cpp.ServerMsg:
+            html = render(msgtype, cpp_msg)
+            result.append((f"format {name}", lambda msgtype=msgtype, cpp_msg=cpp_msg: render(msgtype, cpp_msg),
+                           len(html)))
+            message = ChatMessage(msgtype, html)
+        else:
+            message = ChatMessage(msgtype, attachment=cpp_msg)
+        model.messages.append(message)
+        index = model.index(len(model.messages) - 1, 0)
+        size = len(message.html or message.attachment.filename)
+
+        def paint_new(message=message, index=index):
+            model.messages[index.row()] = ChatMessage(message.msgtype, message.html, message.attachment)
+            delegate.paint(painter, option, index)
+
+        def layout(message=message):
+            message.layout_width = None
+            delegate.layout(message)
+        result.append((f"new {name}", paint_new, size))
+        result.append((f"repaint {name}", lambda index=index: delegate.paint(painter, option, index), size))
+        result.append((f"layout {name}", layout, size))
+    return result
+
+
+def run(name_filter=None):
+    """Runs the benchmarks whose name contains name_filter, printing each result as it is measured.
+    Returns a dict of benchmark name to {'ns_per_op', 'us_per_op', 'alloc_bytes_per_op'}.
+    """
+    results = {}
+    image = QtGui.QImage(LIST_WIDTH, 400, QtGui.QImage.Format_ARGB32_Premultiplied)
+    painter = QtGui.QPainter(image)
+    print(f"{'benchmark':<36}{'ns/op':>14}{'us/op':>10}{'alloc B/op':>12}")
+    for name, function, size in benchmarks(painter):
+        if name_filter and name_filter not in name:
+            continue
+        ns, allocated = measure(function)
+        results[name] = {"ns_per_op": round(ns, 1), "us_per_op": round(ns / 1000, 1), "alloc_bytes_per_op": allocated}
+        print(f"{name:<36}{ns:>14,.0f}{ns / 1000:>10,.1f}{allocated:>12,}")
+    painter.end()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-message render time of the chat's message list.")
+    parser.add_argument("--filter", help="only run the benchmarks whose name contains this text")
+    parser.add_argument("--save", help="save the results to this JSON file, to compare later runs against")
+    parser.add_argument("--compare", help="compare the results to a saved JSON file, exit with 1 if any regressed")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help=f"slowdown counted as a regression (default {REGRESSION_THRESHOLD})")
+    args = parser.parse_args()
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    app = QtWidgets.QApplication(sys.argv)
+    sizes = wire_sizes()
+    results = run(args.filter)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"python": sys.version.split()[0], "qt": QtCore.QT_VERSION_STR,
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "wire_sizes": sizes, "results": results},
+                      file, indent=2)
+        print(f"Results saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
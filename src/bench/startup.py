@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# startup.py
+# Time to first meaningful paint of the chat window (the first paint showing messages), and until it is connected,
+# with an empty message cache (cold) and with a cache of earlier messages (warm), against a local server.
+# The window is drawn offscreen unless --show is given.
+# Run from src/: python -m bench.startup [--messages 10000] [--runs 5]
+
+import os
+import json
+import time
+import socket
+import argparse
+import tempfile
+import statistics
+from bench.loadgen import start_server, free_port
+from frontend.ui import message_store
+from frontend.ui.message_list import MsgType, ChatMessage
+from frontend.windows.chat_window import ChatWindow
+
+
+class BenchWindow(ChatWindow):
+    """A ChatWindow that closes once it has painted messages and connected.
+    """
+
+    def first_painted(self):
+        super().first_painted()
+        self.close_when_started()
+
+    def connected(self, client):
+        super().connected(client)
+        self.close_when_started()
+
+    def close_when_started(self):
+        if "first_paint" in self.timings and "connected" in self.timings:
+            self.close()
+
+
+def fill_cache(path, count):
+    """Stores count earlier messages in the cache at path.
+    """
+    store = message_store.MessageStore(path)
+    messages = [ChatMessage(MsgType.OTHER, f"<p><span style='color:#1f6f8b;'>someone</span></p>"
+                                           f"<p>cached message {number}, written before this launch</p>")
+                for number in range(count)]
+    store.append(messages)
+    store.close()
+
+
+def run(name, ip, port):
+    """Opens a chat window and returns its timings.
+    """
+    window = BenchWindow(args={"name": name, "ip": ip, "port": port})
+    window.exec()
+    if window.recv_thread is not None:  # leave the server
+        window.client.srv_soc.shutdown(socket.SHUT_RDWR)
+    if "refusal" in window.data:
+        raise RuntimeError(window.data["refusal"])
+    return window.timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the chat window's time to first meaningful paint.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="port of a running server (default: start a local one)")
+    parser.add_argument("--messages", type=int, default=10000, help="messages in the warm cache (default 10000)")
+    parser.add_argument("--runs", type=int, default=5, help="launches of each case (default 5)")
+    parser.add_argument("--show", action="store_true", help="draw the window on screen")
+    parser.add_argument("--output", help="JSON file to save the results to (default bench-results/startup-<time>.json)")
+    args = parser.parse_args()
+    if not args.show:
+        os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    message_store.CACHE_DIR = tempfile.mkdtemp(prefix="chat-bench-cache-")
+
+    server = None
+    if args.port is None:
+        args.port = free_port()
+        server = start_server(args.port)
+    results = {}
+    try:
+        for case in ["cold", "warm"]:
+            timings = []
+            for index in range(args.runs):
+                name = f"{case}{index}"
+                if case == "warm":
+                    fill_cache(message_store.cache_path(args.host, args.port, name), args.messages)
+                timings.append(run(name, args.host, args.port))
+            results[case] = {milestone: {"median": round(statistics.median(timing[milestone] for timing in timings), 1),
+                                         "max": round(max(timing[milestone] for timing in timings), 1)}
+                             for milestone in ["first_paint", "connected"]}
+    finally:
+        if server is not None:
+            server.kill()
+
+    print()
+    print(f"{'case':<8}{'first paint (ms)':>20}{'connected (ms)':>20}")
+    for case, result in results.items():
+        paint, connected = result["first_paint"], result["connected"]
+        print(f"{case:<8}{paint['median']:>11} (max {paint['max']:>6}){connected['median']:>11} (max {connected['max']:>6})")
+    output = args.output or time.strftime("bench-results/startup-%Y%m%d-%H%M%S.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump({"messages": args.messages, "runs": args.runs, "results": results}, file, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# transport.py
+# Deterministic performance scenarios of the server over simulated links (backend/simnet.py):
+# the server and its members run in one thread on a manual clock, so the same seed gives the same results.
+# Times are of the simulated clock, except 'cpu', the CPU time the simulation took.
+# Run from src/: python -m bench.transport [--scenario slow_consumer] [--seed 1]
+
+import os
+import sys
+import time
+import struct
+import resource
+import argparse
+import tempfile
+import tracemalloc
+from uuid import uuid4
+from backend import cpp
+from backend.client import Client
+from backend.outbox import Outbox, Lane
+from backend.simnet import SimulatedNetwork, LinkProfile, ManualClock
+from backend.tracing import percentile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+import server  # the server imports its modules from its own directory
+
+
+#########################
+PORT = 8000
+HOSTILE_PEAK = 4 * 2 ** 20  # traced peak allowed while the hostile headers are read (they announce 20 MB)
+#########################
+
+
+class Peer:
+    """A member of a simulation: a Client whose socket is read and written without blocking, once per tick.
+    Instance attributes:
+    received - list of (arrival time, message) of the messages received.
+    """
+
+    def __init__(self, client, clock):
+        self.client = client
+        self.clock = clock
+        self.reader = cpp.FrameReader()
+        self.outbox = Outbox()
+        self.received = []
+        client.srv_soc.setblocking(False)
+
+    def send(self, cpp_msg, lane=Lane.CHAT):
+        self.outbox.put(lane, cpp.seal(self.client.aeskey, cpp_msg))
+
+    def poll(self):
+        self.outbox.flush(self.client.srv_soc)
+        while True:
+            frame = self.reader.read(self.client.srv_soc)
+            if frame is None:
+                return
+            cpp_msg = cpp.construct_cpp_msg(*cpp.sdecrypt(self.client.aeskey, *frame))
+            if type(cpp_msg) is cpp.Sequenced:
+                cpp_msg = cpp_msg.msg
+            self.received.append((self.clock(), cpp_msg))
+
+
+class Simulation:
+    """A server and its members on a simulated network, stepped one server tick at a time.
+    """
+
+    def __init__(self, profile, seed=0):
+        self.clock = ManualClock()
+        self.network = SimulatedNetwork(profile, self.clock, seed)
+        self.server = server.Server(rate_limits={}, transport=self.network)  # rate limits use the real clock
+        self.server.accept_soc.bind(("0.0.0.0", PORT))
+        self.server.accept_soc.listen(1)
+        self.peers = []
+        self.steps = 0
+
+    def join(self, name, profile=None):
+        """Connects a new member over a link with the given profile (the network's by default). Returns its Peer.
+        """
+        client = Client(name, transport=self.network)
+        client.srv_soc = self.network.socket(profile=profile)
+        client.connect("127.0.0.1", PORT)
+        conn, _ = self.server.accept_soc.accept()
+        conn.setblocking(False)
+        self.server.pending_que.put(conn)
+        self.step()
+        refusal = client.receive_key()
+        if refusal:
+            raise RuntimeError(refusal)
+        peer = Peer(client, self.clock)
+        self.peers.append(peer)
+        return peer
+
+    def step(self):
+        self.server.step()
+        for peer in self.peers:
+            peer.poll()
+        self.clock.advance(server.Server.TICK)
+        self.steps += 1
+
+    def run_until(self, done, limit=600):
+        """Steps until done() is true or limit simulated seconds passed. Returns whether done() became true.
+        """
+        deadline = self.clock() + limit
+        while not done():
+            if self.clock() >= deadline:
+                return False
+            self.step()
+        return True
+
+
+def stamped(text_size):
+    """Returns a function making chat messages that carry their (simulated) send time, padded to text_size bytes.
+    """
+    return lambda now: f"{now:.6f} ".ljust(text_size, "x")
+
+
+def latencies(peer):
+    """Returns the latencies (ms) of the stamped chat messages a peer received.
+    """
+    return [(arrival - float(cpp_msg.msg.split(" ", 1)[0])) * 1000 for arrival, cpp_msg in peer.received
+            if type(cpp_msg) is cpp.ServerMsg and cpp_msg.name]
+
+
+def summary(values):
+    if not values:
+        return "no messages"
+    return f"{len(values)} msgs, p50 {percentile(values, 50):.1f} ms, p99 {percentile(values, 99):.1f} ms, max {max(values):.1f} ms"
+
+
+def large_transfer(seed):
+    """A member uploads an 8 MB file over a 10 MB/s, 20 ms link, then downloads it back."""
+    size = 8 * 1024 * 1024
+    sim = Simulation(LinkProfile(latency=0.02, bandwidth=10 * 1024 * 1024, buffer_size=1024 * 1024), seed)
+    peer = sim.join("Alice")
+    data = os.urandom(size)
+    file_id = uuid4()
+    start = sim.clock()
+    for offset in range(0, size, server.Server.FILE_CHUNK_SIZE):
+        peer.send(cpp.FilePart(file_id, offset, size, data[offset:offset + server.Server.FILE_CHUNK_SIZE]), Lane.BULK)
+    sim.run_until(lambda: not peer.outbox and os.path.isfile(sim.server.file_path(file_id))
+                  and os.path.getsize(sim.server.file_path(file_id)) == size
+                  and not sim.server.group["Alice"].reader.received)
+    upload = sim.clock() - start
+    start = sim.clock()
+    peer.send(cpp.FileRequest(file_id))
+    parts = lambda: [cpp_msg for _, cpp_msg in peer.received if type(cpp_msg) is cpp.FilePart]
+    sim.run_until(lambda: sum(len(part.data) for part in parts()) >= size)
+    download = sim.clock() - start
+    os.remove(sim.server.file_path(file_id))
+    os.remove(sim.server.digest_path(file_id))
+    mb = size / 2 ** 20
+    return [f"upload: {upload:.2f}s ({mb / upload:.2f} MB/s of a 10 MB/s link)",
+            f"download: {download:.2f}s ({mb / download:.2f} MB/s), {len(parts())} parts"]
+
+
+def slow_consumer(seed):
+    """A manager sends 200 chat messages of 1 KB at 20 per second to three members on fast links
+    and one on an 8 KB/s link."""
+    sim = Simulation(LinkProfile(latency=0.01), seed)
+    sender = sim.join("Alice")
+    fast = [sim.join(f"fast{i}") for i in range(3)]
+    slow = sim.join("slow", LinkProfile(latency=0.05, bandwidth=8 * 1024, buffer_size=16 * 1024))
+    slow_member = sim.server.group["slow"]
+    make = stamped(1024)
+    peak_queue = 0
+    for _ in range(200):
+        sender.send(make(sim.clock()))
+        sim.step()
+        peak_queue = max(peak_queue, slow_member.outbox.size())
+    sent_at = sim.clock()
+    sim.run_until(lambda: len(latencies(slow)) >= 200)
+    return [f"fast members: {summary([value for peer in fast for value in latencies(peer)])}",
+            f"slow member: {summary(latencies(slow))}",
+            f"slow member's queue on the server peaked at {peak_queue / 1024:.0f} KB, "
+            f"it received the last message {sim.clock() - sent_at:.1f}s after it was sent"]
+
+
+def partial_frames(seed):
+    """Two members chat over links that split every message into 7-byte segments with 5 ms of jitter."""
+    sim = Simulation(LinkProfile(latency=0.01, jitter=0.005, mtu=7), seed)
+    sender, receiver = sim.join("Alice"), sim.join("Bob")
+    make = stamped(200)
+    for _ in range(100):
+        sender.send(make(sim.clock()))
+        sim.step()
+    sim.run_until(lambda: len(latencies(receiver)) >= 100)
+    server_conn = sim.server.group["Alice"].conn
+    return [f"received: {summary(latencies(receiver))}",
+            f"the server read each message in {server_conn.reads / 100:.1f} pieces on average"]
+
+
+def lossy_link(seed):
+    """Two members chat over a 50 ms link losing 2% of its segments, each loss stalling the stream for 200 ms."""
+    sim = Simulation(LinkProfile(latency=0.05, loss=0.02, stall=0.2), seed)
+    sender, receiver = sim.join("Alice"), sim.join("Bob")
+    make = stamped(200)
+    for _ in range(200):
+        sender.send(make(sim.clock()))
+        sim.step()
+    sim.run_until(lambda: len(latencies(receiver)) >= 200)
+    return [f"received: {summary(latencies(receiver))}"]
+
+
+def hostile_headers(seed):
+    """20 members announce messages of 4 GB, and 20 others announce the largest message allowed and send 1 KB of it,
+    then two members chat. The server's memory should not grow with the sizes announced."""
+    sim = Simulation(LinkProfile(latency=0.01), seed)
+    sender, receiver = sim.join("Alice"), sim.join("Bob")
+    hostile = [sim.join(f"oversized{i}") for i in range(20)] + [sim.join(f"liar{i}") for i in range(20)]
+    for peer in hostile:
+        sim.peers.remove(peer)  # their connections are not read, they only send the headers below
+    make = stamped(200)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for peer in hostile:
+        size = 0xFFFFFFF0 if peer.client.name.startswith("oversized") else cpp.MAX_FRAME_SIZE
+        peer.client.srv_soc.send(struct.pack(">I", size) + os.urandom(1024 if size == cpp.MAX_FRAME_SIZE else 0))
+    for _ in range(20):
+        sim.step()
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    for _ in range(100):
+        sender.send(make(sim.clock()))
+        sim.step()
+    sim.run_until(lambda: len(latencies(receiver)) >= 100)
+    liars = [member for member in sim.server.group if member.name.startswith("liar")]
+    held = sum(len(member.reader.buffer) for member in liars)
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_rss  # KB on Linux
+    if any(name.startswith("oversized") for name in sim.server.group.members):
+        raise RuntimeError("a member that announced a message over the size limit is still connected")
+    if held > len(liars) * cpp.FrameReader.CHUNK:  # each sent 1 KB, a read buffers CHUNK bytes at most
+        raise RuntimeError(f"the liars' buffers hold {held / 1024:.0f} KB, over {cpp.FrameReader.CHUNK // 1024} KB each")
+    if peak > HOSTILE_PEAK:
+        raise RuntimeError(f"traced peak memory grew by {peak / 1024:.0f} KB, over {HOSTILE_PEAK // 1024} KB")
+    return [f"received: {summary(latencies(receiver))}",
+            f"{20 - sum(name.startswith('oversized') for name in sim.server.group.members)} of 20 oversized announcers "
+            f"disconnected, {len(liars)} liars connected holding {held / 1024:.0f} KB of buffers "
+            f"(they announced {len(liars) * cpp.MAX_FRAME_SIZE / 2 ** 20:.0f} MB)",
+            f"while the headers were read, traced peak memory grew by {peak / 1024:.0f} KB; peak RSS grew by {rss_growth} KB"]
+
+
+SCENARIOS = {"large_transfer": large_transfer, "slow_consumer": slow_consumer,
+             "partial_frames": partial_frames, "lossy_link": lossy_link, "hostile_headers": hostile_headers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic performance scenarios over simulated links.")
+    parser.add_argument("--scenario", choices=SCENARIOS, help="run only this scenario")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the links' jitter and loss (default 0)")
+    args = parser.parse_args()
+    os.chdir(tempfile.mkdtemp(prefix="chat-sim-"))  # the server stores uploads under ./data
+    for name, scenario in SCENARIOS.items():
+        if args.scenario and name != args.scenario:
+            continue
+        start = time.process_time()
+        print(f"{name}: {scenario.__doc__}")
+        for line in scenario(args.seed):
+            print(f"  {line}")
+        print(f"  cpu: {time.process_time() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
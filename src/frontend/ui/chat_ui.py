@@ -1,15 +1,17 @@
 from PyQt5 import QtCore, QtGui, QtWidgets
 from .widgets import QGrowingTextEdit, QFileButton
+from .message_list import MsgType, MessageModel, MessageDelegate, QMessageView
 
 
 class ChatUi(object):
     SELF_COLOR   = "#93ffa0"
     OTHER_COLOR  = "#ffffff"
     SERVER_COLOR = "#dddddd"
-    
-    selfmsg_style = "background-color:#93ffa0; border: 3px solid #93ffa0; border-radius: 8px; "
-    othermsg_style = "border: 3px solid white; border-radius: 8px"
-    servermsg_style = "background-color:#dddddd; border: 3px solid #dddddd; border-radius: 8px"
+
+    def __init__(self, store):
+        """store - the MessageStore messages are kept in.
+        """
+        self.store = store
 
     def setup_ui(self, window):
         self.window = window
@@ -20,17 +22,14 @@ class ChatUi(object):
         # main vertical layout:
         self.mainVLayout = QtWidgets.QVBoxLayout(self.centralwidget)
         self.mainVLayout.setObjectName("verticalLayout")
-        # scroll area where messages are shown:
-        self.msgArea = QtWidgets.QScrollArea(self.centralwidget)
-        self.msgArea.setWidgetResizable(True)
-        self.msgArea.setObjectName("msgArea")
-        self.msgScrollAreaWidgetContents = QtWidgets.QWidget()
-        self.msgScrollAreaWidgetContents.setObjectName("scrollAreaWidgetContents")
-        self.msgScrollAreaWidgetContents.setSizePolicy(QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Maximum))
-        self.msgArea.setWidget(self.msgScrollAreaWidgetContents)
-        self.mainVLayout.addWidget(self.msgArea)
-        # vertical layout for the msg area:
-        self.msgVLayout = QtWidgets.QVBoxLayout(self.msgScrollAreaWidgetContents)
+        # list where messages are shown:
+        self.msgView = QMessageView(self.centralwidget)
+        self.msgView.setObjectName("msgView")
+        self.msgModel = MessageModel(self.msgView, self.store)
+        self.msgView.setModel(self.msgModel)
+        self.msgView.setItemDelegate(MessageDelegate({MsgType.SELF: self.SELF_COLOR, MsgType.OTHER: self.OTHER_COLOR,
+                                                      MsgType.SERVER: self.SERVER_COLOR}, self.msgView))
+        self.mainVLayout.addWidget(self.msgView)
         # horizontal layout for input widgets:
         self.inputHLayout = QtWidgets.QHBoxLayout()
         self.inputHLayout.setObjectName("inputHLayout")
@@ -52,6 +51,10 @@ class ChatUi(object):
         # window layout;
         self.mainVLayout.addLayout(self.inputHLayout)
         self.window.setCentralWidget(self.centralwidget)
+        # status bar, showing the connection and the messages waiting to be sent:
+        self.statusBar = QtWidgets.QStatusBar(self.window)
+        self.statusBar.setObjectName("statusBar")
+        self.window.setStatusBar(self.statusBar)
         self.window.resizeEvent = self.resize_event
 
         self.style()
@@ -89,15 +92,20 @@ class ChatUi(object):
 
             QScrollBar::sub-line:vertical{
                 height: 0px;
+            }
+
+            QListView#msgView{
+                background: palette(window);
             }'''
         self.centralwidget.setStyleSheet(scrollbar_style)
 
 
 if __name__ == "__main__":
     import sys
+    from .message_store import MessageStore
     app = QtWidgets.QApplication(sys.argv)
     window = QtWidgets.QMainWindow()
-    ui = ChatUi()
+    ui = ChatUi(MessageStore())
     ui.setup_ui(window)
     window.show()
     sys.exit(app.exec_())
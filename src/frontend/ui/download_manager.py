@@ -0,0 +1,196 @@
+# download_manager.py
+# Downloads of the chat's file attachments: queued by the file's UUID and requested a few at a time, the server sends
+# them interleaved, and their chunks are written to disk as they arrive, so a file is never held in memory.
+# A downloaded file is checked against the digest the server computed as it was uploaded, and kept in the
+# download directory (a folder per file), where later downloads of the same attachment find it.
+
+import os
+import ntpath
+import hashlib
+import threading
+from collections import deque
+from PyQt5 import QtCore
+from backend import cpp
+from .message_list import Transfer
+
+
+#########################
+DOWNLOAD_DIR = os.path.join(os.path.expanduser("~"), ".chat-program", "downloads")
+#########################
+
+
+def download_path(file_id, filename):
+    """Returns the path the attachment of the file with the UUID file_id is downloaded to.
+    """
+    name = ntpath.basename(filename).strip()  # the name is chosen by the sender, and may hold either kind of separator
+    if name in ["", ".", ".."]:
+        name = "file"
+    return os.path.join(DOWNLOAD_DIR, str(file_id), name)
+
+
+class Download:
+    """A file being downloaded, written to a partial file next to its path until it is complete.
+    Instance attributes:
+    path - where the file is kept once downloaded.
+    size, digest - the file's size and SHA-256 digest, as sent by the server, None until then.
+    received - bytes of the file written so far.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = None
+        self.digest = None
+        self.received = 0
+        self.file = None
+        self.sha256 = hashlib.sha256()
+
+    def start(self, size, digest):
+        self.size = size
+        self.digest = digest
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(f"{self.path}.part", "wb")
+
+    def write(self, data):
+        self.file.write(data)
+        self.sha256.update(data)
+        self.received += len(data)
+
+    def complete(self):
+        return self.size is not None and self.received == self.size
+
+    def close(self, error=None):
+        """Closes the partial file and moves it to the file's path if it is complete and intact.
+        Returns why it was not, or the error given.
+        """
+        if self.file is not None:
+            self.file.close()
+        if error is None and self.sha256.digest() != self.digest:
+            error = "Download failed, the file is corrupted."
+        try:
+            if error is None:
+                os.replace(f"{self.path}.part", self.path)
+            elif self.file is not None:
+                os.remove(f"{self.path}.part")
+        except OSError as err:
+            error = error or f"Download failed: {err.strerror or err}"
+        return error
+
+
+class DownloadManager(QtCore.QObject):
+    """Downloads attachments, at most MAX_ACTIVE at a time, the others wait in the order they were asked for.
+    The chunks of the files are handed to it by the receiving thread, which writes them.
+    Instance attributes:
+    send - function sending a message to the server, from any thread.
+    transfers - dict of the UUID of a file to its Transfer, shared with the delegate painting the attachments.
+    waiting - deque of (UUID, path) of the files waiting to be requested.
+    active - dict of the UUID of a file being downloaded to its Download.
+    """
+
+    # emitted with a file's UUID as its download progresses.
+    progress = QtCore.pyqtSignal(object)
+    # emitted with a file's UUID, its path, and why its download failed or "" once it is downloaded.
+    downloaded = QtCore.pyqtSignal(object, str, str)
+
+    MAX_ACTIVE = 3  # files downloaded at once, the server interleaves their chunks
+
+    def __init__(self, send, transfers, parent=None):
+        super().__init__(parent)
+        self.send = send
+        self.transfers = transfers
+        self.lock = threading.Lock()
+        self.waiting = deque()
+        self.active = {}
+
+    def download(self, file_id, filename):
+        """Queues the download of an attachment, unless it is already downloaded or queued.
+        Returns the file's path if it was already downloaded, None otherwise.
+        """
+        path = download_path(file_id, filename)
+        if os.path.isfile(path):
+            return path
+        with self.lock:
+            if file_id in self.active or any(waiting_id == file_id for waiting_id, _ in self.waiting):
+                return None
+            self.waiting.append((file_id, path))
+            self.transfers[file_id] = Transfer(None)
+        self.start_next()
+        return None
+
+    def cancel(self, file_id):
+        """Cancels the download of a file that is still waiting to be requested. Returns whether it was waiting.
+        """
+        with self.lock:
+            for waiting in self.waiting:
+                if waiting[0] == file_id:
+                    self.waiting.remove(waiting)
+                    self.transfers.pop(file_id, None)
+                    return True
+        return False
+
+    def start_next(self):
+        """Requests the files waiting, while fewer than MAX_ACTIVE are downloaded.
+        """
+        requests = []
+        with self.lock:
+            while self.waiting and len(self.active) < self.MAX_ACTIVE:
+                file_id, path = self.waiting.popleft()
+                self.active[file_id] = Download(path)
+                requests.append(file_id)
+        for file_id in requests:
+            self.send(cpp.FileRequest(file_id))
+
+    def receive(self, cpp_msg):
+        """Handles the FileInfo or a FilePart of a file being downloaded. Called by the receiving thread.
+        """
+        with self.lock:
+            download = self.active.get(cpp_msg.file_id)
+        if download is None:
+            return  # its download failed
+        try:
+            if type(cpp_msg) is cpp.FileInfo:
+                if not cpp_msg.digest:
+                    self.finish(cpp_msg.file_id, "Download failed, the file is not on the server.")
+                    return
+                download.start(cpp_msg.size, cpp_msg.digest)
+                self.transfers[cpp_msg.file_id].total = cpp_msg.size
+            elif download.file is None or cpp_msg.offset != download.received:
+                self.finish(cpp_msg.file_id, "Download failed, a part of the file was lost.")
+                return
+            else:
+                download.write(cpp_msg.data)
+                self.transfers[cpp_msg.file_id].update(download.received)
+        except (OSError, ValueError) as err:  # ValueError if the download was ended meanwhile, closing its file
+            self.finish(cpp_msg.file_id, f"Download failed: {getattr(err, 'strerror', None) or err}")
+            return
+        if download.complete():
+            self.finish(cpp_msg.file_id)
+        else:
+            self.progress.emit(cpp_msg.file_id)
+
+    def finish(self, file_id, error=None):
+        """Ends a download, and starts the next one waiting.
+        """
+        with self.lock:
+            download = self.active.pop(file_id, None)
+        if download is None:
+            return
+        error = download.close(error)
+        self.transfers[file_id].finish(error)
+        self.downloaded.emit(file_id, download.path, error or "")
+        self.start_next()
+
+    def fail(self, error):
+        """Ends the downloads running, when the connection they were sent over is lost or closed.
+        The downloads waiting are requested from the next connection.
+        """
+        with self.lock:
+            file_ids = list(self.active)
+        for file_id in file_ids:
+            self.finish(file_id, error)
+
+    def close(self):
+        """Ends all the downloads.
+        """
+        with self.lock:
+            self.waiting.clear()
+        self.fail("Download cancelled.")
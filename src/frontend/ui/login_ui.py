@@ -88,23 +88,6 @@ class LoginUi(object):
         self.buttonBox.button(QtWidgets.QDialogButtonBox.Reset).clicked.connect(lambda: self.spinPort.setValue(8000))
         self.buttonBox.rejected.connect(self.window.close)  # Close button quits window
 
-    def ok(self):
-        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-        self.lineIP.setReadOnly(True)
-        self.lineName.setReadOnly(True)
-        self.spinPort.setReadOnly(True)
-        self.buttonBox.button(QtWidgets.QDialogButtonBox.Reset).setEnabled(False)
-        self.buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setEnabled(False)
-        self.buttonBox.button(QtWidgets.QDialogButtonBox.Close).setFocus()
-
-    def retry(self):
-        QtWidgets.QApplication.restoreOverrideCursor()
-        self.lineIP.setReadOnly(False)
-        self.lineName.setReadOnly(False)
-        self.spinPort.setReadOnly(False)
-        self.buttonBox.button(QtWidgets.QDialogButtonBox.Reset).setEnabled(True)
-        self.buttonBox.button(QtWidgets.QDialogButtonBox.Ok).setEnabled(True)
-
 
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,431 @@
+# message_list.py
+# The chat's messages, shown in a QListView: a model holding them and a delegate painting them as bubbles.
+# Only the visible rows are painted, a message is laid out once per width it is shown at, and the view only
+# holds a window of the newest messages (older ones are added as it is scrolled up), as QListView lays out
+# all of its rows whenever one is added. So the list stays smooth with any number of messages.
+# The model keeps a bounded number of messages in memory, and reads older ones back from a MessageStore.
+# File attachments being transferred show their progress, rate and remaining time under the file's name,
+# and image attachments show a thumbnail above it, from a ThumbnailCache.
+
+import ntpath
+from enum import Enum
+from math import ceil
+from time import monotonic
+from collections import deque, OrderedDict
+from PyQt5 import QtWidgets, QtGui, QtCore
+from PyQt5.QtCore import Qt
+from .thumbnails import is_image
+
+
+class MsgType(Enum):
+    SELF = 0  # msg typed by the user.
+    OTHER = 1  # msg typed by another user in the group.
+    SERVER = 2  # msg sent to the user by the server.
+
+
+class ChatMessage:
+    """A message of the list.
+    Instance attributes:
+    msgtype - (MsgType) who sent the message, which decides its color and alignment.
+    html - the message's rich text, or None if it is a file attachment.
+    attachment - (cpp.FileAttachRecv) the attached file, or None.
+    layout_width, size - the width the message was last laid out for, and the size of its bubble at that width.
+    """
+
+    __slots__ = ("msgtype", "html", "attachment", "layout_width", "size")
+
+    def __init__(self, msgtype, html=None, attachment=None):
+        self.msgtype = msgtype
+        self.html = html
+        self.attachment = attachment
+        self.layout_width = None
+        self.size = None
+
+
+def format_size(size):
+    """Returns a number of bytes as a short text, like 1.5 MB.
+    """
+    for unit in ["B", "KB", "MB"]:
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+class Transfer:
+    """Progress of a file's transfer, shown on its attachment.
+    Instance attributes:
+    total - size of the file, in bytes, None until it is known.
+    done - bytes transferred so far.
+    rate - bytes transferred per second, over the last RATE_WINDOW seconds.
+    finished - whether the transfer ended, completed or not.
+    error - why the transfer stopped before it completed, or None.
+    """
+
+    RATE_WINDOW = 3  # seconds
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.rate = 0
+        self.finished = False
+        self.error = None
+        self.samples = deque([(monotonic(), 0)])  # (time, done) of the last RATE_WINDOW seconds
+
+    def update(self, done):
+        now = monotonic()
+        self.done = done
+        self.samples.append((now, done))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.RATE_WINDOW:
+            self.samples.popleft()
+        start, start_done = self.samples[0]
+        if now > start:
+            self.rate = (done - start_done) / (now - start)
+
+    def finish(self, error=None):
+        self.finished = True
+        self.error = error
+
+    @property
+    def fraction(self):
+        return self.done / self.total if self.total else float(self.finished and self.error is None)
+
+    def status(self):
+        """Returns the transfer's state as a short text: how much was transferred, at what rate, and the time left.
+        """
+        if self.error is not None:
+            return self.error
+        if self.finished:
+            return f"Done, {format_size(self.total)}"
+        if self.total is None:
+            return "Waiting..."
+        status = f"{format_size(self.done)} of {format_size(self.total)}"
+        if self.rate:
+            left = ceil((self.total - self.done) / self.rate)
+            status += f", {format_size(self.rate)}/s, {left // 60}:{left % 60:02d} left"
+        return status
+
+
+class MessageModel(QtCore.QAbstractListModel):
+    """The messages of the chat, oldest first, numbered from 0. Its rows are the messages numbered from first on.
+    Messages are written to the store as they are added, and only the newest memory_window of them
+    (or more, if more are shown) are kept in memory.
+    Instance attributes:
+    messages - list of the ChatMessage in memory, the newest ones.
+    base - number of messages[0], older messages are only in the store.
+    first - number of the first row, older messages are hidden from the view.
+    store - (instance of MessageStore) holds all the messages, None to keep them all in memory.
+    """
+
+    MEMORY_WINDOW = 2000  # messages kept in memory, at least
+
+    def __init__(self, parent=None, store=None, memory_window=MEMORY_WINDOW):
+        super().__init__(parent)
+        self.store = store
+        self.memory_window = memory_window
+        self.messages = []
+        self.base = self.first = store.end if store is not None else 0  # messages already stored are shown by show_older
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self.base + len(self.messages) - self.first
+
+    def message(self, row):
+        return self.messages[self.first + row - self.base]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        message = self.message(index.row())
+        return message.html if message.attachment is None else message.attachment.filename
+
+    def append(self, messages):
+        """Appends a list of ChatMessage in one insertion.
+        """
+        if not messages:
+            return
+        if self.store is not None:
+            self.store.append(messages)
+        rows = self.rowCount()
+        self.beginInsertRows(QtCore.QModelIndex(), rows, rows + len(messages) - 1)
+        self.messages.extend(messages)
+        self.endInsertRows()
+        self.evict()
+
+    def show_older(self, count):
+        """Adds up to count of the hidden messages before the first row. Returns how many were added.
+        """
+        oldest = self.store.first if self.store is not None else 0
+        count = max(0, min(count, self.first - oldest))
+        if count:
+            if self.first - count < self.base:  # read back the evicted ones
+                self.messages[:0] = self.store.load(self.first - count, self.base)
+                self.base = self.first - count
+            self.beginInsertRows(QtCore.QModelIndex(), 0, count - 1)
+            self.first -= count
+            self.endInsertRows()
+        return count
+
+    def hide_older(self, rows):
+        """Hides the oldest messages, keeping the newest rows of them.
+        """
+        count = self.rowCount() - rows
+        if count > 0:
+            self.beginRemoveRows(QtCore.QModelIndex(), 0, count - 1)
+            self.first += count
+            self.endRemoveRows()
+            self.evict()
+
+    def evict(self):
+        """Drops the oldest messages from memory, if they are stored and not shown.
+        They are dropped in chunks of a quarter of memory_window, so the list isn't shifted on every message.
+        """
+        if self.store is None:
+            return
+        excess = len(self.messages) - max(self.memory_window, self.rowCount())
+        if excess > self.memory_window // 4:
+            del self.messages[:excess]
+            self.base += excess
+
+
+class MessageDelegate(QtWidgets.QStyledItemDelegate):
+    """Paints messages as rounded bubbles: the user's on the right, the server's centered and others' on the left.
+    The size of a message is cached on it, and computed again only when the list's width changes. The rich text of
+    the last DOCUMENTS messages laid out or painted is kept parsed, so painting them again only draws it.
+    Instance attributes:
+    transfers - dict of the UUID of an attachment's file to its Transfer, painted as the attachment's progress bar.
+    thumbnails - (instance of ThumbnailCache) thumbnails of the image attachments, None to show only their icon.
+    """
+
+    MARGIN = 4  # space around a bubble
+    PADDING = 6  # space between a bubble's edge and its contents
+    RADIUS = 8
+    SIDE_SPACE = 30  # part of the list's width a bubble never covers, so the side it is on is clear
+    WIDTH_STEP = 16  # widths are rounded down to this step, so resizing lays messages out again every few pixels
+    ICON_SIZE = 30
+    BAR_HEIGHT = 6  # progress bar under a file attachment
+    ATTACHMENT_WIDTH = 280  # narrowest bubble of an attachment, so the status of its transfer fits
+    DOCUMENTS = 200  # parsed messages kept, more than fill the list
+
+    def __init__(self, colors, parent=None):
+        """colors - dict of MsgType to the background color of its bubbles.
+        """
+        super().__init__(parent)
+        self.colors = {msgtype: QtGui.QColor(color) for msgtype, color in colors.items()}
+        self.documents = OrderedDict()  # ChatMessage -> QTextDocument of its rich text, the one painted last at the end
+        self.attachment_font = QtGui.QFont("Arial")
+        self.attachment_font.setPixelSize(14)
+        self.attachment_metrics = QtGui.QFontMetrics(self.attachment_font)
+        self.status_font = QtGui.QFont("Arial")
+        self.status_font.setPixelSize(10)
+        self.transfers = {}
+        self.thumbnails = None
+        self.icon_provider = QtWidgets.QFileIconProvider()
+        self.icons = {}  # file extension -> QIcon
+        self.width = self.WIDTH_STEP  # widest a bubble may be
+
+    def resize(self, list_width):
+        """Sets the width of the list. Returns whether bubbles have a new width, so the messages must be laid out again.
+        """
+        width = list_width - 2 * self.MARGIN - self.SIDE_SPACE
+        width = max(self.WIDTH_STEP, width - width % self.WIDTH_STEP)
+        changed, self.width = width != self.width, width
+        return changed
+
+    def layout(self, message):
+        """Returns the size of a message's bubble, computing it if the list's width changed since it was last laid out.
+        """
+        width = self.width
+        if message.layout_width != width:
+            message.layout_width = width
+            if message.attachment is None:
+                document = self.document(message)
+                document.setTextWidth(width - 2 * self.PADDING)
+                message.size = QtCore.QSize(min(width, ceil(document.idealWidth()) + 2 * self.PADDING),
+                                            ceil(document.size().height()) + 2 * self.PADDING)
+            else:
+                text_width = self.attachment_metrics.horizontalAdvance(self.attachment_text(message))
+                message.size = QtCore.QSize(min(width, max(text_width + self.ICON_SIZE + 4 * self.PADDING,
+                                                           self.ATTACHMENT_WIDTH)),
+                                            self.ICON_SIZE + self.BAR_HEIGHT + 3 * self.PADDING)
+                if self.has_thumbnail(message):  # the same size whether the thumbnail arrived, so rows never move
+                    thumbnail = self.thumbnails.SIZE
+                    message.size = QtCore.QSize(min(width, max(message.size.width(), thumbnail.width() + 4 * self.PADDING)),
+                                                message.size.height() + thumbnail.height() + self.PADDING)
+        return message.size
+
+    def sizeHint(self, option, index):
+        size = self.layout(index.model().message(index.row()))
+        return QtCore.QSize(size.width(), size.height() + 2 * self.MARGIN)
+
+    def paint(self, painter, option, index):
+        message = index.model().message(index.row())
+        size = self.layout(message)
+        area = option.rect.adjusted(self.MARGIN, self.MARGIN, -self.MARGIN, -self.MARGIN)
+        if message.msgtype == MsgType.SELF:
+            left = area.right() - size.width()
+        elif message.msgtype == MsgType.SERVER:
+            left = area.left() + (area.width() - size.width()) // 2
+        else:
+            left = area.left()
+        bubble = QtCore.QRect(left, area.top(), size.width(), size.height())
+        painter.save()
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(self.colors[message.msgtype])
+        painter.drawRoundedRect(bubble, self.RADIUS, self.RADIUS)
+        contents = bubble.adjusted(self.PADDING, self.PADDING, -self.PADDING, -self.PADDING)
+        if message.attachment is None:
+            document = self.document(message)
+            document.setTextWidth(contents.width())  # laid out again only the first time it is painted at this width
+            painter.translate(contents.topLeft())
+            document.drawContents(painter)
+        else:
+            self.paint_attachment(painter, message, contents)
+        painter.restore()
+
+    def document(self, message):
+        """Returns the QTextDocument of a message's rich text, parsing it if it is not kept.
+        """
+        document = self.documents.get(message)
+        if document is None:
+            document = QtGui.QTextDocument()
+            document.setDocumentMargin(0)
+            document.setHtml(message.html)
+            self.documents[message] = document
+            if len(self.documents) > self.DOCUMENTS:
+                self.documents.popitem(last=False)
+        else:
+            self.documents.move_to_end(message)
+        return document
+
+    def has_thumbnail(self, message):
+        return self.thumbnails is not None and is_image(message.attachment.filename)
+
+    def paint_attachment(self, painter, message, rect):
+        color = self.colors[message.msgtype]
+        painter.setBrush(color.darker(105))
+        painter.drawRoundedRect(rect, self.RADIUS / 2, self.RADIUS / 2)
+        if self.has_thumbnail(message):
+            preview = QtCore.QRect(rect.left() + self.PADDING, rect.top() + self.PADDING,
+                                   rect.width() - 2 * self.PADDING, self.thumbnails.SIZE.height())
+            self.paint_thumbnail(painter, message, preview, color)
+            rect = rect.adjusted(0, preview.height() + self.PADDING, 0, 0)
+        icon_rect = QtCore.QRect(rect.left() + self.PADDING, rect.top(), self.ICON_SIZE, self.ICON_SIZE)
+        self.icon(message.attachment.filename).paint(painter, icon_rect)
+        transfer = self.transfers.get(message.attachment.uuid)
+        painter.setFont(self.attachment_font)
+        painter.setPen(Qt.black)
+        text_rect = QtCore.QRect(icon_rect.right() + self.PADDING, rect.top(),
+                                 rect.right() - icon_rect.right() - self.PADDING, self.ICON_SIZE)
+        if transfer is None:
+            painter.drawText(text_rect, Qt.AlignVCenter | Qt.AlignLeft, self.attachment_text(message))
+        else:
+            painter.drawText(text_rect, Qt.AlignTop | Qt.AlignLeft, self.attachment_text(message))
+            painter.setFont(self.status_font)
+            painter.setPen(Qt.darkRed if transfer.error is not None else Qt.darkGray)
+            painter.drawText(text_rect, Qt.AlignBottom | Qt.AlignLeft, f" {transfer.status()}")
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(color.darker(110))
+        bar = QtCore.QRect(rect.left(), rect.bottom() - self.BAR_HEIGHT, rect.width(), self.BAR_HEIGHT)
+        painter.drawRoundedRect(bar, self.BAR_HEIGHT / 2, self.BAR_HEIGHT / 2)
+        if transfer is not None and transfer.fraction:
+            painter.setBrush(color.darker(150))
+            bar.setWidth(max(self.BAR_HEIGHT, round(bar.width() * transfer.fraction)))
+            painter.drawRoundedRect(bar, self.BAR_HEIGHT / 2, self.BAR_HEIGHT / 2)
+
+    def paint_thumbnail(self, painter, message, rect, color):
+        """Paints an image attachment's thumbnail, or its icon while the thumbnail is made.
+        """
+        pixmap = self.thumbnails.get(message.attachment)
+        if pixmap is None:
+            painter.setBrush(color.darker(110))
+            painter.drawRoundedRect(rect, self.RADIUS / 2, self.RADIUS / 2)
+            icon_rect = QtCore.QRect(0, 0, 2 * self.ICON_SIZE, 2 * self.ICON_SIZE)
+            icon_rect.moveCenter(rect.center())
+            self.icon(message.attachment.filename).paint(painter, icon_rect)
+            return
+        size = pixmap.size()
+        if size.width() > rect.width() or size.height() > rect.height():  # the list is narrower than thumbnails
+            size.scale(rect.size(), Qt.KeepAspectRatio)
+            painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+        target = QtCore.QRect(QtCore.QPoint(0, 0), size)
+        target.moveCenter(rect.center())
+        painter.drawPixmap(target, pixmap)
+
+    def attachment_text(self, message):
+        return f" {ntpath.basename(message.attachment.filename)}"
+
+    def icon(self, filename):
+        """Returns the icon of a file's type, looked up once per extension.
+        """
+        extension = QtCore.QFileInfo(filename).suffix().lower()
+        if extension not in self.icons:
+            self.icons[extension] = self.icon_provider.icon(QtCore.QFileInfo(filename))
+        return self.icons[extension]
+
+
+class QMessageView(QtWidgets.QListView):
+    """A QListView of the chat's messages (a MessageModel painted by a MessageDelegate).
+    While scrolled to the bottom it keeps showing the newest messages, and hides the old ones beyond WINDOW;
+    scrolling to the top shows them again, WINDOW at a time.
+    Instance attributes:
+    at_bottom - whether the list is scrolled to the bottom.
+    painted - whether messages have been painted yet.
+    """
+
+    # emitted the first time messages are painted.
+    first_painted = QtCore.pyqtSignal()
+
+    WINDOW = 500  # messages kept in the view while scrolled to the bottom
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.setFocusPolicy(Qt.NoFocus)
+        self.at_bottom = True
+        self.painted = False
+        scrollbar = self.verticalScrollBar()
+        scrollbar.valueChanged.connect(self.scrolled)
+        scrollbar.rangeChanged.connect(self.range_changed)
+
+    def append(self, messages):
+        """Adds a list of ChatMessage to the end of the list.
+        """
+        model = self.model()
+        model.append(messages)
+        if self.at_bottom and model.rowCount() > 2 * self.WINDOW:
+            model.hide_older(self.WINDOW)
+
+    def scrolled(self, value):
+        scrollbar = self.verticalScrollBar()
+        self.at_bottom = value >= scrollbar.maximum()
+        if value == scrollbar.minimum() and scrollbar.maximum() > 0:
+            QtCore.QTimer.singleShot(0, self.show_older)
+
+    def show_older(self):
+        """Shows older messages above the first one, keeping it where it was.
+        """
+        if self.verticalScrollBar().value() != self.verticalScrollBar().minimum():
+            return
+        added = self.model().show_older(self.WINDOW)
+        if added:
+            self.doItemsLayout()
+            self.scrollTo(self.model().index(added, 0), QtWidgets.QAbstractItemView.PositionAtTop)
+
+    def range_changed(self, minimum, maximum):
+        if self.at_bottom:
+            self.verticalScrollBar().setValue(maximum)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        delegate = self.itemDelegate()
+        if isinstance(delegate, MessageDelegate) and delegate.resize(self.viewport().width()):
+            self.scheduleDelayedItemsLayout()  # QListView keeps the rows' heights when only the width changes
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.painted and self.model().rowCount():
+            self.painted = True
+            self.first_painted.emit()
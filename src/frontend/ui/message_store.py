@@ -0,0 +1,125 @@
+# message_store.py
+# On-disk store of the chat's messages, so the client only keeps the recent ones in memory:
+# every message is written to it when it is displayed, and older ones are read back when the list is scrolled up.
+# A store kept in the cache directory (one per server and name) also holds the last position in each room's
+# sequence of broadcasts, so the next launch shows the previous messages at once and asks the server for the missed ones,
+# and the outbox of messages waiting to be sent, so ones typed while the connection was down are sent on the next launch.
+
+import atexit
+import os
+import sqlite3
+import tempfile
+from uuid import UUID
+from urllib.parse import quote
+from backend import cpp
+from .message_list import MsgType, ChatMessage
+
+
+#########################
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".chat-program", "cache")
+#########################
+
+
+def cache_path(ip, port, name):
+    """Returns the path of the message cache of a name on a server.
+    """
+    return os.path.join(CACHE_DIR, f"{quote(ip, safe='')}-{port}-{quote(name, safe='')}.sqlite")
+
+
+class MessageStore:
+    """The chat's messages in an SQLite database, numbered in the order they were displayed.
+    Without a path, the database is a temporary file that is deleted when the store is closed.
+    Instance attributes:
+    first - number of the oldest message stored.
+    end - number of the next message to be stored.
+    """
+
+    KEEP = 100000  # messages kept in a cache, older ones are deleted when it is opened
+
+    def __init__(self, path=None):
+        self.temporary = path is None
+        if self.temporary:
+            fd, path = tempfile.mkstemp(prefix="chat-", suffix=".sqlite")
+            os.close(fd)
+            atexit.register(self.close)  # also when the window is closed without closing the store
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        if self.temporary:
+            self.db.execute("PRAGMA synchronous = OFF")  # nothing to recover after a crash
+        else:
+            self.db.execute("PRAGMA journal_mode = WAL")  # a commit per frame appends to the log, without rewriting pages
+            self.db.execute("PRAGMA synchronous = NORMAL")  # nor flushed to the disk on each commit (one per message sent)
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (number INTEGER PRIMARY KEY, msgtype INTEGER, html TEXT,"
+                        " filename TEXT, sender TEXT, file_id BLOB)")
+        # room is '' for the whole group:
+        self.db.execute("CREATE TABLE IF NOT EXISTS sequences (room TEXT PRIMARY KEY, epoch INTEGER, last_seq INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outbox (number INTEGER PRIMARY KEY, plaintext BLOB)")
+        first, last = self.db.execute("SELECT MIN(number), MAX(number) FROM messages").fetchone()
+        self.end = 0 if last is None else last + 1
+        self.first = self.end if first is None else max(first, self.end - self.KEEP)
+        if first is not None and first < self.first:
+            with self.db:
+                self.db.execute("DELETE FROM messages WHERE number < ?", (self.first,))
+
+    def append(self, messages):
+        """Stores a list of ChatMessage after the ones already stored.
+        """
+        rows = []
+        for number, message in enumerate(messages, self.end):
+            attachment = message.attachment
+            if attachment is None:
+                rows.append((number, message.msgtype.value, message.html, None, None, None))
+            else:
+                rows.append((number, message.msgtype.value, None, attachment.filename, attachment.name, attachment.uuid.bytes))
+        with self.db:
+            self.db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.end += len(rows)
+
+    def load(self, start, end):
+        """Returns the list of ChatMessage numbered from start to end (excluded).
+        """
+        messages = []
+        for msgtype, html, filename, sender, file_id in self.db.execute(
+                "SELECT msgtype, html, filename, sender, file_id FROM messages WHERE number >= ? AND number < ? ORDER BY number",
+                (start, end)):
+            attachment = cpp.FileAttachRecv(filename, sender, UUID(bytes=file_id)) if file_id is not None else None
+            messages.append(ChatMessage(MsgType(msgtype), html, attachment))
+        return messages
+
+    def save_sequences(self, sequences):
+        """Replaces the stored positions in the sequences of broadcasts.
+        sequences - dict of a room's name (None for the whole group) to (epoch, last_seq).
+        """
+        with self.db:
+            self.db.execute("DELETE FROM sequences")
+            self.db.executemany("INSERT INTO sequences VALUES (?, ?, ?)",
+                                [(room or "", epoch, last_seq) for room, (epoch, last_seq) in sequences.items()])
+
+    def load_sequences(self):
+        """Returns the stored positions in the sequences of broadcasts, as given to save_sequences.
+        """
+        return {room or None: (epoch, last_seq) for room, epoch, last_seq in self.db.execute("SELECT * FROM sequences")}
+
+    def add_outgoing(self, plaintext):
+        """Stores an encoded message waiting to be sent to the server. Returns its number in the outbox.
+        """
+        with self.db:
+            return self.db.execute("INSERT INTO outbox (plaintext) VALUES (?)", (plaintext,)).lastrowid
+
+    def remove_outgoing(self, numbers):
+        """Removes the messages that were sent from the outbox.
+        """
+        with self.db:
+            self.db.executemany("DELETE FROM outbox WHERE number = ?", [(number,) for number in numbers])
+
+    def load_outgoing(self):
+        """Returns a list of (number, plaintext) of the messages waiting to be sent, oldest first.
+        """
+        return self.db.execute("SELECT number, plaintext FROM outbox ORDER BY number").fetchall()
+
+    def close(self):
+        self.db.close()
+        if self.temporary and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,98 @@
+# render.py
+# Rich text of the chat's messages, as shown in their bubbles. Each kind of message has a template, built once when
+# the module is loaded, that a message is formatted into. A member's name color is computed once per name, from
+# a hash that is the same on every run (Python's hash() of a str is salted per process), so members keep their colors.
+# Members' messages are sent in the protocol's compact markup (see cpp.valid_markup), made from the message input's
+# document by to_markup, rather than as the full HTML document Qt makes of it.
+
+import zlib
+import html
+from functools import lru_cache
+from time import localtime, strftime
+from colorsys import hls_to_rgb
+from PyQt5 import QtGui
+from .message_list import MsgType
+
+
+#########################
+NAME_LIGHTNESS = .3
+NAME_SATURATION = .9
+#########################
+
+
+_BODY = '<body style=" font-family:\'Sans Serif\'; font-size:9pt; font-weight:400; font-style:normal;">'
+_BLOCK = ' style=" margin-top:0px; margin-bottom:0px;"'  # paragraphs of the template, not spaced out
+_TIME = f'<p align="right"{_BLOCK}><span style=" font-size:7pt; color:#353535;">{{time}}</span></p></body>'
+_TEXT = '<p style=" margin-top:0px; margin-bottom:0px; white-space:pre-wrap;">{msg}</p>'  # a member's markup
+
+# MsgType -> str.format of its template, with the fields msg, time, and name and color (of the sender)
+TEMPLATES = {
+    MsgType.SELF: f'{_BODY}{_TEXT}{_TIME}'.format,
+    MsgType.OTHER: f'{_BODY}<p{_BLOCK}><span style=" color:{{color}};">{{name}}</span></p>{_TEXT}{_TIME}'.format,
+    MsgType.SERVER: f'{_BODY}{{msg}}{_TIME}'.format,  # the server's messages are HTML
+}
+
+
+@lru_cache(maxsize=None)
+def name_color(name):
+    """Returns the color of a member's name, as #rrggbb.
+    """
+    hue = zlib.crc32(name.encode()) * 6 % 360
+    r, g, b = (round(y * 256) for y in hls_to_rgb(hue / 360, NAME_LIGHTNESS, NAME_SATURATION))
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+def render(msgtype, cpp_msg):
+    """Returns the rich text of a message (cpp.ServerMsg) shown as msgtype, from a member's markup or the server's HTML.
+    """
+    time = strftime("%H:%M", localtime(cpp_msg.timestamp))
+    if msgtype == MsgType.OTHER:
+        return TEMPLATES[msgtype](msg=cpp_msg.msg, time=time, name=cpp_msg.name, color=name_color(cpp_msg.name))
+    return TEMPLATES[msgtype](msg=cpp_msg.msg, time=time)
+
+
+def to_markup(document):
+    """Returns the markup of a QTextDocument's text: its paragraphs, as lines, and the formatting of its characters
+    (bold, italic, underlined, struck out, colored and links), as tags opened and closed only where it changes.
+    """
+    lines = []
+    block = document.begin()
+    while block.isValid():
+        line = []
+        opened = []  # (name, opening tag) of the tags open, the outermost first
+        fragments = block.begin()
+        while not fragments.atEnd():
+            fragment = fragments.fragment()
+            tags = _tags(fragment.charFormat())
+            common = 0
+            while common < min(len(opened), len(tags)) and opened[common] == tags[common]:
+                common += 1
+            line += [f"</{name}>" for name, _ in reversed(opened[common:])]
+            line += [tag for _, tag in tags[common:]]
+            opened = tags
+            text = fragment.text().replace("\u2028", "\n").replace("\ufffc", "")  # line breaks, and no images
+            line.append(html.escape(text, quote=False))
+            fragments += 1
+        line += [f"</{name}>" for name, _ in reversed(opened)]
+        lines.append("".join(line))
+        block = block.next()
+    return "\n".join(lines)
+
+
+def _tags(char_format):
+    """Returns the (name, opening tag) of the tags of a character format, the outermost first.
+    """
+    tags = []
+    if char_format.isAnchor():  # links are underlined and colored by the document they are shown in
+        tags.append(("a", f'<a href="{html.escape(char_format.anchorHref())}">'))
+    elif char_format.hasProperty(QtGui.QTextFormat.ForegroundBrush):
+        tags.append(("font", f'<font color="{char_format.foreground().color().name()}">'))
+    if char_format.fontWeight() > QtGui.QFont.Normal:
+        tags.append(("b", "<b>"))
+    if char_format.fontItalic():
+        tags.append(("i", "<i>"))
+    if char_format.fontUnderline() and not char_format.isAnchor():
+        tags.append(("u", "<u>"))
+    if char_format.fontStrikeOut():
+        tags.append(("s", "<s>"))
+    return tags
@@ -0,0 +1,186 @@
+# thumbnails.py
+# Thumbnails of the chat's image attachments, shown in their bubbles. They are made by a worker thread, which reads
+# each image straight at the thumbnail's size, so the GUI thread never decodes a full image; and they are cached
+# on disk by the image's content hash, so an image is decoded once, whatever message it is attached to, and by the
+# attachment's UUID, so the image of an attachment whose thumbnail was made before is not needed (nor downloaded) again.
+# The thumbnails painted last are kept in memory, and are requested only when painted, so scrolling past many images
+# costs no more than the ones shown.
+
+import os
+import hashlib
+import threading
+from collections import deque, OrderedDict
+from PyQt5 import QtCore, QtGui
+from PyQt5.QtCore import Qt
+
+
+#########################
+THUMBNAIL_DIR = os.path.join(os.path.expanduser("~"), ".chat-program", "thumbnails")
+IMAGE_SUFFIXES = {"png", "jpg", "jpeg", "gif", "bmp", "webp"}
+#########################
+
+
+def is_image(filename):
+    return QtCore.QFileInfo(filename).suffix().lower() in IMAGE_SUFFIXES
+
+
+class ThumbnailThread(QtCore.QThread):
+    """Thread making the thumbnails of images, the last one asked for first (it is the one in view).
+    Instance attributes:
+    size - the size thumbnails fit in.
+    queue - deque of (key, path of the image, None if it is not on this computer) waiting.
+    """
+
+    # emitted with a key and the thumbnail of its image, a null QImage if it could not be read.
+    loaded = QtCore.pyqtSignal(object, QtGui.QImage)
+    # emitted with a key whose thumbnail was never made, and whose image is not on this computer.
+    missing = QtCore.pyqtSignal(object)
+
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.running = True
+
+    def put(self, key, path):
+        with self.condition:
+            self.queue.append((key, path))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or not self.running)
+                if not self.running:
+                    return
+                key, path = self.queue.pop()
+            try:
+                image = self.thumbnail(key, path)
+            except OSError:
+                image = QtGui.QImage()
+            if image is None:
+                self.missing.emit(key)
+            else:
+                self.loaded.emit(key, image)
+
+    def thumbnail(self, key, path):
+        """Returns the thumbnail of the image at path, from the cache if it was made before (for key or the same image).
+        Returns None if it was not, and there is no image (path is None).
+        """
+        by_key = os.path.join(THUMBNAIL_DIR, f"{key}-{self.size.width()}x{self.size.height()}.png")
+        if os.path.isfile(by_key):
+            return QtGui.QImage(by_key)
+        if path is None:
+            return None
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                sha256.update(block)
+        cached = os.path.join(THUMBNAIL_DIR, f"{sha256.hexdigest()}-{self.size.width()}x{self.size.height()}.png")
+        if os.path.isfile(cached):
+            image = QtGui.QImage(cached)
+            self.save(image, by_key)
+            return image
+        reader = QtGui.QImageReader(path)
+        reader.setAutoTransform(True)  # as the camera was held
+        size = reader.size()
+        if size.isValid() and (size.width() > self.size.width() or size.height() > self.size.height()):
+            reader.setScaledSize(size.scaled(self.size, Qt.KeepAspectRatio))  # decoded at that size, if the format allows
+        image = reader.read()
+        if not image.isNull():
+            if image.width() > self.size.width() or image.height() > self.size.height():
+                image = image.scaled(self.size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            self.save(image, cached)
+            self.save(image, by_key)
+        return image
+
+    def save(self, image, path):
+        os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+        if image.save(f"{path}.tmp", "PNG"):
+            os.replace(f"{path}.tmp", path)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+
+class ThumbnailCache(QtCore.QObject):
+    """The thumbnails of image attachments, made on a ThumbnailThread and kept in memory for the last MEMORY of them.
+    Instance attributes:
+    locate - function returning the path of an attachment's file, or None if it is not on this computer.
+    fetch - function downloading an attachment's file, when its thumbnail is needed and was never made;
+            the file is given to load once it is downloaded (or the thumbnail to fail).
+    pixmaps - OrderedDict of the UUID of an attachment's file to its thumbnail (None if its image could not be read),
+              the one painted last at the end.
+    requested - dict of the UUIDs of the files whose thumbnails are on their way to their attachments.
+    """
+
+    # emitted when thumbnails arrive.
+    updated = QtCore.pyqtSignal()
+
+    SIZE = QtCore.QSize(240, 180)  # thumbnails fit in it
+    MEMORY = 100  # thumbnails kept in memory
+
+    def __init__(self, locate, fetch, parent=None):
+        super().__init__(parent)
+        self.locate = locate
+        self.fetch = fetch
+        self.pixmaps = OrderedDict()
+        self.requested = {}
+        self.thread = ThumbnailThread(self.SIZE)
+        self.thread.loaded.connect(self.loaded)
+        self.thread.missing.connect(self.missing)
+        self.thread.start()
+
+    def get(self, attachment):
+        """Returns the thumbnail of an image attachment, or None while it is made (or if it can't be).
+        """
+        key = attachment.uuid
+        if key in self.pixmaps:
+            self.pixmaps.move_to_end(key)
+            return self.pixmaps[key]
+        if key not in self.requested:
+            self.requested[key] = attachment
+            self.thread.put(key, self.locate(attachment))
+        return None
+
+    def load(self, key, path):
+        """Makes the thumbnail of the image at path, once it was fetched.
+        """
+        self.thread.put(key, path)
+
+    def missing(self, key):
+        attachment = self.requested.get(key)
+        if attachment is not None:  # not forgotten meanwhile
+            self.fetch(attachment)
+
+    def forget(self, key):
+        """Gives up a thumbnail on its way, whose image is no longer fetched: it is requested again when painted.
+        """
+        self.requested.pop(key, None)
+
+    def fail(self, key):
+        """Gives up the thumbnail of an image that could not be found.
+        """
+        self.loaded(key, QtGui.QImage())
+
+    def loaded(self, key, image):
+        self.requested.pop(key, None)
+        self.pixmaps[key] = None if image.isNull() else QtGui.QPixmap.fromImage(image)
+        while len(self.pixmaps) > self.MEMORY:
+            self.pixmaps.popitem(last=False)
+        self.updated.emit()
+
+    def retry(self):
+        """Requests again the thumbnails that failed or could not be located, once the connection is up.
+        """
+        self.requested.clear()
+        for key in [key for key, pixmap in self.pixmaps.items() if pixmap is None]:
+            del self.pixmaps[key]
+        self.updated.emit()
+
+    def close(self):
+        self.thread.stop()
+        self.thread.wait()
@@ -1,106 +1,218 @@
-from time import localtime, strftime
-from backend.client import Client
+import os
+import socket
+import itertools
+import threading
+from collections import deque
+from time import perf_counter
+from uuid import uuid4
+from backend.client import Client, Sequence
 from backend import cpp
-from PyQt5 import QtWidgets, QtCore
+from PyQt5 import QtWidgets, QtGui, QtCore
 from PyQt5.QtWidgets import QFileDialog
 from .window import Window
 from frontend.ui.chat_ui import ChatUi
-from frontend.ui.widgets import QGrowingTextBrowser, QFileAttachment
-from enum import Enum
-from colorsys import hls_to_rgb
+from frontend.ui.message_list import MsgType, ChatMessage, Transfer
+from frontend.ui.message_store import MessageStore, cache_path
+from frontend.ui.download_manager import DownloadManager, download_path
+from frontend.ui.thumbnails import ThumbnailCache, is_image
+from frontend.ui.render import render, to_markup
 
 
-class MsgType(Enum):
-    SELF = 0  # msg typed by the user.
-    OTHER = 1  # msg typed by another user in the group.
-    SERVER = 2  # msg sent to the user by the server.
+class ChatWindow(Window):
+    """The chat's main window, connecting to the server given by args['name'], args['ip'] and args['port'].
+    Messages received in a burst are not displayed one by one: they wait in the receiving thread,
+    and are displayed together at most once per frame (FRAME_INTERVAL), with a single layout of the message list.
+    Messages are cached on disk (per server and name): the window shows the cached ones at once, while it connects,
+    then rejoins the rooms and asks the server for the broadcasts missed since the last one cached.
+    If the server refuses the connection, the window closes with the reason as data['refusal'].
+    Messages to the server are queued in an outbox (kept in the store) and sent by the sending thread,
+    so typing never waits for the connection; if the connection is lost, they wait until it is restored.
+    Files are uploaded by an UploadThread each, alongside the messages, and shared once the server has all of them;
+    their attachments show the upload's progress, and can be cancelled from their context menu.
+    Clicking an attachment downloads it (through the DownloadManager, with its progress shown likewise) and opens it.
+    Image attachments show a thumbnail. An image is downloaded only when its thumbnail is shown and was never made, and
+    the download is cancelled if it is scrolled out of view before it starts.
+    Instance attributes:
+    client - the connected Client, None until the handshake completes.
+    online - whether the connection is up, as last signaled by the receiving thread.
+    outgoing - set of the outbox numbers of the messages waiting to be sent.
+    uploads - dict of the UUID of a file being uploaded to (UploadThread, room it is shared in).
+    transfers - dict of the UUID of a file uploaded or downloaded to its Transfer, painted on its attachment.
+    downloads - (instance of DownloadManager) downloads the attachments, None until connected.
+    opening - set of the UUIDs of the files to open once they are downloaded.
+    local_files - dict of the UUID of a file uploaded from this window to its path.
+    thumbnails - (instance of ThumbnailCache) thumbnails of the image attachments.
+    previews - set of the UUIDs of the images being downloaded only to make their thumbnails.
+    timings - dict of a startup milestone ('first_paint', 'connected') to the ms since the window was created.
+    """
 
+    FRAME_INTERVAL = 16  # ms between updates of the message list (about 60 per second)
+    CACHED_ROWS = 50  # cached messages shown at launch (more than fill the window), older ones are shown by scrolling up
+    CLOSE_TIMEOUT = 1000  # ms to wait on closing for the messages waiting to be sent, while connected
 
-class ChatWindow(Window):
     def __init__(self, args=dict()):
-        super().__init__(ui=ChatUi(), Qtype=QtWidgets.QMainWindow, args=args)
-        self.client = self.args['client']
-        self.recv_thread = RecvThread(self.client)
-        self.recv_thread.received.connect(self.received_string)
-        self.recv_thread.daemon  = True
-        self.recv_thread.start()
+        self.created = perf_counter()
+        self.store = MessageStore(cache_path(args['ip'], args['port'], args['name']))
+        super().__init__(ui=ChatUi(self.store), Qtype=QtWidgets.QMainWindow, args=args)
+        self.client = None
+        self.recv_thread = None
+        self.send_thread = None
+        self.online = False
+        self.outgoing = set()
+        self.uploads = {}
+        self.downloads = None
+        self.opening = set()
+        self.local_files = {}
+        self.timings = {}
+        self.pending_rows = []  # ChatMessages waiting for the next frame to be displayed
+        self.connect_thread = ConnectThread(args['name'], args['ip'], args['port'])
+        self.connect_thread.accepted.connect(self.connected)
+        self.connect_thread.rejected.connect(self.refused)
 
     def extend_ui(self):
-        self.ui.msgs = []
         self.ui.sendButton.clicked.connect(self.send_msg)
         self.ui.fileButton.clicked.connect(self.send_file)
-        self.ui.window.resizeEvent = self.resize_event
         self.ui.msgInput.send = self.send_msg
         self.ui.msgInput.cmds = Client.COMMANDS
-        
-        file_attach = QFileAttachment(1, "server.zip")
-        file_attach.setStyle(1)
-        self.ui.msgVLayout.addWidget(file_attach)
-        
-        file_attach = QFileAttachment(2, "game.py")
-        file_attach.setStyle(0)
-        self.ui.msgVLayout.addWidget(file_attach)
-
-        html = '''</head>
-    <body style=" font-family:'Sans Serif'; font-size:9pt; font-weight:400; font-style:normal;">
-    </p>Hello world<p align="right"
-    style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;">
-    <span style=" font-size:7pt; color:#353535;">09:51</span></p>
-    </body>
-    </html>
-</head>'''
-        self.display_msg(MsgType.OTHER, html)
-
-    def resize_event(self, event):
-        self.ui.resize_event(event)
-        for msgBrowser in self.ui.msgs:
-            msgBrowser.setMaximumWidth(self.ui.msgArea.size().width() - 30)
-            msgBrowser.adjustSize()
+        self.frame_timer = QtCore.QTimer(self.ui.window)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.setInterval(self.FRAME_INTERVAL)
+        self.frame_timer.timeout.connect(self.update_frame)
+        self.ui.msgView.first_painted.connect(self.first_painted)
+        self.ui.msgView.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+        self.ui.msgView.customContextMenuRequested.connect(self.message_menu)
+        self.ui.msgView.clicked.connect(self.message_clicked)
+        self.transfers = self.ui.msgView.itemDelegate().transfers
+        self.previews = set()
+        self.thumbnails = ThumbnailCache(self.image_path, self.fetch_image)
+        self.thumbnails.updated.connect(self.ui.msgView.viewport().update)
+        self.ui.msgView.verticalScrollBar().valueChanged.connect(self.cancel_previews)
+        self.ui.msgView.itemDelegate().thumbnails = self.thumbnails
+        self.ui.sendButton.setEnabled(False)  # until connected
+        self.ui.fileButton.setEnabled(False)
+        self.ui.msgModel.show_older(self.CACHED_ROWS)
+        self.update_status()
+        self.connect_thread.start()
+
+    def connected(self, client):
+        """Starts the chat once the server accepted the connection: resumes the broadcasts from the cached position.
+        """
+        self.client = client
+        for room, (epoch, last_seq) in self.store.load_sequences().items():
+            self.client.sequences[room] = Sequence(epoch, last_seq)
+        self.client.rejoin()
+        self.send_thread = SendThread(self.client)
+        self.send_thread.sent.connect(self.sent)
+        for number, plaintext in self.store.load_outgoing():  # left from the last launch
+            self.outgoing.add(number)
+            self.send_thread.put(number, plaintext)
+        self.send_thread.start()
+        self.downloads = DownloadManager(self.send_unsaved, self.transfers)
+        self.downloads.progress.connect(lambda file_id: self.ui.msgView.viewport().update())
+        self.downloads.downloaded.connect(self.downloaded)
+        self.recv_thread = RecvThread(self.client, self.send_thread, self.downloads)
+        self.recv_thread.received.connect(self.schedule_frame)
+        self.recv_thread.lost.connect(lambda: self.set_online(False))
+        self.recv_thread.reconnected.connect(lambda: self.set_online(True))
+        self.recv_thread.reconnected.connect(self.thumbnails.retry)
+        self.recv_thread.daemon  = True
+        self.recv_thread.start()
+        self.ui.sendButton.setEnabled(True)
+        self.ui.fileButton.setEnabled(True)
+        self.set_online(True)
+        self.thumbnails.retry()  # the images shown while connecting can be downloaded now
+        self.timings['connected'] = self.elapsed()
+
+    def set_online(self, online):
+        self.online = online
+        self.update_status()
+        if not online:  # the server forgets the uploads of a lost connection
+            for upload, room in self.uploads.values():
+                upload.cancel("Upload failed, the connection was lost.")
+
+    def queue(self, cpp_msg):
+        """Queues a message to the server in the outbox, where it waits until the sending thread sends it.
+        Raises ValueError if the message is larger than the server accepts.
+        """
+        plaintext = self.client.encode(cpp_msg)
+        number = self.store.add_outgoing(plaintext)
+        self.outgoing.add(number)
+        self.send_thread.put(number, plaintext)
+        self.update_status()
+
+    def send_unsaved(self, cpp_msg):
+        """Queues a message to the server that is not kept in the outbox for the next launch.
+        """
+        self.send_thread.put(None, self.client.encode(cpp_msg))
+
+    def sent(self, numbers):
+        """Removes the messages the sending thread sent from the outbox.
+        """
+        self.store.remove_outgoing(numbers)
+        self.outgoing.difference_update(numbers)
+        self.update_status()
+        if not self.outgoing and len(numbers) > 1:
+            self.ui.statusBar.showMessage("Sent the messages that were waiting.", 3000)
+
+    def update_status(self):
+        """Shows the state of the connection, and how many messages wait to be sent, in the status bar.
+        """
+        if self.client is None:
+            status = "Connecting..."
+        elif not self.online:
+            status = "Connection lost, reconnecting..."
+        else:
+            status = ""
+        if self.outgoing:
+            status = f"{status} {len(self.outgoing)} message{'s' if len(self.outgoing) > 1 else ''} waiting to be sent."
+        if status:
+            self.ui.statusBar.showMessage(status.strip())
+        else:
+            self.ui.statusBar.clearMessage()
+
+    def refused(self, refusal):
+        self.data['refusal'] = refusal
+        self.close()
+
+    def first_painted(self):
+        self.timings['first_paint'] = self.elapsed()
+
+    def elapsed(self):
+        """Returns the ms since the window was created.
+        """
+        return (perf_counter() - self.created) * 1000
+
+    def schedule_frame(self):
+        """Makes the next frame display the messages waiting, unless it is already scheduled.
+        """
+        if not self.frame_timer.isActive():
+            self.frame_timer.start()
+
+    def update_frame(self):
+        """Handles the messages received since the last frame, and displays them all at once.
+        """
+        for cpp_msg in self.recv_thread.take():
+            self.received_string(cpp_msg)
+            if not cpp_msg:
+                return
+        rows, self.pending_rows = self.pending_rows, []
+        self.ui.msgView.append(rows)
+        self.save_sequences()
+
+    def save_sequences(self):
+        """Caches the position in the broadcasts of the group and of each room, to resume from on the next launch.
+        """
+        if self.client is not None:
+            self.store.save_sequences({room: (sequence.epoch, sequence.last_seq)
+                                       for room, sequence in list(self.client.sequences.items())})
 
     def display_msg(self, msgtype, html):
-        msgBrowser = QGrowingTextBrowser(self.ui.msgScrollAreaWidgetContents)
-        if msgtype == MsgType.SELF:
-            style = self.ui.selfmsg_style
-            self.ui.msgVLayout.addWidget(msgBrowser, 0, QtCore.Qt.AlignRight)
-        elif msgtype == MsgType.SERVER:
-            style = self.ui.servermsg_style
-            self.ui.msgVLayout.addWidget(msgBrowser, 0, QtCore.Qt.AlignCenter)
-        elif msgtype == MsgType.OTHER:
-            style = self.ui.othermsg_style
-            self.ui.msgVLayout.addWidget(msgBrowser)
-        msgBrowser.setStyleSheet(style)
-        move_scrollbar = False
-        scrollbar = self.ui.msgArea.verticalScrollBar()
-        if scrollbar.value() == scrollbar.maximum():
-            move_scrollbar = True
-        msgBrowser.setMaximumHeight(150)
-        msgBrowser.setHtml(html)
-        self.ui.msgs.append(msgBrowser)
-        self.resize_event(self.ui.window)
-        if move_scrollbar:
-            scrollbar.setValue(scrollbar.maximum())
+        self.pending_rows.append(ChatMessage(msgtype, html))
+        self.schedule_frame()
 
     def display_file_attachment(self, msgtype, attachment):
-        fileAttachment = QFileAttachment(attachment.uuid, attachment.filename)
-        fileAttachment.setStyle(0)
-        # if msgtype == MsgType.SELF:
-        #     style = self.ui.selfmsg_style
-        #     self.ui.msgVLayout.addWidget(msgBrowser, 0, QtCore.Qt.AlignRight)
-        # elif msgtype == MsgType.SERVER:
-        #     style = self.ui.servermsg_style
-        #     self.ui.msgVLayout.addWidget(msgBrowser, 0, QtCore.Qt.AlignCenter)
-        # elif msgtype == MsgType.OTHER:
-        #     style = self.ui.othermsg_style
-        #     self.ui.msgVLayout.addWidget(msgBrowser)
-        self.ui.msgVLayout.addWidget(fileAttachment)
-        move_scrollbar = False
-        scrollbar = self.ui.msgArea.verticalScrollBar()
-        if scrollbar.value() == scrollbar.maximum():
-            move_scrollbar = True
-        self.ui.msgs.append(fileAttachment)
-        self.resize_event(self.ui.window)
-        if move_scrollbar:
-            scrollbar.setValue(scrollbar.maximum())
+        self.pending_rows.append(ChatMessage(msgtype, attachment=attachment))
+        self.schedule_frame()
 
     def handle_msg(self, cpp_msg):
         if not cpp_msg.name:
@@ -109,64 +221,41 @@ class ChatWindow(Window):
             msgtype = MsgType.SELF
         else:
             msgtype = MsgType.OTHER
-        self.display_msg(msgtype, self.html_format(msgtype, cpp_msg))
+        self.display_msg(msgtype, render(msgtype, cpp_msg))
+
+    def handle_room_msg(self, room_msg):
+        """Displays a message broadcast in a room, labeled with the room's name.
+        """
+        cpp_msg = room_msg.msg
+        if type(cpp_msg) is cpp.FileAttachRecv:
+            self.handle_file_attachment(cpp_msg)
+        elif type(cpp_msg) is cpp.ServerMsg:
+            self.handle_msg(cpp.ServerMsg(f"<b>#{room_msg.room}</b> {cpp_msg.msg}", cpp_msg.timestamp, cpp_msg.name))
 
     def handle_file_attachment(self, attachment):
+        if attachment.name == self.client.name and attachment.uuid in self.transfers:
+            return  # uploaded from this window, and already shown
         if attachment.name == self.client.name:
             msgtype = MsgType.SELF
         else:
             msgtype = MsgType.OTHER
         self.display_file_attachment(msgtype, attachment)
 
-    def name_to_color(self, name):
-        """Calculates and returns a member's name color"""
-        k = hash(name)*6 % 360
-        r,g,b = tuple(round(y*256) for y in hls_to_rgb(k/360,.3,.9))
-        return f"#{r:02x}{g:02x}{b:02x}"
-
-    def html_format(self, msgtype, cpp_msg):
-        time = strftime("%H:%M", localtime(cpp_msg.timestamp))
-        msg = cpp_msg.msg
-        name = cpp_msg.name
-        color = self.name_to_color(name)
-        if msgtype == MsgType.SELF:
-            return \
-                f'''</head>
-<body style=" font-family:\'Sans Serif\'; font-size:9pt; font-weight:400; font-style:normal;">{msg}<p align="right"
-style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;">
-<span style=" font-size:7pt; color:#353535;">{time}</span></p>
-</body>
-</html>'''
-        elif msgtype == MsgType.OTHER:
-            return \
-                f'''</head>
-<body style=" font-family:\'Sans Serif\'; font-size:9pt; font-weight:400; font-style:normal;">\n<p
-style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;">
-<span style=" color:{color};">{name}</span></p>\n{msg}\n<p align="right"
-style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;">
-<span style=" font-size:7pt; color:#353535;">{time}</span></p>
-</body>
-</html>'''
-        elif msgtype == MsgType.SERVER:
-            return f'''</head>
-    <body style=" font-family:\'Sans Serif\'; font-size:9pt; font-weight:400; font-style:normal;">
-    </p>{msg}<p align="right"
-    style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;">
-    <span style=" font-size:7pt; color:#353535;">{time}</span></p>
-    </body>
-    </html>'''
-
     def send_msg(self):
         """Sends the message typed by the user & clears the input.
         """
+        if self.client is None:
+            return  # still connecting, the message stays in the input
         msg_plain = self.ui.msgInput.toPlainText()
-        msg_html = self.ui.msgInput.toHtml()
         if msg_plain:
             if msg_plain.strip().split(' ')[0] in Client.COMMANDS:
                 self.send_cmd(msg_plain)
             else:
-                # self.client.send(msg_plain)
-                self.client.ssend(msg_html)
+                try:
+                    self.queue(self.client.in_room(to_markup(self.ui.msgInput.document())))
+                except ValueError:
+                    self.display_msg(MsgType.SERVER, "Error - Message is too long to send.")
+                    return
         self.ui.msgInput.clear()
         self.ui.msgInput.setFocus()
 
@@ -176,8 +265,126 @@ style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -q
         options |= QFileDialog.DontUseNativeDialog
         filepath, _ = QFileDialog.getOpenFileName(self.ui.fileButton,"Send File", "", "", options=options)
         if filepath:
-            attachment = cpp.FileAttachSend(filepath)
-            self.client.ssend(attachment)
+            self.upload(filepath)
+
+    def upload(self, filepath):
+        """Starts uploading a file, shown at once as an attachment with the upload's progress.
+        """
+        try:
+            total = os.path.getsize(filepath)
+        except OSError as err:
+            self.display_msg(MsgType.SERVER, f"Error - Could not read the file: {err.strerror or err}")
+            return
+        file_id = uuid4()
+        upload = UploadThread(self.client, filepath, file_id, total)
+        upload.done.connect(self.upload_done)
+        self.uploads[file_id] = (upload, self.client.room)  # shared in the room it was sent in, once uploaded
+        self.local_files[file_id] = filepath
+        self.transfers[file_id] = Transfer(total)
+        if not self.online:
+            upload.cancel("Upload failed, not connected to the server.")
+        upload.start()
+        self.display_file_attachment(MsgType.SELF, cpp.FileAttachRecv(os.path.basename(filepath), self.client.name, file_id))
+
+    def handle_file_ack(self, ack):
+        if ack.file_id in self.uploads:
+            self.uploads[ack.file_id][0].acknowledge(ack.received)
+            self.transfers[ack.file_id].update(ack.received)
+            self.ui.msgView.viewport().update()
+
+    def upload_done(self, file_id, error):
+        """Shares a file once it is uploaded, through the outbox. error is why the upload stopped, if it did not complete.
+        """
+        upload, room = self.uploads.pop(file_id)
+        upload.wait()
+        self.transfers[file_id].finish(error or None)
+        self.ui.msgView.viewport().update()
+        if not error:
+            attachment = cpp.FileAttachSend(os.path.basename(upload.path), file_id)
+            self.queue(attachment if room is None else cpp.InRoom(room, attachment))
+
+    def message_menu(self, pos):
+        """Shows the context menu of a message: an attachment being uploaded may be cancelled.
+        """
+        index = self.ui.msgView.indexAt(pos)
+        if not index.isValid():
+            return
+        attachment = self.ui.msgModel.message(index.row()).attachment
+        if attachment is None or attachment.uuid not in self.uploads:
+            return
+        menu = QtWidgets.QMenu(self.ui.msgView)
+        menu.addAction("Cancel upload", lambda: self.cancel_upload(attachment.uuid))
+        menu.exec(self.ui.msgView.viewport().mapToGlobal(pos))
+
+    def cancel_upload(self, file_id):
+        if file_id in self.uploads:
+            self.uploads[file_id][0].cancel("Upload cancelled.")
+
+    def message_clicked(self, index):
+        """Opens a clicked attachment, downloading it first unless it was downloaded before.
+        """
+        attachment = self.ui.msgModel.message(index.row()).attachment
+        if attachment is None or self.downloads is None or attachment.uuid in self.uploads:
+            return
+        self.previews.discard(attachment.uuid)  # wanted now, even out of view
+        path = self.downloads.download(attachment.uuid, attachment.filename)
+        if path is None:
+            self.opening.add(attachment.uuid)
+            self.ui.msgView.viewport().update()
+        else:
+            self.open_file(path)
+
+    def image_path(self, attachment):
+        """Returns the path of an image attachment's file on this computer, or None.
+        """
+        if attachment.uuid in self.local_files:
+            return self.local_files[attachment.uuid]
+        path = download_path(attachment.uuid, attachment.filename)
+        return path if os.path.isfile(path) else None
+
+    def fetch_image(self, attachment):
+        """Downloads an image attachment, whose thumbnail is shown and was never made.
+        """
+        if self.downloads is None:  # still connecting, the thumbnail is requested again once connected
+            self.thumbnails.fail(attachment.uuid)
+            return
+        self.previews.add(attachment.uuid)
+        path = self.downloads.download(attachment.uuid, attachment.filename)
+        if path is not None:
+            self.thumbnails.load(attachment.uuid, path)
+
+    def cancel_previews(self):
+        """Cancels the downloads of images for their thumbnails that were scrolled out of view before they started.
+        """
+        if not self.previews:
+            return
+        view, model = self.ui.msgView, self.ui.msgModel
+        rect = view.viewport().rect()
+        first, last = view.indexAt(rect.topLeft()).row(), view.indexAt(rect.bottomLeft()).row()
+        if last == -1:  # below the last row
+            last = model.rowCount() - 1
+        shown = {model.message(row).attachment.uuid for row in range(max(first, 0), last + 1)
+                 if model.message(row).attachment is not None}
+        for file_id in self.previews - shown:
+            if self.downloads.cancel(file_id):
+                self.previews.discard(file_id)
+                self.thumbnails.forget(file_id)
+
+    def downloaded(self, file_id, path, error):
+        self.ui.msgView.viewport().update()
+        self.previews.discard(file_id)
+        if file_id in self.thumbnails.requested and is_image(path):
+            if error:
+                self.thumbnails.fail(file_id)
+            else:
+                self.thumbnails.load(file_id, path)
+        if file_id in self.opening:
+            self.opening.discard(file_id)
+            if not error:
+                self.open_file(path)
+
+    def open_file(self, path):
+        QtGui.QDesktopServices.openUrl(QtCore.QUrl.fromLocalFile(path))
 
     def send_cmd(self, cmdline):
         args = cmdline.split(" ")
@@ -186,28 +393,67 @@ style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -q
             cmdtype = Client.COMMANDS[cmdname]
         except KeyError:
             return
+        if cmdtype == cpp.DataType.CMD_PING.value:
+            if self.online:  # a probe waiting in the outbox would measure the wait
+                self.queue(self.client.ping())
+            else:
+                self.display_msg(MsgType.SERVER, "Error - Not connected to the server.")
+            return
+        if cmdtype == cpp.DataType.CMD_QUIT.value:
+            self.send_unsaved(cpp.Cmd(cmdtype))
+            self.close()
+            return
+        if cmdtype == cpp.DataType.CMD_LEAVE.value and not args:
+            if self.client.room is None:
+                return
+            args = [self.client.room]
         if len(args) == 0:
             cmd = cpp.Cmd(cmdtype)
         elif len(args) == 1:
             cmd = cpp.Cmd(cmdtype, args[0])
         elif len(args) >= 2:
             cmd = cpp.Cmd(cmdtype, args[0], " ".join(args[1:]))
-        self.client.ssend(cmd)
-        if cmdtype == cpp.DataType.CMD_QUIT.value:
-            self.close()
+        if cmdtype in Client.ROOM_COMMANDS:
+            cmd = self.client.in_room(cmd)
+        if cmdtype in [cpp.DataType.CMD_JOIN.value, cpp.DataType.CMD_CREATE.value] and args:
+            self.client.join_room(args[0].lstrip("#"))  # messages are sent in the room joined last
+        self.queue(cmd)
+        if cmdtype == cpp.DataType.CMD_LEAVE.value:
+            self.client.left_room(args[0].lstrip("#"))
 
     def received_string(self, cpp_msg):
         if not cpp_msg:  # kicked by server
             self.close()
         elif type(cpp_msg) is cpp.FileAttachRecv:
             self.handle_file_attachment(cpp_msg)
+        elif type(cpp_msg) is cpp.InRoom:
+            self.handle_room_msg(cpp_msg)
+        elif type(cpp_msg) is cpp.FileAck:
+            self.handle_file_ack(cpp_msg)
         else:
             self.handle_msg(cpp_msg)
 
     def close(self):
         """Closes the program.
         """
-        self.recv_thread.stop()
+        if self.recv_thread is not None:
+            self.recv_thread.stop()
+            self.recv_thread.disconnect()  # it may still be receiving or reconnecting, after the window is gone
+        for upload, room in list(self.uploads.values()):
+            upload.done.disconnect()
+            upload.cancel("Upload cancelled.")
+            upload.wait(self.CLOSE_TIMEOUT)
+        if self.downloads is not None:
+            self.downloads.disconnect()
+            self.downloads.close()
+        self.thumbnails.close()
+        if self.send_thread is not None:
+            self.send_thread.stop()
+            self.send_thread.wait(self.CLOSE_TIMEOUT)
+            # handle the sent signals of the messages flushed meanwhile, so they are removed from the outbox:
+            QtCore.QCoreApplication.sendPostedEvents(None, QtCore.QEvent.MetaCall)
+        self.save_sequences()
+        self.store.close()
         self.ui.window.close()
 
     def closeEvent(self, event):
@@ -215,23 +461,250 @@ style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -q
         event.accept()
 
 
+class ConnectThread(QtCore.QThread):
+
+    rejected = QtCore.pyqtSignal(str)  # stored string details the cause of rejection.
+    accepted = QtCore.pyqtSignal(Client)  # stored Client-type is the client object for communication with the server.
+
+    def __init__(self, name, ip, port):
+        super().__init__()
+        super().__init__(parent=self)
+        self.name = name
+        self.ip = ip
+        self.port = port
+
+    def run(self):
+        client = Client(self.name)
+        try:
+            refusal = client.handshake(self.ip, self.port)
+        except OSError as err:
+            refusal = f"Could not connect to the server: {err.strerror or err}"
+        if refusal:
+            self.rejected.emit(refusal)
+        else:
+            self.accepted.emit(client)
+
+
+class SendThread(QtCore.QThread):
+    """Thread responsible for sending data to the server, so the window never waits for the connection.
+    Messages are queued with their outbox number, and sent in order, up to FLUSH_BATCH of them in one write.
+    While the connection is down they wait, and are sent once the receiving thread reconnects;
+    a backlog is sent FLUSH_BATCH messages every FLUSH_INTERVAL, so it stays within the server's rate limits.
+    Instance attributes:
+    queue - deque of (outbox number, encoded message) waiting to be sent, the number is None for unsaved messages.
+    online - whether the connection is up.
+    """
+
+    # emitted with the outbox numbers of messages once they are sent.
+    sent = QtCore.pyqtSignal(list)
+
+    FLUSH_BATCH = 10  # messages sent in one write
+    FLUSH_INTERVAL = 2  # seconds between the writes of a backlog (the server allows bursts of 20, then 5 a second)
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.online = True
+        self.running = True
+
+    def put(self, number, plaintext):
+        with self.condition:
+            self.queue.append((number, plaintext))
+            self.condition.notify()
+
+    def set_online(self, online):
+        with self.condition:
+            self.online = online
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                # once stopped, only the messages already queued are sent, if the connection is up:
+                self.condition.wait_for(lambda: self.online and self.queue or not self.running)
+                if not (self.online and self.queue):
+                    return
+                batch = list(itertools.islice(self.queue, self.FLUSH_BATCH))
+            try:
+                self.client.ssend_encoded([plaintext for number, plaintext in batch])
+            except OSError:  # the connection was lost, wake the receiving thread up to reconnect
+                self.set_online(False)
+                try:
+                    self.client.srv_soc.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                continue
+            with self.condition:
+                for _ in batch:
+                    self.queue.popleft()
+                backlog = len(self.queue)
+            self.sent.emit([number for number, plaintext in batch if number is not None])
+            if backlog and len(batch) == self.FLUSH_BATCH:
+                with self.condition:
+                    self.condition.wait_for(lambda: not self.running, self.FLUSH_INTERVAL)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+
+class UploadThread(QtCore.QThread):
+    """Thread uploading a file to the server as FILE_PART chunks, read from disk one at a time.
+    At most WINDOW bytes are sent ahead of the server's acknowledgments, so the memory and the socket buffers
+    an upload holds are bounded, and messages sent meanwhile wait behind at most a chunk.
+    The server writes chunks only in order, and drops those over its rate limit: an acknowledgment that does not
+    grow means a chunk was lost, and the upload goes back to the first byte not acknowledged, as it does
+    after ACK_TIMEOUT without acknowledgments.
+    Instance attributes:
+    path, file_id, total - the file uploaded, its UUID and its size.
+    sent - bytes of the file sent, from its start.
+    acked - bytes of the file the server acknowledged.
+    error - why the upload was cancelled, or None.
+    """
+
+    # emitted with the file's UUID and why the upload was cancelled, or "" once the server has all of the file.
+    done = QtCore.pyqtSignal(object, str)
+
+    CHUNK_SIZE = 64 * 1024
+    WINDOW = 4 * CHUNK_SIZE  # bytes sent and not acknowledged yet
+    ACK_TIMEOUT = 1  # seconds, the server drops chunks over its rate limit (about a second's worth) without answering
+
+    def __init__(self, client, path, file_id, total):
+        super().__init__()
+        self.client = client
+        self.path = path
+        self.file_id = file_id
+        self.total = total
+        self.condition = threading.Condition()
+        self.sent = 0
+        self.acked = 0
+        self.started = False  # whether a chunk was sent (an empty file is sent as one empty chunk)
+        self.resent_from = None  # byte the upload last went back to after a lost chunk
+        self.error = None
+
+    def acknowledge(self, received):
+        """Handles the server's acknowledgment that it has received bytes of the file.
+        """
+        with self.condition:
+            if received > self.acked:
+                self.acked = received
+            elif received < min(self.sent, self.total) and received != self.resent_from:  # the chunks after a lost one were ignored
+                self.sent = self.resent_from = received
+            self.condition.notify()
+
+    def cancel(self, error):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.condition.notify()
+
+    def can_send(self):
+        return (self.error is not None or self.acked == self.total and self.started
+                or self.sent - self.acked < self.WINDOW and (self.sent < self.total or not self.started))
+
+    def run(self):
+        try:
+            with open(self.path, "rb") as file:
+                while True:
+                    with self.condition:
+                        if not self.condition.wait_for(self.can_send, self.ACK_TIMEOUT):
+                            self.sent = self.resent_from = self.acked  # the last chunks were lost
+                        if self.error is not None or self.acked == self.total and self.started:
+                            break
+                        offset = self.sent
+                        size = min(self.CHUNK_SIZE, self.total - offset)
+                        self.sent += size
+                        self.started = True
+                    file.seek(offset)
+                    chunk = file.read(size)
+                    if len(chunk) < size:
+                        self.cancel("Upload failed, the file was changed.")
+                    else:
+                        self.client.ssend(cpp.FilePart(self.file_id, offset, self.total, chunk))
+        except OSError as err:
+            self.cancel(f"Upload failed: {err.strerror or err}")
+        self.done.emit(self.file_id, self.error or "")
+
+
 class RecvThread(QtCore.QThread):
     """Thread responsible for receiving data from the server.
+    Received messages wait in the thread until the window takes them, and the window is signaled
+    only when the first of them arrives, not for every message.
+    The chunks of downloaded files are not handed to the window, but written by the DownloadManager.
+    If the connection is lost (rather than closed by the server), the thread reconnects,
+    retrying after each of RETRY_DELAYS in turn, and lets the sending thread resume.
+    A connection is lost once nothing arrives for RECV_TIMEOUT: while it is up, the server echoes the messages
+    the client sends, and pings it after 15 seconds of silence.
     """
 
-    # stored string details the cause of rejection.
-    received = QtCore.pyqtSignal(object)
+    # emitted when messages start waiting to be taken.
+    received = QtCore.pyqtSignal()
+    # emitted when the connection is lost, and when it is restored.
+    lost = QtCore.pyqtSignal()
+    reconnected = QtCore.pyqtSignal()
 
-    def __init__(self, client):
+    RECV_TIMEOUT = 40  # seconds
+    RETRY_DELAYS = [0.5, 1, 2, 5, 10, 30]  # seconds before each attempt to reconnect, the last one repeats
+
+    def __init__(self, client, send_thread, downloads):
         super().__init__()
         super().__init__(parent=self)
         self.client = client
+        self.send_thread = send_thread
+        self.downloads = downloads
         self.listen = True
+        self.lock = threading.Lock()
+        self.pending = []
 
     def run(self):
+        self.client.srv_soc.settimeout(self.RECV_TIMEOUT)
         while self.listen:
-            cpp_msg = self.client.srecv()
-            self.received.emit(cpp_msg)
+            try:
+                cpp_msg = self.client.srecv()
+            except OSError:  # including the timeout
+                cpp_msg = None
+                self.send_thread.set_online(False)
+            if type(cpp_msg) in [cpp.FileInfo, cpp.FilePart]:
+                self.downloads.receive(cpp_msg)
+                continue
+            if cpp_msg is None and not self.send_thread.online and self.reconnect():
+                continue
+            with self.lock:
+                signal = not self.pending
+                self.pending.append(cpp_msg)
+            if signal:
+                self.received.emit()
+            if not cpp_msg:  # the connection was closed
+                break
+
+    def reconnect(self):
+        """Reconnects after the connection was lost, until it succeeds or the thread is stopped.
+        Returns whether it reconnected.
+        """
+        self.lost.emit()
+        self.downloads.fail("Download failed, the connection was lost.")
+        for attempt in itertools.count():
+            self.msleep(int(self.RETRY_DELAYS[min(attempt, len(self.RETRY_DELAYS) - 1)] * 1000))
+            if not self.listen:
+                return False
+            try:
+                refusal = self.client.reconnect(self.RECV_TIMEOUT)  # refused while the server holds the lost connection
+            except OSError:
+                refusal = "unreachable"
+            if refusal is None:
+                self.send_thread.set_online(True)
+                self.reconnected.emit()
+                return True
+
+    def take(self):
+        """Returns the messages received since the last call, oldest first.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        return pending
     
     def stop(self):
         self.listen = False
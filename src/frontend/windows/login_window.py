@@ -1,11 +1,12 @@
 from PyQt5 import QtWidgets, QtCore
 from .window import Window
 from frontend.ui.login_ui import LoginUi
-from backend.client import Client
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import AES, PKCS1_OAEP
 
 class LoginWindow(Window):
+    """Asks for the user's name and the server to connect to, which the window returns as its data.
+    The chat window connects to the server, and if the server refuses, this window is shown again with args['refusal'].
+    """
+
     def __init__(self, args=dict()):
         super().__init__(ui=LoginUi(), Qtype=QtWidgets.QDialog, args=args)
 
@@ -15,18 +16,16 @@ class LoginWindow(Window):
         self.ui.lineName.setText(self.args['default_name'])
         self.ui.buttonBox.accepted.connect(lambda: self.login() if self.validate_login() else None)
         self.ui.lineName.textEdited.connect(self.ui.labelError.clear)
+        if self.args.get('refusal'):
+            QtCore.QTimer.singleShot(0, lambda: self.show_error(self.args['refusal']))
 
         # self.ui.buttonBox.accepted.emit()
 
     def login(self):
-        name = self.ui.lineName.text()
-        ip = self.ui.lineIP.text() if self.ui.lineIP.text() else self.args['default_ip']
-        port = self.ui.spinPort.value()
-        self.ui.ok()
-        connect_thread = ConnectThread(name, ip, port)
-        connect_thread.rejected.connect(self.rejected)
-        connect_thread.accepted.connect(self.accepted)
-        connect_thread.start()
+        self.data['name'] = self.ui.lineName.text()
+        self.data['ip'] = self.ui.lineIP.text() if self.ui.lineIP.text() else self.args['default_ip']
+        self.data['port'] = self.ui.spinPort.value()
+        self.window.close()
 
     def validate_login(self):
         name = self.ui.lineName.text()
@@ -35,15 +34,6 @@ class LoginWindow(Window):
             return False
         return True
 
-    def rejected(self, err):
-        self.ui.retry()
-        self.show_error(err)
-
-    def accepted(self, client):
-        self.data['client'] = client
-        QtWidgets.QApplication.restoreOverrideCursor()
-        self.window.close()
-
     def show_error(self, err):
         msg = QtWidgets.QMessageBox()
         msg.setWindowTitle("Error")
@@ -52,31 +42,6 @@ class LoginWindow(Window):
         msg.exec()
 
 
-class ConnectThread(QtCore.QThread):
-
-    rejected = QtCore.pyqtSignal(str)  # stored string details the cause of rejection.
-    accepted = QtCore.pyqtSignal(Client)  # stored Client-type is the client object for communication with the server.
-
-    def __init__(self, name, ip, port):
-        super().__init__()
-        super().__init__(parent=self)
-        self.name = name
-        self.ip = ip
-        self.port = port
-
-    def run(self):
-        self.msleep(250)
-        client = Client(self.name)
-        client.connect(self.ip, self.port)
-        response = client.recv()
-        if type(response) is not bytearray and response.msg.startswith("Connection Refused"):
-            self.rejected.emit(response.msg)
-        else:
-            enc_aeskey = response
-            client.aeskey = PKCS1_OAEP.new(client.privkey).decrypt(enc_aeskey)
-            self.accepted.emit(client)
-
-
 if __name__ == "__main__":
     app = LoginWindow(args={'default_ip': '127.0.0.1', 'default_port': 8000})
     app.exec()